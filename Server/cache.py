@@ -0,0 +1,273 @@
+"""In memory player state with write-behind persistence.
+
+Only the connection of a player changes that player's state, so the server keeps the resources and buildings of
+active players in memory, answers reads from there and writes the changes to SQLite in periodic batches.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import economy
+import logs
+from database import UPSERT_BUILDING
+
+log = logs.get_logger("cache")
+
+PLAYER_COLUMNS = "Food, Metal, Energy, FoodRate, MetalRate, EnergyRate, LastUpdated"
+
+
+class PlayerEntry:
+    def __init__(self, pid, row, buildings):
+        self.pid = pid
+        # [Food, Metal, Energy, FoodRate, MetalRate, EnergyRate, LastUpdated], the same order as PLAYER_COLUMNS
+        self.row = list(row) if row is not None else None
+        # (PlayerID, BuildingNo, BuildingName, BuildingLevel) rows, as info_buildings returns them
+        self.buildings = buildings
+        # changes not written yet, resources are only written when they changed here, so a cached row never
+        # overwrites resources the economy tick produced in the database
+        self.resources_dirty = False
+        # latest row per hexagon changed since the last flush
+        self.new_buildings = {}
+        self.last_access = time.monotonic()
+
+    @property
+    def dirty(self):
+        return self.resources_dirty or bool(self.new_buildings)
+
+
+class PlayerStateCache:
+    def __init__(self, db, lazy=True, idle_seconds=300.0, flush_seconds=1.0, active_pids=None):
+        self.db = db
+        # callable returning the players with an open connection, those are never evicted
+        self.active_pids = active_pids
+        self.lazy = lazy
+        self.idle_seconds = idle_seconds
+        self.flush_seconds = flush_seconds
+        self.entries = {}
+        self.lock = threading.RLock()
+        # moves on every invalidate_resources, a row read from the database before it is not used
+        self.generation = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="cache-flush", daemon=True)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.last_flush_duration = 0.0
+        self.max_flush_duration = 0.0
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Stop the flush thread and write everything still dirty, nothing is lost on shutdown."""
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.flush()
+
+    def load_row(self, pid):
+        with self.db.reader() as connection:
+            return connection.execute(f"SELECT {PLAYER_COLUMNS} FROM Players WHERE PlayerID = ?", (pid,)).fetchone()
+
+    def get(self, pid):
+        """The player's entry, None when there is no such player, like the uncached reads find no row.
+
+        The database is read without the lock, so a login storm does not queue every cached read behind it. Callers
+        that need the entry under the lock use locked().
+        """
+        with self.lock:
+            entry = self.entries.get(pid)
+            if entry is not None:
+                self.hits += 1
+                entry.last_access = time.monotonic()
+                if entry.row is not None:
+                    return entry
+                generation = self.generation
+            else:
+                self.misses += 1
+        if entry is not None:
+            # resources were changed in the database behind the cache, see invalidate_resources
+            row = self.load_row(pid)
+            if row is None:
+                return None
+            with self.lock:
+                # a row read before another invalidation is stale, the caller loads it again
+                if entry.row is None and generation == self.generation:
+                    entry.row = list(row)
+                return entry
+        with self.db.reader() as connection:
+            row = connection.execute(f"SELECT {PLAYER_COLUMNS} FROM Players WHERE PlayerID = ?", (pid,)).fetchone()
+            buildings = connection.execute("SELECT * FROM Buildings WHERE PlayerID = ?", (pid,)).fetchall()
+        if row is None:
+            return None
+        with self.lock:
+            # another thread may have loaded the same player meanwhile, keep the first one
+            entry = self.entries.setdefault(pid, PlayerEntry(pid, row, buildings))
+            entry.last_access = time.monotonic()
+            return entry
+
+    @contextmanager
+    def locked(self, pid):
+        """Hold the lock with the player's loaded entry, or None for a missing player, loading it before the lock."""
+        while True:
+            entry = self.get(pid)
+            with self.lock:
+                # invalidated or evicted between the load and the lock, load it again
+                if entry is None or (entry.row is not None and self.entries.get(pid) is entry):
+                    yield entry
+                    return
+
+    @contextmanager
+    def existing(self, pid):
+        with self.locked(pid) as entry:
+            if entry is None:
+                raise KeyError(f"No player {pid}")
+            yield entry
+
+    def resources(self, pid, now=None):
+        with self.locked(pid) as entry:
+            if entry is None:
+                return None
+            if self.lazy:
+                return economy.accrued(entry.row, now)
+            return tuple(entry.row[:3])
+
+    def peek_resources(self, pids, now=None):
+        """Resources of the cached players among pids, without loading or touching anything."""
+        with self.lock:
+            found = {}
+            for pid in pids:
+                entry = self.entries.get(pid)
+                if entry is not None and entry.row is not None:
+                    found[pid] = economy.accrued(entry.row, now) if self.lazy else tuple(entry.row[:3])
+            return found
+
+    def buildings(self, pid):
+        with self.locked(pid) as entry:
+            return list(entry.buildings) if entry is not None else []
+
+    def add_building(self, pid, building_no, building_name, building_level, now=None):
+        with self.existing(pid) as entry:
+            row = (pid, building_no, building_name, building_level)
+            for index, building in enumerate(entry.buildings):
+                if building[1] == building_no:
+                    entry.buildings[index] = row
+                    break
+            else:
+                entry.buildings.append(row)
+            entry.new_buildings[building_no] = row
+            if self.lazy:
+                # same bookkeeping as economy.settle, resources up to now and the new rates
+                entry.row[0], entry.row[1], entry.row[2], entry.row[6] = economy.settled(entry.row, now)
+                entry.row[3:6] = economy.building_rates(building[2:4] for building in entry.buildings)
+                entry.resources_dirty = True
+
+    def produce(self, pid):
+        """One production period for a player, what the update command does in poll mode."""
+        with self.existing(pid) as entry:
+            produced = economy.building_rates(building[2:4] for building in entry.buildings)
+            for index in range(3):
+                entry.row[index] += produced[index]
+            entry.resources_dirty = True
+
+    def save(self, pid):
+        """What the cache holds of a player, restore puts it back when the change made after it is rolled back."""
+        with self.lock:
+            entry = self.entries.get(pid)
+            if entry is None:
+                return pid, None
+            return pid, (entry, list(entry.row) if entry.row is not None else None, list(entry.buildings),
+                         dict(entry.new_buildings), entry.resources_dirty)
+
+    def restore(self, saved):
+        pid, state = saved
+        with self.lock:
+            if state is None:
+                # loaded by the change that failed, the database still has what it was loaded from
+                self.entries.pop(pid, None)
+                return
+            entry, entry.row, entry.buildings, entry.new_buildings, entry.resources_dirty = state
+            self.entries[pid] = entry
+
+    def invalidate_resources(self):
+        """Forget cached resources after something updated Players directly, like the economy tick."""
+        with self.lock:
+            self.generation += 1
+            for entry in self.entries.values():
+                entry.row = None
+
+    def flush(self, pids=None):
+        """Write every dirty entry, or those of pids, in one transaction, returns the number of players written."""
+        t0 = time.perf_counter()
+        dirty, players, buildings = [], [], []
+        try:
+            with self.db.writer() as connection:
+                # the changes are taken out with the writer held, so a batch still running and possibly rolling back
+                # its commands is never written half way, the write itself runs without blocking the cached reads
+                with self.lock:
+                    dirty = [entry for entry in self.entries.values()
+                             if entry.dirty and (pids is None or entry.pid in pids)]
+                    if not dirty:
+                        return 0
+                    players = [(*entry.row, entry.pid) for entry in dirty
+                               if entry.resources_dirty and entry.row is not None]
+                    for entry in dirty:
+                        buildings.extend(entry.new_buildings.values())
+                        entry.new_buildings = {}
+                        entry.resources_dirty = False
+                connection.executemany(
+                    "UPDATE Players SET Food = ?, Metal = ?, Energy = ?, FoodRate = ?, MetalRate = ?, EnergyRate = ?, "
+                    "LastUpdated = ? WHERE PlayerID = ?", players)
+                connection.executemany(UPSERT_BUILDING, buildings)
+        except Exception:
+            # put the changes back so the next flush retries them
+            with self.lock:
+                written = {player[-1] for player in players}
+                for entry in dirty:
+                    for row in buildings:
+                        # a change made while the flush was running is newer, keep it
+                        if row[0] == entry.pid:
+                            entry.new_buildings.setdefault(row[1], row)
+                    if entry.pid in written:
+                        entry.resources_dirty = True
+            raise
+        duration = time.perf_counter() - t0
+        self.flushes += 1
+        self.last_flush_duration = duration
+        self.max_flush_duration = max(self.max_flush_duration, duration)
+        logs.event(log, "cache_flush", logging.DEBUG, players=len(dirty), ms=round(duration * 1000, 2))
+        return len(dirty)
+
+    def evict_idle(self, active_pids=()):
+        """Drop clean entries nobody touched for idle_seconds, players with an open session stay."""
+        limit = time.monotonic() - self.idle_seconds
+        with self.lock:
+            idle = [pid for pid, entry in self.entries.items()
+                    if not entry.dirty and entry.last_access < limit and pid not in active_pids]
+            for pid in idle:
+                del self.entries[pid]
+            self.evictions += len(idle)
+        return len(idle)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "flushes": self.flushes,
+            "last_flush_ms": self.last_flush_duration * 1000,
+            "max_flush_ms": self.max_flush_duration * 1000,
+        }
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_seconds):
+            try:
+                self.flush()
+                self.evict_idle(self.active_pids() if self.active_pids is not None else ())
+            except Exception as e:
+                logs.event(log, "cache_flush_failed", logging.ERROR, error=e)
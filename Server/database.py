@@ -0,0 +1,175 @@
+"""Server wide SQLite connection management.
+
+One writer connection is shared by every client and guarded by a lock, so writes never fight over the file lock,
+while a small pool of reader connections serves the queries. The database runs in WAL mode so the readers keep
+working while the writer commits.
+"""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import logs
+
+log = logs.get_logger("database")
+
+PRAGMAS = {
+    "journal_mode": "WAL",
+    # NORMAL is safe in WAL mode, a power loss can only drop the latest commits, never corrupt the file
+    "synchronous": "NORMAL",
+    # negative values are KiB, so about 8 MB of page cache per connection
+    "cache_size": -8000,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+# connections idle for longer than this are checked with a test query before being handed out
+HEALTH_CHECK_AFTER = 30.0
+
+# one row per hexagon, an upgrade or downgrade replaces the row instead of adding history
+UPSERT_BUILDING = (
+    "INSERT INTO Buildings(PlayerID, BuildingNo, BuildingName, BuildingLevel) VALUES(?,?,?,?) "
+    "ON CONFLICT(PlayerID, BuildingNo) DO UPDATE SET "
+    "BuildingName = excluded.BuildingName, BuildingLevel = excluded.BuildingLevel")
+
+
+def ensure_unique_buildings(connection):
+    """Collapse the building history to the latest row per hexagon and make (PlayerID, BuildingNo) unique.
+
+    Returns the number of outdated rows removed.
+    """
+    exists = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'BuildingsPlayerHexagon'").fetchone()
+    if exists:
+        return 0
+    # rows were only ever appended, so the highest rowid of a hexagon is its current building
+    removed = connection.execute(
+        "DELETE FROM Buildings WHERE rowid NOT IN (SELECT MAX(rowid) FROM Buildings GROUP BY PlayerID, BuildingNo)"
+    ).rowcount
+    connection.execute("CREATE UNIQUE INDEX BuildingsPlayerHexagon ON Buildings(PlayerID, BuildingNo)")
+    logs.event(log, "buildings_compacted", removed=removed)
+    return removed
+
+
+def apply_pragmas(connection, pragmas=None):
+    for name, value in (pragmas or PRAGMAS).items():
+        connection.execute(f"PRAGMA {name} = {value}")
+
+
+def is_healthy(connection):
+    try:
+        connection.execute("SELECT 1").fetchone()
+        return True
+    except sqlite3.Error:
+        return False
+
+
+class ConnectionManager:
+    """Pool of reader connections plus one dedicated writer connection, shared by all clients."""
+
+    def __init__(self, connect, readers=4, pragmas=None, checkout_timeout=10.0):
+        self.connect = connect
+        self.pragmas = pragmas or PRAGMAS
+        self.checkout_timeout = checkout_timeout
+        self.reader_count = readers
+        # LIFO so the most recently used, already warm, connections are reused first
+        self.readers = queue.LifoQueue()
+        self.last_used = {}
+        self.writer_lock = threading.RLock()
+        self.local = threading.local()
+        self.writer_connection = self.open_connection()
+        for _ in range(readers):
+            self.readers.put(self.open_connection())
+        self.replaced = 0
+        # optional callable(access, seconds) told how long each outermost reader or writer block held its connection
+        self.observe = None
+
+    def open_connection(self):
+        connection = self.connect()
+        apply_pragmas(connection, self.pragmas)
+        self.last_used[id(connection)] = time.monotonic()
+        return connection
+
+    def checked(self, connection):
+        """Return the connection, or a fresh one if it has been idle and no longer answers."""
+        last_used = self.last_used.pop(id(connection), 0)
+        if time.monotonic() - last_used > HEALTH_CHECK_AFTER and not is_healthy(connection):
+            logs.event(log, "connection_replaced", logging.WARNING)
+            try:
+                connection.close()
+            except sqlite3.Error:
+                pass
+            connection = self.connect()
+            apply_pragmas(connection, self.pragmas)
+            self.replaced += 1
+        self.last_used[id(connection)] = time.monotonic()
+        return connection
+
+    @contextmanager
+    def reader(self):
+        # Inside a write the reads have to see the uncommitted changes, so they go through the writer
+        if getattr(self.local, "writer_depth", 0):
+            yield self.writer_connection
+            return
+        connection = self.checked(self.readers.get(timeout=self.checkout_timeout))
+        t0 = time.perf_counter()
+        try:
+            yield connection
+        finally:
+            self.last_used[id(connection)] = time.monotonic()
+            self.readers.put(connection)
+            if self.observe is not None:
+                self.observe("read", time.perf_counter() - t0)
+
+    @contextmanager
+    def writer(self):
+        """Exclusive access to the writer connection, commits when the outermost writer block ends."""
+        with self.writer_lock:
+            depth = getattr(self.local, "writer_depth", 0)
+            if depth == 0:
+                self.writer_connection = self.checked(self.writer_connection)
+            self.local.writer_depth = depth + 1
+            t0 = time.perf_counter()
+            try:
+                yield self.writer_connection
+                if depth == 0:
+                    self.writer_connection.commit()
+            except Exception:
+                if depth == 0:
+                    self.writer_connection.rollback()
+                raise
+            finally:
+                self.local.writer_depth = depth
+                if depth == 0 and self.observe is not None:
+                    self.observe("write", time.perf_counter() - t0)
+
+    def health(self):
+        """Check every idle connection and report the state of the pool."""
+        with self.writer():
+            writer_ok = is_healthy(self.writer_connection)
+        idle = []
+        while True:
+            try:
+                idle.append(self.readers.get_nowait())
+            except queue.Empty:
+                break
+        healthy_readers = sum(1 for connection in idle if is_healthy(connection))
+        for connection in idle:
+            self.readers.put(connection)
+        return {
+            "writer": writer_ok,
+            "readers": self.reader_count,
+            "idle_readers": len(idle),
+            "healthy_idle_readers": healthy_readers,
+            "replaced": self.replaced,
+        }
+
+    def close(self):
+        with self.writer_lock:
+            self.writer_connection.close()
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                break
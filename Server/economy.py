@@ -0,0 +1,306 @@
+"""Server owned economy.
+
+Two ways to keep production going without clients asking for an update:
+
+* the tick applies production to every player at a fixed interval with one set based UPDATE
+* lazy accrual stores per player production rates and the time resources were last written, so the current
+  amounts are computed in closed form when they are read and a write only happens when the rates change
+
+What a building produces comes from one table of building types with an amount per level. The tick, the rate
+recomputation and settle use SQL generated from it, so production of all players is summed over (player, type,
+level) inside SQLite in one pass, and building_rates reads the same table for a single player held in Python.
+"""
+import logging
+import math
+import sqlite3
+import threading
+import time
+from contextlib import nullcontext
+
+import logs
+
+log = logs.get_logger("economy")
+
+# the clients used to send update every 5 seconds, production amounts are given per this period
+PRODUCTION_PERIOD = 5.0
+# resource column and amount produced per period by a level 1 building of each producing type
+BUILDING_TYPES = {
+    "plantation": ("Food", 5),
+    "power_plant": ("Energy", 100),
+    "abyssal_ore_refinery": ("Metal", 15),
+}
+# the clients name buildings after their class
+BUILDING_ALIASES = {"powerplant": "power_plant", "abyssalorerefinery": "abyssal_ore_refinery"}
+# every further level produces this much more, higher levels produce as much as MAX_LEVEL
+LEVEL_GROWTH = 1.5
+MAX_LEVEL = 10
+RESOURCE_COLUMNS = ("Food", "Metal", "Energy")
+RATE_COLUMNS = ("FoodRate", "MetalRate", "EnergyRate")
+ACCRUAL_COLUMNS = {"FoodRate": "INTEGER", "MetalRate": "INTEGER", "EnergyRate": "INTEGER", "LastUpdated": "REAL"}
+
+
+def production_table(types=None, aliases=None, max_level=MAX_LEVEL, growth=LEVEL_GROWTH):
+    """{building name: (resource column, (amount at level 0, 1, ... max_level))} from the building definitions.
+
+    Level 0 is a hexagon the building was chosen for but not bought yet, it produces nothing.
+    """
+    types = BUILDING_TYPES if types is None else types
+    aliases = BUILDING_ALIASES if aliases is None else aliases
+    table = {}
+    for name, (resource, amount) in types.items():
+        amounts = (0,) + tuple(round(amount * growth ** (level - 1)) for level in range(1, max_level + 1))
+        table[name] = (resource, amounts)
+    for alias, name in aliases.items():
+        if name in table:
+            table[alias] = table[name]
+    return table
+
+
+# the production engine reads only this table, the SQL and the Python side are generated from it
+PRODUCTION_RATES = production_table()
+
+
+def level_amount(amounts, level):
+    return amounts[min(max(level or 0, 0), len(amounts) - 1)]
+
+
+def production_sums(rates):
+    """SQL expressions summing the production of each resource column over a player's buildings."""
+    sums = {}
+    for column in RESOURCE_COLUMNS:
+        cases = []
+        for name, (resource, amounts) in rates.items():
+            if resource != column:
+                continue
+            levels = " ".join(f"WHEN {level} THEN {amount}" for level, amount in enumerate(amounts) if amount)
+            cases.append(f"WHEN '{name}' THEN CASE MIN(BuildingLevel, {len(amounts) - 1}) {levels} ELSE 0 END")
+        sums[column] = f"SUM(CASE BuildingName {' '.join(cases)} ELSE 0 END)" if cases else "0"
+    return sums
+
+
+def shard_filter(shard, column="PlayerID"):
+    """SQL condition selecting the players of shard (index, count), players are split by PlayerID % count."""
+    if shard is None:
+        return "1"
+    index, count = shard
+    return f"{column} % {int(count)} = {int(index)}"
+
+
+def production_statement(rates=None, shard=None):
+    rates = rates or PRODUCTION_RATES
+    sums = production_sums(rates)
+    producers = ", ".join(f"'{name}'" for name in rates)
+    owned = f"BuildingLevel > 0 AND {shard_filter(shard)}"
+    if sqlite3.sqlite_version_info >= (3, 33, 0):
+        # one aggregation over Buildings joined back onto Players
+        return (f"UPDATE Players SET Food = Players.Food + p.FoodChange, Metal = Players.Metal + p.MetalChange, "
+                f"Energy = Players.Energy + p.EnergyChange "
+                f"FROM (SELECT PlayerID, CAST({sums['Food']} * :scale AS INTEGER) AS FoodChange, "
+                f"CAST({sums['Metal']} * :scale AS INTEGER) AS MetalChange, "
+                f"CAST({sums['Energy']} * :scale AS INTEGER) AS EnergyChange "
+                f"FROM Buildings WHERE BuildingName IN ({producers}) AND {owned} GROUP BY PlayerID) AS p "
+                f"WHERE Players.PlayerID = p.PlayerID")
+    # older SQLite has no UPDATE ... FROM, fall back to correlated sub queries
+    assignments = ", ".join(
+        f"{column} = {column} + (SELECT CAST(COALESCE({sums[column]}, 0) * :scale AS INTEGER) FROM Buildings "
+        f"WHERE Buildings.PlayerID = Players.PlayerID)" for column in RESOURCE_COLUMNS)
+    return (f"UPDATE Players SET {assignments} "
+            f"WHERE PlayerID IN (SELECT PlayerID FROM Buildings WHERE BuildingName IN ({producers}) AND {owned})")
+
+
+def apply_production(connection, scale=1.0, rates=None, shard=None):
+    """Apply `scale` production periods to every player of the shard, returns the number of players updated."""
+    cursor = connection.execute(production_statement(rates, shard), {"scale": scale})
+    return cursor.rowcount
+
+
+# Lazy accrual
+
+def ensure_accrual_columns(connection):
+    existing = {row[1] for row in connection.execute("PRAGMA table_info(Players)")}
+    for column, column_type in ACCRUAL_COLUMNS.items():
+        if column not in existing:
+            connection.execute(f"ALTER TABLE Players ADD COLUMN {column} {column_type}")
+
+
+def start_accrual(connection, now=None, rates=None, shard=None):
+    """Recompute every player's rates and start the clock for players without one."""
+    ensure_accrual_columns(connection)
+    sums = production_sums(rates or PRODUCTION_RATES)
+    owned = shard_filter(shard)
+    connection.execute(
+        "UPDATE Players SET " + ", ".join(
+            f"{rate} = (SELECT COALESCE({sums[column]}, 0) FROM Buildings WHERE Buildings.PlayerID = Players.PlayerID)"
+            for column, rate in zip(RESOURCE_COLUMNS, RATE_COLUMNS)) + f" WHERE {owned}")
+    connection.execute(f"UPDATE Players SET LastUpdated = ? WHERE LastUpdated IS NULL AND {owned}",
+                       (now or time.time(),))
+
+
+def stop_accrual(connection, now=None, shard=None):
+    """Write the accrued resources and clear the accrual clock when another economy mode takes over.
+
+    Both happen in one statement, so the time since the last write is credited once, not lost or twice.
+    """
+    ensure_accrual_columns(connection)
+    periods = f"MAX(0, CAST((:now - LastUpdated) / {PRODUCTION_PERIOD} AS INTEGER))"
+    connection.execute(
+        "UPDATE Players SET " + ", ".join(f"{column} = {column} + COALESCE({rate}, 0) * {periods}"
+                                          for column, rate in zip(RESOURCE_COLUMNS, RATE_COLUMNS)) +
+        f", LastUpdated = NULL WHERE LastUpdated IS NOT NULL AND {shard_filter(shard)}", {"now": now or time.time()})
+
+
+def accrued(row, now=None):
+    """Current (food, steel, energy) from a (Food, Metal, Energy, FoodRate, MetalRate, EnergyRate, LastUpdated) row.
+
+    Only whole production periods are credited, the rest of the time is kept for the next read.
+    """
+    food, steel, energy, food_rate, steel_rate, energy_rate, last_updated = row
+    if last_updated is None:
+        return food, steel, energy
+    periods = max(0, math.floor(((now or time.time()) - last_updated) / PRODUCTION_PERIOD))
+    return (food + (food_rate or 0) * periods, steel + (steel_rate or 0) * periods,
+            energy + (energy_rate or 0) * periods)
+
+
+def settled(row, now=None):
+    """(food, steel, energy, last_updated) to store when the accrued resources are written.
+
+    LastUpdated only moves by whole periods, so the part of a period that has not been credited yet is kept.
+    """
+    now = now or time.time()
+    food, steel, energy = accrued(row, now)
+    last_updated = row[6]
+    if last_updated is None:
+        return food, steel, energy, now
+    return food, steel, energy, last_updated + max(0, math.floor((now - last_updated) / PRODUCTION_PERIOD)) * PRODUCTION_PERIOD
+
+
+def building_rates(buildings, rates=None):
+    """(food, steel, energy) produced per period by (name, level) buildings, the Python twin of production_sums."""
+    totals = dict.fromkeys(RESOURCE_COLUMNS, 0)
+    for name, level in buildings:
+        produced = (rates or PRODUCTION_RATES).get(name)
+        if produced is not None:
+            totals[produced[0]] += level_amount(produced[1], level)
+    return tuple(totals[column] for column in RESOURCE_COLUMNS)
+
+
+def read_accrued(connection, pid, now=None):
+    row = connection.execute(
+        "SELECT Food, Metal, Energy, FoodRate, MetalRate, EnergyRate, LastUpdated FROM Players WHERE PlayerID = ?",
+        (pid,)).fetchone()
+    return accrued(row, now)
+
+
+def read_resources(connection, pids, lazy=True, now=None, chunk=500):
+    """{pid: (food, steel, energy)} for many players, computed the same way info does."""
+    pids = list(pids)
+    now = now or time.time()
+    resources = {}
+    for start in range(0, len(pids), chunk):
+        part = pids[start:start + chunk]
+        marks = ", ".join("?" * len(part))
+        if lazy:
+            rows = connection.execute(
+                "SELECT PlayerID, Food, Metal, Energy, FoodRate, MetalRate, EnergyRate, LastUpdated FROM Players "
+                f"WHERE PlayerID IN ({marks})", part)
+            for row in rows:
+                resources[row[0]] = accrued(row[1:], now)
+        else:
+            rows = connection.execute(f"SELECT PlayerID, Food, Metal, Energy FROM Players WHERE PlayerID IN ({marks})",
+                                      part)
+            for row in rows:
+                resources[row[0]] = tuple(row[1:])
+    return resources
+
+
+def settle(connection, pid, now=None, rates=None):
+    """Write the accrued resources and the player's new rates, called right after buildings or spending change."""
+    row = connection.execute(
+        "SELECT Food, Metal, Energy, FoodRate, MetalRate, EnergyRate, LastUpdated FROM Players WHERE PlayerID = ?",
+        (pid,)).fetchone()
+    food, steel, energy, last_updated = settled(row, now)
+    sums = production_sums(rates or PRODUCTION_RATES)
+    new_rates = connection.execute(
+        "SELECT " + ", ".join(f"COALESCE({sums[column]}, 0)" for column in RESOURCE_COLUMNS) +
+        " FROM Buildings WHERE PlayerID = ?", (pid,)).fetchone()
+    connection.execute(
+        "UPDATE Players SET Food = ?, Metal = ?, Energy = ?, FoodRate = ?, MetalRate = ?, EnergyRate = ?, "
+        "LastUpdated = ? WHERE PlayerID = ?", (food, steel, energy, *new_rates, last_updated, pid))
+    return food, steel, energy
+
+
+class EconomyTicker:
+    """Background thread applying production to all players every `interval` seconds."""
+
+    def __init__(self, db, interval=PRODUCTION_PERIOD, rates=None, before_tick=None, after_tick=None, shard=None,
+                 journal=None):
+        self.db = db
+        self.interval = interval
+        self.rates = rates or PRODUCTION_RATES
+        # (index, count) when several server processes share the database, each ticks only its own players
+        self.shard = shard
+        # callables run around each tick, e.g. to write a player cache out and reload it afterwards
+        self.before_tick = before_tick
+        self.after_tick = after_tick
+        # every tick is journaled as one event, see journal.py
+        self.journal = journal
+        # production periods not applied yet, ticks shorter than a period would otherwise round production away
+        self.pending_periods = 0.0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="economy-tick", daemon=True)
+        self.ticks = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def tick(self):
+        t0 = time.perf_counter()
+        self.pending_periods += self.interval / PRODUCTION_PERIOD
+        periods = int(self.pending_periods)
+        players = 0
+        if periods:
+            with self.journal.action() if self.journal is not None else nullcontext():
+                if self.before_tick is not None:
+                    self.before_tick()
+                with self.db.writer() as connection:
+                    players = apply_production(connection, periods, self.rates, self.shard)
+                if self.journal is not None:
+                    self.journal.record("tick", periods=periods, shard=self.shard)
+            self.pending_periods -= periods
+            if self.after_tick is not None:
+                self.after_tick()
+        duration = time.perf_counter() - t0
+        self.ticks += 1
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+        logs.event(log, "economy_tick", tick=self.ticks, players=players, ms=round(duration * 1000, 2))
+        return players
+
+    def stats(self):
+        return {
+            "ticks": self.ticks,
+            "last_ms": self.last_duration * 1000,
+            "max_ms": self.max_duration * 1000,
+            "mean_ms": self.total_duration * 1000 / self.ticks if self.ticks else 0.0,
+        }
+
+    def run(self):
+        # schedule against the start time so slow ticks do not make the economy drift
+        next_tick = time.monotonic() + self.interval
+        while not self.stop_event.wait(max(0.0, next_tick - time.monotonic())):
+            try:
+                self.tick()
+            except Exception as e:
+                logs.event(log, "economy_tick_failed", logging.ERROR, error=e)
+            # a late tick is caught up right away, so no production is lost
+            next_tick += self.interval
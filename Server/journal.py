@@ -0,0 +1,349 @@
+"""Append-only journal of game actions with periodic database snapshots.
+
+Every change the server makes to a player is appended to the journal as one JSON line with a sequence number and
+a timestamp. A background thread writes the queued lines and syncs the file once per batch, so the request path
+never waits on the disk and many actions share one fsync. Every snapshot_seconds the server copies the database to
+a snapshot named after the last sequence number it contains and starts a new journal segment, segments and
+snapshots older than the kept snapshots are deleted.
+
+A lost or damaged database is rebuilt from the newest snapshot and the journal written after it, or from an older
+snapshot up to a point in time, and the journal doubles as an audit trail of a player's actions:
+
+    python journal.py --dir journal --restore Leviathan.db [--until 1718000000]
+    python journal.py --dir journal --audit 42
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import economy
+import logs
+from database import UPSERT_BUILDING
+
+log = logs.get_logger("journal")
+
+SNAPSHOT_SECONDS = 600.0
+# snapshots kept for restores, with the journal needed to replay from the oldest of them
+KEEP_SNAPSHOTS = 2
+# lines written per fsync at most
+BATCH_SIZE = 1000
+
+
+def segment_path(directory, first_seq):
+    return os.path.join(directory, f"journal-{first_seq:012d}.log")
+
+
+def snapshot_path(directory, seq, created):
+    return os.path.join(directory, f"snapshot-{seq:012d}-{int(created)}.db")
+
+
+def segments(directory):
+    """[(first seq, path), ...] oldest first."""
+    found = []
+    for path in glob.glob(os.path.join(directory, "journal-*.log")):
+        found.append((int(os.path.basename(path)[8:-4]), path))
+    return sorted(found)
+
+
+def snapshots(directory):
+    """[(seq, created, path), ...] oldest first."""
+    found = []
+    for path in glob.glob(os.path.join(directory, "snapshot-*.db")):
+        seq, created = os.path.basename(path)[9:-3].split("-")
+        found.append((int(seq), int(created), path))
+    return sorted(found)
+
+
+def read_segment(path):
+    with open(path, encoding="utf-8") as journal_file:
+        for line in journal_file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # a line cut short by a crash can only be the last one
+                return
+
+
+def read_events(directory, after_seq=0, until=None):
+    """Journal events with a sequence number above after_seq, and a time up to until, in order."""
+    existing = segments(directory)
+    for index, (first_seq, path) in enumerate(existing):
+        if index + 1 < len(existing) and existing[index + 1][0] <= after_seq + 1:
+            # the whole segment is older than after_seq
+            continue
+        for entry in read_segment(path):
+            if entry["seq"] <= after_seq:
+                continue
+            if until is not None and entry["ts"] > until:
+                return
+            yield entry
+
+
+def apply(connection, entry):
+    """Redo one journaled action on a database, the same writes the server made for it."""
+    kind = entry["type"]
+    pid = entry.get("pid")
+    if kind == "add_building":
+        connection.execute(UPSERT_BUILDING, (pid, entry["building_no"], entry["building_name"], entry["level"]))
+        if entry.get("settle"):
+            economy.settle(connection, pid, now=entry["ts"])
+    elif kind == "update":
+        buildings = connection.execute("SELECT BuildingName, BuildingLevel FROM Buildings WHERE PlayerID = ?", (pid,))
+        food, steel, energy = economy.building_rates(buildings)
+        connection.execute("UPDATE Players SET Food = Food + ?, Metal = Metal + ?, Energy = Energy + ? "
+                           "WHERE PlayerID = ?", (food, steel, energy, pid))
+    elif kind == "tick":
+        economy.apply_production(connection, entry["periods"], shard=entry.get("shard"))
+    elif kind == "army":
+        connection.execute("UPDATE Players SET Defense = ? WHERE PlayerID = ?", (entry["defense"], pid))
+    elif kind == "upgrade_scheduled":
+        # the restored server finishes the job on start, like after a crash
+        connection.execute(
+            "INSERT OR IGNORE INTO BuildJobs(PlayerID, BuildingNo, BuildingName, BuildingLevel, DueAt) "
+            "VALUES(?,?,?,?,?)", (pid, entry["building_no"], entry["building_name"], entry["level"], entry["due"]))
+    elif kind == "build_finished":
+        # the add_building of the finished job comes right before it
+        connection.execute("DELETE FROM BuildJobs WHERE PlayerID = ? AND BuildingNo = ?", (pid, entry["building_no"]))
+    else:
+        logs.event(log, "unknown_journal_entry", logging.WARNING, seq=entry["seq"], type=kind)
+
+
+def restore(directory, db_path, until=None):
+    """Rebuild db_path from the newest snapshot taken up to until and the journal after it, returns events replayed."""
+    candidates = [snapshot for snapshot in snapshots(directory) if until is None or snapshot[1] <= until]
+    if not candidates:
+        raise FileNotFoundError(f"No snapshot in {directory} to restore from")
+    seq, created, path = candidates[-1]
+    shutil.copyfile(path, db_path)
+    connection = sqlite3.connect(db_path)
+    replayed = 0
+    try:
+        with connection:
+            for entry in read_events(directory, seq, until):
+                apply(connection, entry)
+                replayed += 1
+    finally:
+        connection.close()
+    logs.event(log, "restored", snapshot=path, replayed=replayed)
+    return replayed
+
+
+class Journal:
+    def __init__(self, directory, db, keep_snapshots=KEEP_SNAPSHOTS):
+        self.directory = directory
+        self.db = db
+        self.keep_snapshots = keep_snapshots
+        os.makedirs(directory, exist_ok=True)
+        self.seq = self.last_seq()
+        # held around applying an action and journaling it, so a snapshot never sees one without the other
+        self.lock = threading.RLock()
+        # JSON lines, or callables the writer runs once the lines before them are written
+        self.records = queue.Queue()
+        self.file = None
+        self.writer = threading.Thread(target=self.write_loop, name="journal-writer", daemon=True)
+        self.written = 0
+        self.batches = 0
+        self.snapshots_taken = 0
+
+    def last_seq(self):
+        """Sequence number of the last event on disk, or of the newest snapshot when the journal is empty."""
+        seq = max([snapshot[0] for snapshot in snapshots(self.directory)] or [0])
+        existing = segments(self.directory)
+        if existing:
+            for entry in read_segment(existing[-1][1]):
+                seq = max(seq, entry["seq"])
+        return seq
+
+    def start(self):
+        self.file = open(segment_path(self.directory, self.seq + 1), "a", encoding="utf-8")
+        self.writer.start()
+
+    def stop(self):
+        self.records.put(None)
+        if self.writer.is_alive():
+            self.writer.join()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    @contextmanager
+    def action(self):
+        # the writer connection first, a batch of commands already holds it when its actions get here
+        with self.db.writer(), self.lock:
+            yield
+
+    def record(self, kind, **fields):
+        """Append one event, call it inside action() right after the change it describes."""
+        with self.lock:
+            self.seq += 1
+            entry = {"seq": self.seq, "ts": time.time(), "type": kind}
+            entry.update(fields)
+            self.records.put(json.dumps(entry))
+        return entry["seq"]
+
+    def write_lines(self, lines):
+        if not lines:
+            return
+        try:
+            self.file.write("\n".join(lines) + "\n")
+            self.file.flush()
+            # one sync for the whole batch instead of one per action
+            os.fsync(self.file.fileno())
+        except Exception as e:
+            logs.event(log, "journal_write_failed", logging.ERROR, lines=len(lines), error=e)
+            return
+        self.written += len(lines)
+        self.batches += 1
+
+    def write_loop(self):
+        while True:
+            items = [self.records.get()]
+            while len(items) < BATCH_SIZE:
+                try:
+                    items.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for item in items:
+                if isinstance(item, str):
+                    lines.append(item)
+                    continue
+                # the lines queued before a marker go out first
+                self.write_lines(lines)
+                lines = []
+                if item is None:
+                    return
+                item()
+            self.write_lines(lines)
+
+    def run_in_writer(self, work=None):
+        """Wait until everything recorded so far is written, then run work on the writer thread."""
+        if not self.writer.is_alive():
+            if work is not None:
+                work()
+            return
+        done = threading.Event()
+
+        def marker():
+            if work is not None:
+                work()
+            done.set()
+
+        self.records.put(marker)
+        done.wait()
+
+    def flush(self):
+        """Wait until everything recorded so far is on disk."""
+        self.run_in_writer()
+
+    def snapshot(self, before=None):
+        """Copy the database together with the sequence number it is current to, returns the snapshot path.
+
+        before() runs first, for example to write the player cache out. No action runs while the copy is taken.
+        Returns None when nothing happened since the last snapshot.
+        """
+        with self.action():
+            seq = self.seq
+            existing = snapshots(self.directory)
+            if existing and existing[-1][0] == seq:
+                return None
+            if before is not None:
+                before()
+            created = time.time()
+            path = snapshot_path(self.directory, seq, created)
+            target = sqlite3.connect(path + ".tmp")
+            try:
+                with self.db.writer() as connection:
+                    connection.backup(target)
+            finally:
+                target.close()
+            os.replace(path + ".tmp", path)
+            # later events go to a new segment, so whole segments can be dropped once no snapshot needs them
+            self.run_in_writer(lambda: self.rotate(seq + 1))
+        self.snapshots_taken += 1
+        self.compact()
+        logs.event(log, "snapshot", seq=seq, path=path)
+        return path
+
+    def rotate(self, first_seq):
+        old = self.file
+        self.file = open(segment_path(self.directory, first_seq), "a", encoding="utf-8")
+        if old is not None:
+            old.close()
+
+    def compact(self):
+        """Delete snapshots beyond the kept ones and the segments only those needed."""
+        kept = snapshots(self.directory)[-self.keep_snapshots:]
+        for seq, created, path in snapshots(self.directory)[:-self.keep_snapshots]:
+            os.remove(path)
+        if not kept:
+            return
+        oldest = kept[0][0]
+        existing = segments(self.directory)
+        for (first_seq, path), following in zip(existing, existing[1:]):
+            # every event of this segment is older than the oldest snapshot kept
+            if following[0] <= oldest + 1:
+                os.remove(path)
+
+    def stats(self):
+        return {"seq": self.seq, "written": self.written, "batches": self.batches,
+                "snapshots": self.snapshots_taken}
+
+
+class SnapshotTimer:
+    """Background thread taking a journal snapshot every interval seconds."""
+
+    def __init__(self, take, interval):
+        self.take = take
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="journal-snapshot", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.take()
+            except Exception as e:
+                logs.event(log, "snapshot_failed", logging.ERROR, error=e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Restore Leviathan.db from the journal or read a player's actions")
+    parser.add_argument("--dir", default="journal", help="directory of the journal and snapshots")
+    parser.add_argument("--restore", metavar="DB", help="rebuild this database from the snapshot and journal")
+    parser.add_argument("--until", type=float, default=None, help="replay only events up to this unix time")
+    parser.add_argument("--force", action="store_true", help="overwrite an existing database when restoring")
+    parser.add_argument("--audit", type=int, metavar="PID", help="print the journaled actions of a player")
+    args = parser.parse_args()
+    logs.setup()
+    try:
+        if args.restore:
+            if os.path.exists(args.restore) and not args.force:
+                parser.error(f"{args.restore} exists, pass --force to overwrite it")
+            print(f"Replayed {restore(args.dir, args.restore, args.until)} events")
+        if args.audit is not None:
+            for entry in read_events(args.dir, until=args.until):
+                if entry.get("pid") == args.audit:
+                    print(json.dumps(entry))
+    finally:
+        logs.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""Player ranking kept up to date while the server runs.
+
+The score of a player is its resources, its building levels and the defense of its army. Scores are held in an
+indexable skip list ordered by (-score, PlayerID), so a changed score is moved, the top of the board is read and
+the rank of a player is found in O(log n) without looking at the other players. The board is loaded from the
+database once when the server starts, after that only the players whose state the server changes are updated.
+
+The server moves a player when buildings are written, production is applied for it, it reads its resources or
+reports its army. What changes without that, production of players nobody reads and the players of the other
+workers of a sharded server, is read again for every player after each economy tick, or every REFRESH_SECONDS in
+the other economy modes.
+"""
+import logging
+import random
+import threading
+
+import economy
+import logs
+
+log = logs.get_logger("leaderboard")
+
+# score of a building level and of a point of army defense, resources count 1 each
+LEVEL_POINTS = 100
+DEFENSE_POINTS = 1
+# rows of a leaderboard page at most, clients page through the rest
+PAGE_LIMIT = 50
+# enough levels for 2**24 players before the list gets slower
+MAX_LEVELS = 24
+# seconds between two full reads of the scores when no economy tick triggers them
+REFRESH_SECONDS = 60.0
+
+
+def ensure_defense_column(connection):
+    existing = {row[1] for row in connection.execute("PRAGMA table_info(Players)")}
+    if "Defense" not in existing:
+        connection.execute("ALTER TABLE Players ADD COLUMN Defense INTEGER")
+
+
+def score(resources, levels, defense):
+    return resources + levels * LEVEL_POINTS + defense * DEFENSE_POINTS
+
+
+class Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        # positions skipped by following next on each level, the head is position 0
+        self.width = [1] * levels
+
+
+class RankedIndex:
+    """Indexable skip list of unique, sortable keys."""
+
+    def __init__(self, max_levels=MAX_LEVELS, rng=None):
+        self.max_levels = max_levels
+        self.rng = rng or random.Random()
+        self.head = Node(None, max_levels)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def random_levels(self):
+        levels = 1
+        while levels < self.max_levels and self.rng.random() < 0.5:
+            levels += 1
+        return levels
+
+    def build(self, keys):
+        """Replace the contents with the already sorted keys in O(n)."""
+        self.head = Node(None, self.max_levels)
+        last = [self.head] * self.max_levels
+        positions = [0] * self.max_levels
+        position = 0
+        for position, key in enumerate(keys, start=1):
+            node = Node(key, self.random_levels())
+            for level in range(len(node.next)):
+                last[level].next[level] = node
+                last[level].width[level] = position - positions[level]
+                last[level] = node
+                positions[level] = position
+        self.size = position
+        # the last node of each level reaches past the end, like the head of an empty list
+        for level in range(self.max_levels):
+            last[level].width[level] = self.size + 1 - positions[level]
+
+    def insert(self, key):
+        chain = [None] * self.max_levels
+        steps_at_level = [0] * self.max_levels
+        node = self.head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level] is not None and node.next[level].key <= key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        new_node = Node(key, self.random_levels())
+        steps = 0
+        for level in range(len(new_node.next)):
+            previous = chain[level]
+            new_node.next[level] = previous.next[level]
+            previous.next[level] = new_node
+            new_node.width[level] = previous.width[level] - steps
+            previous.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(len(new_node.next), self.max_levels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain = [None] * self.max_levels
+        node = self.head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level] is not None and node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        found = chain[0].next[0]
+        if found is None or found.key != key:
+            raise KeyError(key)
+        for level in range(len(found.next)):
+            previous = chain[level]
+            previous.width[level] += found.width[level] - 1
+            previous.next[level] = found.next[level]
+        for level in range(len(found.next), self.max_levels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, key):
+        """Number of keys smaller than key, the 0 based position of key when it is in the list."""
+        position = 0
+        node = self.head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        return position
+
+    def slice(self, start, count):
+        """count keys from the 0 based position start on."""
+        keys = []
+        if start < 0 or start >= self.size:
+            return keys
+        remaining = start + 1
+        node = self.head
+        for level in reversed(range(self.max_levels)):
+            while node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        while node is not None and len(keys) < count:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+class Entry:
+    __slots__ = ("name", "resources", "levels", "defense")
+
+    def __init__(self, name, resources=0, levels=0, defense=0):
+        self.name = name
+        self.resources = resources
+        self.levels = levels
+        self.defense = defense
+
+    @property
+    def score(self):
+        return score(self.resources, self.levels, self.defense)
+
+
+class Leaderboard:
+    def __init__(self, lazy=True):
+        # lazy accrual stores rates instead of amounts, the resources are computed like info does
+        self.lazy = lazy
+        self.entries = {}
+        self.index = RankedIndex()
+        self.lock = threading.Lock()
+        # single players are only added to a loaded board, before that the ranks would be meaningless
+        self.loaded = False
+        self.updates = 0
+
+    def player_rows(self, connection, where="1", parameters=()):
+        rows = connection.execute(
+            "SELECT PlayerID, PName, Food, Metal, Energy, FoodRate, MetalRate, EnergyRate, LastUpdated, "
+            "COALESCE(Defense, 0), (SELECT COALESCE(SUM(BuildingLevel), 0) FROM Buildings "
+            f"WHERE Buildings.PlayerID = Players.PlayerID) FROM Players WHERE {where}", parameters)
+        for row in rows:
+            amounts = tuple(value or 0 for value in row[2:5])
+            if self.lazy:
+                amounts = economy.accrued((*amounts, *row[5:9]))
+            yield row[0], Entry(row[1], sum(amounts), row[10], row[9])
+
+    def load(self, connection):
+        """Read every player once, returns how many are ranked."""
+        entries = dict(self.player_rows(connection))
+        keys = sorted((-entry.score, pid) for pid, entry in entries.items())
+        with self.lock:
+            self.entries = entries
+            self.index.build(keys)
+            self.loaded = True
+        return len(keys)
+
+    def add_player(self, connection, pid):
+        """Rank a player created after the board was loaded."""
+        if not self.loaded:
+            return
+        for pid, entry in self.player_rows(connection, "PlayerID = ?", (pid,)):
+            with self.lock:
+                if pid not in self.entries:
+                    self.entries[pid] = entry
+                    self.index.insert((-entry.score, pid))
+
+    def refresh(self, connection):
+        """Read every player's score again, returns how many moved."""
+        if not self.loaded:
+            return 0
+        moves = self.updates
+        for pid, entry in list(self.player_rows(connection)):
+            if not self.update(pid, entry.resources, entry.levels, entry.defense):
+                # created by another worker
+                with self.lock:
+                    if pid not in self.entries:
+                        self.entries[pid] = entry
+                        self.index.insert((-entry.score, pid))
+                        self.updates += 1
+        return self.updates - moves
+
+    def update(self, pid, resources=None, levels=None, defense=None):
+        """Change the parts of a player's score that are given, returns False for players not on the board."""
+        with self.lock:
+            entry = self.entries.get(pid)
+            if entry is None:
+                return False
+            old_key = (-entry.score, pid)
+            if resources is not None:
+                entry.resources = resources
+            if levels is not None:
+                entry.levels = levels
+            if defense is not None:
+                entry.defense = defense
+            new_key = (-entry.score, pid)
+            # most reads find the same score, nothing to move then
+            if new_key != old_key:
+                self.index.remove(old_key)
+                self.index.insert(new_key)
+                self.updates += 1
+            return True
+
+    def page(self, start, count):
+        """[(rank, name, score), ...] from the 1 based rank start on, at most PAGE_LIMIT rows."""
+        start = max(1, start)
+        with self.lock:
+            keys = self.index.slice(start - 1, min(count, PAGE_LIMIT))
+            return [(start + offset, self.entries[pid].name, -negative_score)
+                    for offset, (negative_score, pid) in enumerate(keys)]
+
+    def rank(self, pid):
+        """(1 based rank, score) of a player or None."""
+        with self.lock:
+            entry = self.entries.get(pid)
+            if entry is None:
+                return None
+            return self.index.rank((-entry.score, pid)) + 1, entry.score
+
+    def __len__(self):
+        return len(self.index)
+
+
+class RefreshTimer:
+    """Background thread calling refresh every interval seconds."""
+
+    def __init__(self, refresh, interval=REFRESH_SECONDS):
+        self.refresh = refresh
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="leaderboard-refresh", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                logs.event(log, "leaderboard_refresh_failed", logging.ERROR, error=e)
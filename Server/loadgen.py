@@ -0,0 +1,242 @@
+"""Load generator speaking the real wire protocol.
+
+Simulated players log in and then send info, update and add_building at the configured rates per player, and
+reconnect with their session token if asked to.
+Commands without a reply are sent as a batch of one, so every request gets an answer and a latency.
+
+With --spawn a server is started on a throwaway database filled with synthetic players, so a run needs
+nothing but this checkout:
+
+    python loadgen.py --spawn --clients 2000 --duration 30
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import migrations
+import protocol
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+BUILDINGS = ["plantation", "powerplant", "abyssalorerefinery", "cabins", "barracks", "defensivedome"]
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+class LoadStats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def record(self, command, seconds):
+        self.latencies.setdefault(command, []).append(seconds)
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        requests = sum(len(values) for values in self.latencies.values())
+        errors = sum(self.errors.values())
+        lines = [f"{requests} requests in {elapsed:.1f} s, {requests / elapsed:.1f} requests/s, "
+                 f"{errors} errors ({errors / max(1, requests + errors) * 100:.2f} %)"]
+        for command, values in sorted(self.latencies.items()):
+            values.sort()
+            lines.append(f"  {command:<14} {len(values):>8}  p50 {percentile(values, 0.5) * 1000:8.2f} ms  "
+                         f"p99 {percentile(values, 0.99) * 1000:8.2f} ms  max {values[-1] * 1000:8.2f} ms")
+        for kind, count in sorted(self.errors.items()):
+            lines.append(f"  error {kind}: {count}")
+        return "\n".join(lines)
+
+
+async def request(reader, writer, payload, msg_type=protocol.MSG_TEXT, timeout=10.0):
+    writer.write(protocol.encode_frame(payload, msg_type))
+    await writer.drain()
+    while True:
+        frame = await asyncio.wait_for(protocol.read_frame(reader), timeout)
+        if frame is None:
+            raise ConnectionAbortedError("Connection closed by server")
+        # a subscribed player would also get pushes, they are not replies
+        if frame[0] != protocol.MSG_PUSH:
+            return frame
+
+
+async def timed(stats, command, reader, writer, text):
+    """Send one command and record its latency, returns the reply text or None on an error."""
+    t0 = time.perf_counter()
+    if command in ("add_building", "update"):
+        msg_type, payload = await request(reader, writer, protocol.encode_batch([text]), protocol.MSG_BATCH)
+        reply = protocol.decode_batch(payload)[0]
+        if reply.startswith("error"):
+            stats.error(command)
+            return None
+    else:
+        msg_type, payload = await request(reader, writer, text)
+        reply = payload.decode("utf-8")
+    stats.record(command, time.perf_counter() - t0)
+    return reply
+
+
+async def simulated_player(stats, host, port, name, password, rates, deadline, seed):
+    rng = random.Random(seed)
+    commands = [command for command, rate in rates.items() if rate > 0]
+    total_rate = sum(rates.values())
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        stats.error("connect")
+        return
+    try:
+        reply = await timed(stats, "login", reader, writer, f"login {name} {password}")
+        if reply == "busy":
+            # turned away by the connection limit
+            stats.error("busy")
+            return
+        if reply is None or reply.split(" ")[0] != "accepted":
+            stats.error("login")
+            return
+        token = reply.split(" ")[1] if len(reply.split(" ")) > 1 else ""
+        while commands:
+            # exponential gaps give Poisson arrivals, so players do not fire in lock step
+            wait = rng.expovariate(total_rate)
+            if time.perf_counter() + wait > deadline:
+                break
+            await asyncio.sleep(wait)
+            command = rng.choices(commands, weights=[rates[command] for command in commands])[0]
+            if command == "reconnect":
+                # drop the connection and come back with the session token, like a client after a server blip
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port)
+                if await timed(stats, "resume", reader, writer, f"resume {token}") != "accepted":
+                    stats.error("resume")
+                    return
+                continue
+            if command == "add_building":
+                text = f"add_building {rng.randrange(19)} {rng.choice(BUILDINGS)} {rng.randint(1, 3)}"
+            else:
+                text = command
+            await timed(stats, command, reader, writer, text)
+    except (OSError, asyncio.TimeoutError, protocol.ProtocolError) as e:
+        stats.error(type(e).__name__)
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, clients, duration, rates, first_player=1, prefix="player", password="password",
+                   ramp_seconds=1.0, seed=0):
+    """Run clients simulated players for duration seconds and return their LoadStats."""
+    stats = LoadStats()
+    deadline = time.perf_counter() + ramp_seconds + duration
+    tasks = []
+    for number in range(clients):
+        name = f"{prefix}{first_player + number}"
+        tasks.append(asyncio.create_task(
+            simulated_player(stats, host, port, name, password, rates, deadline, seed + number)))
+        # spread the logins so the connect storm does not dominate the numbers
+        if ramp_seconds:
+            await asyncio.sleep(ramp_seconds / clients)
+    await asyncio.gather(*tasks)
+    stats.finished = time.perf_counter()
+    return stats
+
+
+def make_database(path, players):
+    connection = sqlite3.connect(path)
+    try:
+        migrations.migrate(connection)
+        first = migrations.generate_fixture(connection, players, buildings_per_player=6)
+        connection.commit()
+    finally:
+        connection.close()
+    return first
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(host, port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server did not start listening on {host}:{port}")
+
+
+def spawn_server(db_path, port, server_args):
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT, "--port", str(port), "--db", db_path, *server_args],
+                               cwd=os.path.dirname(SERVER_SCRIPT), stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port("127.0.0.1", port)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated players against a Leviathans legacy server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load after the ramp up")
+    parser.add_argument("--ramp-seconds", type=float, default=1.0, help="time over which the clients connect")
+    parser.add_argument("--info-rate", type=float, default=0.2, help="info requests per player per second")
+    parser.add_argument("--update-rate", type=float, default=0.2, help="update requests per player per second")
+    parser.add_argument("--build-rate", type=float, default=0.02, help="add_building per player per second")
+    parser.add_argument("--buildings-rate", type=float, default=0.0, help="info_buildings per player per second")
+    parser.add_argument("--reconnect-rate", type=float, default=0.0,
+                        help="reconnects with resume <token> per player per second")
+    parser.add_argument("--prefix", default="player", help="players are named <prefix><number>")
+    parser.add_argument("--first-player", type=int, default=1)
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--spawn", action="store_true",
+                        help="start a server on a throwaway database with a synthetic player per client")
+    parser.add_argument("--server-args", default="", help="extra arguments for the spawned server")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rates = {"info": args.info_rate, "update": args.update_rate, "add_building": args.build_rate,
+             "info_buildings": args.buildings_rate, "reconnect": args.reconnect_rate}
+    process = None
+    directory = None
+    host, port, first_player = args.host, args.port, args.first_player
+    try:
+        if args.spawn:
+            directory = tempfile.TemporaryDirectory()
+            db_path = os.path.join(directory.name, "Leviathan.db")
+            first_player = make_database(db_path, args.clients)
+            host, port = "127.0.0.1", free_port()
+            process = spawn_server(db_path, port, args.server_args.split())
+            print(f"Spawned server on port {port} with {args.clients} players")
+        stats = asyncio.run(run_load(host, port, args.clients, args.duration, rates, first_player, args.prefix,
+                                     args.password, args.ramp_seconds, args.seed))
+        print(stats.report())
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if directory is not None:
+            directory.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Structured server logging, written by a background thread.
+
+Server code logs named events with fields:
+
+    logs.event(log, "cache_flush", players=3, ms=0.41)
+
+The handler on the request path only puts the record on a bounded queue, a QueueListener thread formats and
+writes it, so a request never waits on the terminal or the disk. When the queue is full records are dropped and
+counted instead of blocking. High volume events can be sampled, `command=100` keeps 1 in 100 command events, and
+the output is either plain `key=value` text or one JSON object per line.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+ROOT = "leviathan"
+QUEUE_SIZE = 10000
+# one command event per request would flood the log, keep 1 in 100 unless configured otherwise
+DEFAULT_SAMPLES = {"command": 100}
+
+listener = None
+handler = None
+
+
+def get_logger(name):
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+def event(logger, name, level=logging.INFO, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, name, extra={"event": name, "fields": fields})
+
+
+def parse_samples(text):
+    """{"command": 100} from "command=100", several events are separated by commas."""
+    samples = {}
+    for part in filter(None, text.split(",")):
+        name, _, every = part.partition("=")
+        samples[name.strip()] = int(every)
+    return samples
+
+
+class SampleFilter(logging.Filter):
+    """Keep 1 in N records of the sampled events, warnings and errors always pass."""
+
+    def __init__(self, samples):
+        super().__init__()
+        self.samples = samples
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        every = self.samples.get(getattr(record, "event", None), 1)
+        if every <= 1 or record.levelno >= logging.WARNING:
+            return True
+        with self.lock:
+            count = self.counts.get(record.event, 0) + 1
+            self.counts[record.event] = count
+        if count % every:
+            return False
+        # each kept record stands for this many events
+        record.sampled = every
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = f"{self.formatTime(record)} {record.levelname} {record.name} {record.getMessage()}"
+        fields = getattr(record, "fields", None)
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if getattr(record, "sampled", None):
+            text += f" sampled=1/{record.sampled}"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": record.created, "level": record.levelname, "logger": record.name,
+                 "message": record.getMessage(), "process": record.process}
+        entry.update(getattr(record, "fields", None) or {})
+        if getattr(record, "sampled", None):
+            entry["sampled"] = record.sampled
+        return json.dumps(entry, default=str)
+
+
+def setup(level="INFO", json_output=False, path=None, samples=None):
+    """Send the server loggers through a queue to stdout or path, returns the queue handler."""
+    global listener, handler
+    shutdown()
+    target = logging.FileHandler(path) if path else logging.StreamHandler(sys.stdout)
+    target.setFormatter(JsonFormatter() if json_output else TextFormatter())
+    handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+    handler.addFilter(SampleFilter(DEFAULT_SAMPLES if samples is None else samples))
+    root = logging.getLogger(ROOT)
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    root.propagate = False
+    listener = logging.handlers.QueueListener(handler.queue, target)
+    listener.start()
+    return handler
+
+
+def shutdown():
+    """Write out the queued records and stop the writer thread."""
+    global listener
+    if listener is not None:
+        listener.stop()
+        for target in listener.handlers:
+            target.close()
+        listener = None
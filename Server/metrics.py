@@ -0,0 +1,182 @@
+"""Server metrics in the Prometheus text format.
+
+The server records into a Registry of counters, gauges and histograms, and serve() exposes it over HTTP at
+/metrics for a local scraper or a plain curl. Stats owned by other components, like the economy tick or the
+player cache, are pulled in by collectors when the metrics are rendered.
+"""
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import logs
+
+log = logs.get_logger("metrics")
+
+# seconds, from half a millisecond up, the tail of a loaded server lands in the upper buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def label_text(labels):
+    if not labels:
+        return ""
+    pairs = ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                     for name, value in labels)
+    return "{" + pairs + "}"
+
+
+def number_text(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+        # one value per label combination, keyed by a sorted tuple of (label, value) pairs
+        self.values = {}
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self):
+        with self.lock:
+            values = list(self.values.items())
+        return self.header() + [f"{self.name}{label_text(labels)} {number_text(value)}" for labels, value in values]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = HistogramValue(self.buckets)
+            # only the first matching bucket is counted here, render makes the counts cumulative
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram.counts[index] += 1
+                    break
+            histogram.count += 1
+            histogram.sum += value
+
+    def count(self, **labels):
+        histogram = self.values.get(tuple(sorted(labels.items())))
+        return histogram.count if histogram is not None else 0
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            for labels, histogram in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{label_text(labels + (('le', number_text(bound)),))} {cumulative}")
+                lines.append(f"{self.name}_bucket{label_text(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{self.name}_sum{label_text(labels)} {number_text(histogram.sum)}")
+                lines.append(f"{self.name}_count{label_text(labels)} {histogram.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # callables returning [(name, help, kind, value), ...] read when the metrics are rendered
+        self.collectors = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self.add(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self.add(Gauge(name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help_text, buckets))
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            try:
+                samples = collector()
+            except Exception as e:
+                logs.event(log, "collect_failed", logging.ERROR, error=e)
+                continue
+            for name, help_text, kind, value in samples:
+                lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {number_text(value)}"])
+        return "\n".join(lines) + "\n"
+
+
+def serve(registry, host="127.0.0.1", port=9100):
+    """Serve the registry at http://host:port/metrics from a daemon thread, returns the HTTP server."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes every few seconds would flood the server output
+            pass
+
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, name="metrics-http", daemon=True).start()
+    logs.event(log, "metrics_listening", url=f"http://{host}:{http_server.server_address[1]}/metrics")
+    return http_server
@@ -0,0 +1,180 @@
+"""Versioned schema migrations for Leviathan.db.
+
+The schema version is kept in PRAGMA user_version. Each migration brings the database from the version before it
+to its own, so a new file gets the whole schema and an existing one only the steps it is missing. Migrations
+check what is already there before changing it, databases made before the runner existed upgrade cleanly.
+
+Run directly to migrate a database, fill it with synthetic players or look at the plans of the hot queries:
+
+    python migrations.py --db Leviathan.db --fixture-players 1000000 --explain
+"""
+import argparse
+import random
+import sqlite3
+import time
+
+import database
+import economy
+import leaderboard
+import logs
+import scheduler
+
+log = logs.get_logger("migrations")
+
+# the schema of the original Leviathan.db
+CREATE_PLAYERS = """
+CREATE TABLE IF NOT EXISTS "Players" (
+    "PlayerID"  INTEGER NOT NULL UNIQUE,
+    "PName" TEXT NOT NULL UNIQUE,
+    "PPass" TEXT NOT NULL,
+    "Food"  INTEGER,
+    "Metal" INTEGER,
+    "Energy"    INTEGER,
+    PRIMARY KEY("PlayerID")
+)"""
+CREATE_BUILDINGS = """
+CREATE TABLE IF NOT EXISTS "Buildings" (
+    "PlayerID"  INTEGER NOT NULL,
+    "BuildingNo"    INTEGER,
+    "BuildingName"  TEXT,
+    "BuildingLevel" INTEGER
+)"""
+
+# the queries run for every client, checked by explain()
+HOT_QUERIES = {
+    "login": ("SELECT * FROM Players WHERE PName = ?", ("player1",)),
+    "resources": ("SELECT Food, Metal, Energy, FoodRate, MetalRate, EnergyRate, LastUpdated FROM Players "
+                  "WHERE PlayerID = ?", (1,)),
+    "buildings": ("SELECT * FROM Buildings WHERE PlayerID = ?", (1,)),
+}
+
+FIXTURE_BUILDINGS = ["plantation", "powerplant", "abyssalorerefinery", "cabins", "barracks", "defensivedome"]
+
+
+def leading_column_indexed(connection, table, column):
+    """True if some index on table starts with column, so lookups by it do not scan the table."""
+    for index in connection.execute(f"PRAGMA index_list({table})").fetchall():
+        columns = connection.execute(f"PRAGMA index_info('{index[1]}')").fetchall()
+        if columns and columns[0][2] == column:
+            return True
+    return False
+
+
+def create_schema(connection):
+    connection.execute(CREATE_PLAYERS)
+    connection.execute(CREATE_BUILDINGS)
+
+
+def unique_buildings(connection):
+    database.ensure_unique_buildings(connection)
+
+
+def lookup_indexes(connection):
+    # PName is UNIQUE and (PlayerID, BuildingNo) has the unique index, both already serve as lookup indexes.
+    # Only create the plain ones where no index starts with the column, a second one would just slow writes.
+    if not leading_column_indexed(connection, "Players", "PName"):
+        connection.execute("CREATE INDEX IF NOT EXISTS PlayersName ON Players(PName)")
+    if not leading_column_indexed(connection, "Buildings", "PlayerID"):
+        connection.execute("CREATE INDEX IF NOT EXISTS BuildingsPlayer ON Buildings(PlayerID)")
+
+
+def accrual_columns(connection):
+    economy.ensure_accrual_columns(connection)
+
+
+def build_jobs(connection):
+    scheduler.create_table(connection)
+
+
+def army_defense(connection):
+    leaderboard.ensure_defense_column(connection)
+
+
+# position + 1 is the schema version after the migration ran, only ever append to this list
+MIGRATIONS = [
+    create_schema,
+    unique_buildings,
+    lookup_indexes,
+    accrual_columns,
+    build_jobs,
+    army_defense,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(connection):
+    """Apply the missing migrations, returns the number applied."""
+    version = schema_version(connection)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than this server ({SCHEMA_VERSION})")
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(connection)
+        connection.execute(f"PRAGMA user_version = {number}")
+        logs.event(log, "migrated", version=number, migration=migration.__name__)
+    return SCHEMA_VERSION - version
+
+
+def generate_fixture(connection, players, buildings_per_player=6, seed=0, chunk=10000):
+    """Insert synthetic players named player<id> with random resources and buildings, returns the first new id."""
+    rng = random.Random(seed)
+    first = (connection.execute("SELECT MAX(PlayerID) FROM Players").fetchone()[0] or 0) + 1
+    for start in range(first, first + players, chunk):
+        ids = range(start, min(start + chunk, first + players))
+        connection.executemany(
+            "INSERT INTO Players(PlayerID, PName, PPass, Food, Metal, Energy) VALUES(?,?,?,?,?,?)",
+            ((pid, f"player{pid}", "password", rng.randrange(10000), rng.randrange(10000), rng.randrange(10000))
+             for pid in ids))
+        connection.executemany(
+            "INSERT INTO Buildings(PlayerID, BuildingNo, BuildingName, BuildingLevel) VALUES(?,?,?,?)",
+            ((pid, no, rng.choice(FIXTURE_BUILDINGS), rng.randint(1, 3))
+             for pid in ids for no in range(buildings_per_player)))
+    return first
+
+
+def explain(connection, queries=None):
+    """{query name: [plan detail, ...]} from EXPLAIN QUERY PLAN for each hot query."""
+    plans = {}
+    for name, (sql, parameters) in (queries or HOT_QUERIES).items():
+        plans[name] = [row[3] for row in connection.execute("EXPLAIN QUERY PLAN " + sql, parameters)]
+    return plans
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate Leviathan.db and check its query plans")
+    parser.add_argument("--db", default="Leviathan.db", help="path of the SQLite database")
+    parser.add_argument("--fixture-players", type=int, default=0, help="synthetic players to add")
+    parser.add_argument("--fixture-buildings", type=int, default=6, help="buildings per synthetic player")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--explain", action="store_true", help="print the plan and timing of the hot queries")
+    args = parser.parse_args()
+    logs.setup()
+    db = database.ConnectionManager(lambda: sqlite3.connect(args.db, check_same_thread=False), readers=1)
+    try:
+        with db.writer() as connection:
+            migrate(connection)
+        if args.fixture_players:
+            t0 = time.perf_counter()
+            with db.writer() as connection:
+                generate_fixture(connection, args.fixture_players, args.fixture_buildings, args.seed)
+                economy.start_accrual(connection)
+            print(f"Added {args.fixture_players} players in {time.perf_counter() - t0:.2f} s")
+        if args.explain:
+            with db.reader() as connection:
+                for name, details in explain(connection).items():
+                    sql, parameters = HOT_QUERIES[name]
+                    t0 = time.perf_counter()
+                    connection.execute(sql, parameters).fetchall()
+                    print(f"{name} ({(time.perf_counter() - t0) * 1000:.3f} ms):")
+                    for detail in details:
+                        print(f"    {detail}")
+    finally:
+        db.close()
+        logs.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+"""Framed wire protocol shared by the server and the game client.
+
+Every message is a header holding the payload length and the message type, followed by the payload.
+Reads are buffered, so several messages arriving in one TCP segment are split apart again and a message
+spread over several segments is only handed out once it is complete.
+
+A client that logs in with `login <name> <password> binary` (or resumes with `resume <token> binary`) and is
+answered `accepted ... binary` gets the replies listed in REPLY_SCHEMAS as MSG_BINARY frames: typed fields packed
+with struct after a schema id and a row count, instead of text with ", " and "^^" separators. Everyone else, and
+every batch and push, keeps the text replies.
+
+Adding `zlib` or `zlib-dict` to the login the same way has the server compress its messages from
+COMPRESS_THRESHOLD bytes on, zlib-dict starts every message from SHARED_DICTIONARY so repeated building and player
+words are short even in small replies. A compressed frame has the COMPRESSED bit set in its message type and
+FrameReader hands it out decompressed, so the rest of the code never sees the difference.
+"""
+import asyncio
+import select
+import struct
+import threading
+import time
+import zlib
+
+# payload length (unsigned int) and message type (unsigned byte), network byte order
+HEADER = struct.Struct("!IB")
+MAX_PAYLOAD = 16 * 1024 * 1024
+RECV_SIZE = 65536
+
+# Message types
+MSG_TEXT = 1
+# sent by the server on its own, not as the answer to a request
+MSG_PUSH = 2
+# several requests in one message, answered by one message holding a status and reply per request
+MSG_BATCH = 3
+# a reply packed with one of the REPLY_SCHEMAS
+MSG_BINARY = 4
+
+# encodings a client can ask for at login, text is what every client understands
+TEXT = "text"
+BINARY = "binary"
+ENCODINGS = (TEXT, BINARY)
+
+# command -> (schema id, header fields, fields of each row)
+# largest value of an H field, the server rejects hexagon numbers and levels above it
+MAX_UINT16 = 0xFFFF
+# H 16 bit unsigned int, i 32 bit int, q 64 bit int, d double, s utf-8 string of up to 65535 bytes
+REPLY_SCHEMAS = {
+    "info": (1, "qqq", ""),
+    # pid, hexagon no, building name, level
+    "info_buildings": (2, "", "iHsH"),
+    # mode (full, delta, unchanged or rejected), epoch, version
+    "buildings_since": (3, "sqq", "iHsH"),
+    # hexagon no, building name, level, seconds left
+    "build_jobs": (4, "", "HsHd"),
+    "leaderboard": (5, "", "isq"),
+    "map_chunk": (6, "", "isii"),
+    "map_near": (6, "", "isii"),
+}
+REPLY_COUNT = struct.Struct("!BI")
+STRING_LENGTH = struct.Struct("!H")
+
+# compression a client can ask for at login
+ZLIB = "zlib"
+ZLIB_DICTIONARY = "zlib-dict"
+COMPRESSIONS = (ZLIB, ZLIB_DICTIONARY)
+# bits of the message type byte of a compressed frame, the low bits keep the message type
+COMPRESSED = 0x80
+WITH_DICTIONARY = 0x40
+TYPE_MASK = 0x3F
+# smaller payloads are sent as they are, the zlib header and the CPU time are not worth it
+COMPRESS_THRESHOLD = 1024
+# the fastest level, replies are repetitive enough that higher levels gain little
+COMPRESS_LEVEL = 1
+# words found in most replies, the most common last since zlib reaches the end of the dictionary cheapest
+SHARED_DICTIONARY = (
+    b"rejected unchanged delta full scheduled accepted resources building player"
+    b", defensivedome, 1^^, barracks, 1^^, cabins, 1^^, abyssalorerefinery, 1^^, abyssal_ore_refinery, 1^^"
+    b", powerplant, 1^^, power_plant, 1^^, plantation, 1^^, plantation, 2^^, plantation, 3^^"
+    b"\x00\x06cabins\x00\x08barracks\x00\x0ddefensivedome\x00\x12abyssalorerefinery\x00\x0apowerplant"
+    b"\x00\x0aplantation"
+)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class CompressionStats:
+    """Bytes in and out of the compressors of every connection and the CPU time they took."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    def add(self, bytes_in, bytes_out, cpu_seconds):
+        with self.lock:
+            self.messages += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.cpu_seconds += cpu_seconds
+
+    @property
+    def ratio(self):
+        return self.bytes_in / self.bytes_out if self.bytes_out else 1.0
+
+
+class Compressor:
+    """Compresses the payloads one connection sends, from threshold bytes on."""
+
+    def __init__(self, threshold=COMPRESS_THRESHOLD, dictionary=False, stats=None, level=COMPRESS_LEVEL):
+        self.threshold = threshold
+        self.dictionary = dictionary
+        self.stats = stats or CompressionStats()
+        self.level = level
+
+    def compress(self, payload, msg_type):
+        """(payload, msg_type) to send, compressed with the flag bits set or unchanged."""
+        if len(payload) < self.threshold:
+            return payload, msg_type
+        t0 = time.thread_time()
+        # a new stream per message, a frame is decompressed on its own
+        if self.dictionary:
+            stream = zlib.compressobj(self.level, zdict=SHARED_DICTIONARY)
+        else:
+            stream = zlib.compressobj(self.level)
+        compressed = stream.compress(payload) + stream.flush()
+        self.stats.add(len(payload), min(len(compressed), len(payload)), time.thread_time() - t0)
+        if len(compressed) >= len(payload):
+            return payload, msg_type
+        return compressed, msg_type | COMPRESSED | (WITH_DICTIONARY if self.dictionary else 0)
+
+
+def decompress_frame(msg_type, payload):
+    """The (msg_type, payload) a compressed frame was made from, other frames are returned as they are."""
+    if not msg_type & COMPRESSED:
+        return msg_type, payload
+    if msg_type & WITH_DICTIONARY:
+        stream = zlib.decompressobj(zdict=SHARED_DICTIONARY)
+    else:
+        stream = zlib.decompressobj()
+    try:
+        data = stream.decompress(payload, MAX_PAYLOAD)
+    except zlib.error as e:
+        raise ProtocolError(f"Compressed frame could not be read: {e}")
+    if stream.unconsumed_tail:
+        raise ProtocolError(f"Compressed frame is over the {MAX_PAYLOAD} byte limit")
+    return msg_type & TYPE_MASK, data
+
+
+def encode_frame(payload, msg_type=MSG_TEXT, compressor=None):
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    if compressor is not None:
+        payload, msg_type = compressor.compress(payload, msg_type)
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError(f"Payload of {len(payload)} bytes is over the {MAX_PAYLOAD} byte limit")
+    return HEADER.pack(len(payload), msg_type) + payload
+
+
+def encode_batch(items):
+    """Batch payload, each item is framed on its own so items may hold any text."""
+    return b"".join(encode_frame(item) for item in items)
+
+
+def decode_batch(payload):
+    reader = FrameReader()
+    reader.feed(payload)
+    return [item.decode("utf-8") for _, item in reader.frames()]
+
+
+def compile_fields(fields):
+    """[(Struct, field count), ...], runs of fixed size fields are packed at once, a string is (None, 1)."""
+    parts = []
+    run = ""
+    for field in fields:
+        if field == "s":
+            if run:
+                parts.append((struct.Struct("!" + run), len(run)))
+                run = ""
+            parts.append((None, 1))
+        else:
+            run += field
+    if run:
+        parts.append((struct.Struct("!" + run), len(run)))
+    return parts
+
+
+class ReplySchema:
+    def __init__(self, schema_id, header, row):
+        self.schema_id = schema_id
+        self.header = compile_fields(header)
+        self.row = compile_fields(row)
+
+    @staticmethod
+    def pack_values(out, parts, values):
+        index = 0
+        for part, count in parts:
+            if part is None:
+                data = values[index].encode("utf-8")
+                out += STRING_LENGTH.pack(len(data))
+                out += data
+            else:
+                out += part.pack(*values[index:index + count])
+            index += count
+
+    @staticmethod
+    def unpack_values(payload, offset, parts):
+        values = []
+        for part, count in parts:
+            if part is None:
+                (length,) = STRING_LENGTH.unpack_from(payload, offset)
+                offset += STRING_LENGTH.size
+                values.append(payload[offset:offset + length].decode("utf-8"))
+                offset += length
+            else:
+                values.extend(part.unpack_from(payload, offset))
+                offset += part.size
+        return tuple(values), offset
+
+    def pack(self, header=(), rows=()):
+        out = bytearray(REPLY_COUNT.pack(self.schema_id, len(rows)))
+        self.pack_values(out, self.header, header)
+        for row in rows:
+            self.pack_values(out, self.row, row)
+        return bytes(out)
+
+    def unpack(self, payload):
+        """(header, [row, ...]) of a packed reply."""
+        schema_id, count = REPLY_COUNT.unpack_from(payload)
+        if schema_id != self.schema_id:
+            raise ProtocolError(f"Reply with schema {schema_id} where schema {self.schema_id} was expected")
+        header, offset = self.unpack_values(payload, REPLY_COUNT.size, self.header)
+        rows = []
+        for _ in range(count):
+            row, offset = self.unpack_values(payload, offset, self.row)
+            rows.append(row)
+        return header, rows
+
+
+SCHEMAS = {command: ReplySchema(*schema) for command, schema in REPLY_SCHEMAS.items()}
+
+
+def pack_reply(command, header=(), rows=()):
+    return SCHEMAS[command].pack(header, rows)
+
+
+def unpack_reply(command, payload):
+    return SCHEMAS[command].unpack(payload)
+
+
+class FrameReader:
+    """Incremental buffer turning a byte stream back into (msg_type, payload) frames."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def feed(self, data):
+        # drop the already consumed part only once it is big, so each byte is copied a bounded number of times
+        if self.offset > RECV_SIZE and self.offset * 2 > len(self.buffer):
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer += data
+
+    def next_frame(self):
+        """Return the next complete frame or None if more data is needed."""
+        if len(self.buffer) - self.offset < HEADER.size:
+            return None
+        length, msg_type = HEADER.unpack_from(self.buffer, self.offset)
+        if length > MAX_PAYLOAD:
+            raise ProtocolError(f"Incoming frame of {length} bytes is over the {MAX_PAYLOAD} byte limit")
+        start = self.offset + HEADER.size
+        end = start + length
+        if len(self.buffer) < end:
+            return None
+        payload = bytes(self.buffer[start:end])
+        self.offset = end
+        return decompress_frame(msg_type, payload)
+
+    def pending(self):
+        """Number of buffered bytes belonging to a frame that is not complete yet."""
+        return len(self.buffer) - self.offset
+
+    def frames(self):
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+
+class Channel:
+    """A blocking socket with its own frame buffer, used by the threaded server and the client.
+
+    idle_timeout limits the wait for a new frame, read_timeout the wait for the rest of a frame already started.
+    Both raise socket.timeout, None waits forever.
+    """
+
+    def __init__(self, sock, idle_timeout=None, read_timeout=None):
+        self.sock = sock
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.reader = FrameReader()
+        # pushes are sent from other threads, frames must not interleave
+        self.send_lock = threading.Lock()
+
+    def send(self, payload, msg_type=MSG_TEXT):
+        self.send_frame(encode_frame(payload, msg_type))
+
+    def send_frame(self, frame):
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    def recv(self):
+        """Block until a whole frame arrived, returns (msg_type, payload) or None once the peer closed."""
+        frame = self.reader.next_frame()
+        while frame is None:
+            if self.idle_timeout is not None or self.read_timeout is not None:
+                self.sock.settimeout(self.read_timeout if self.reader.pending() else self.idle_timeout)
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                return None
+            self.reader.feed(data)
+            frame = self.reader.next_frame()
+        return frame
+
+    def recv_nowait(self):
+        """Return a frame if one can be read without blocking, otherwise None."""
+        frame = self.reader.next_frame()
+        if frame is not None:
+            return frame
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        if readable:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                raise ConnectionAbortedError("Connection closed by peer")
+            self.reader.feed(data)
+        return self.reader.next_frame()
+
+    def send_text(self, text):
+        self.send(text, MSG_TEXT)
+
+    def recv_reply(self, on_push=None):
+        """Wait for the next (msg_type, payload) reply, server pushes arriving before it are handed to on_push."""
+        while True:
+            frame = self.recv()
+            if frame is None:
+                raise ConnectionAbortedError("Connection closed by peer")
+            msg_type, payload = frame
+            if msg_type != MSG_PUSH:
+                return frame
+            if on_push is not None:
+                on_push(payload.decode("utf-8"))
+
+    def recv_text(self, on_push=None):
+        """Wait for the next reply as text, server pushes arriving before it are handed to on_push."""
+        return self.recv_reply(on_push)[1].decode("utf-8")
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+
+async def read_frame(stream_reader, idle_timeout=None, read_timeout=None):
+    """asyncio counterpart of Channel.recv, returns (msg_type, payload) or None once the peer closed.
+
+    Raises asyncio.TimeoutError when no frame starts within idle_timeout or a started one is not complete within
+    read_timeout.
+    """
+    try:
+        header = await asyncio.wait_for(stream_reader.readexactly(HEADER.size), idle_timeout)
+        length, msg_type = HEADER.unpack(header)
+        if length > MAX_PAYLOAD:
+            raise ProtocolError(f"Incoming frame of {length} bytes is over the {MAX_PAYLOAD} byte limit")
+        payload = await asyncio.wait_for(stream_reader.readexactly(length), read_timeout)
+    except asyncio.IncompleteReadError:
+        return None
+    return decompress_frame(msg_type, payload)
@@ -0,0 +1,189 @@
+"""Server side timers for building upgrades.
+
+`upgrade_building <hexagon no> <building name> <level>` starts a job and the building reaches the new level once
+the job is due. Jobs are stored in the BuildJobs table, so they survive a restart, and kept in a heap ordered by
+due time, so a single thread sleeps until the earliest job instead of anyone polling. A finished job is written
+like an add_building and pushed to subscribed clients, everyone else sees the new level on the next read.
+"""
+import heapq
+import logging
+import threading
+import time
+from contextlib import nullcontext
+
+import economy
+import logs
+
+log = logs.get_logger("scheduler")
+
+CREATE_BUILD_JOBS = """
+CREATE TABLE IF NOT EXISTS "BuildJobs" (
+    "PlayerID"  INTEGER NOT NULL,
+    "BuildingNo"    INTEGER NOT NULL,
+    "BuildingName"  TEXT NOT NULL,
+    "BuildingLevel" INTEGER NOT NULL,
+    "DueAt" REAL NOT NULL,
+    PRIMARY KEY("PlayerID", "BuildingNo")
+)"""
+
+# seconds of a level 1 build, the same as the client's build_time
+BUILD_SECONDS = {
+    "plantation": 30,
+    "powerplant": 45,
+    "cabins": 20,
+    "barracks": 60,
+    "abyssalorerefinery": 80,
+    "defensivedome": 90,
+}
+DEFAULT_BUILD_SECONDS = 1
+# every further level takes this much longer, like increase_rate_of_build_time on the client
+UPGRADE_TIME_GROWTH = 1.5
+# a job whose completion failed is tried again after this many seconds, doubled on every further failure
+RETRY_SECONDS = 1.0
+MAX_RETRY_SECONDS = 60.0
+
+
+def create_table(connection):
+    connection.execute(CREATE_BUILD_JOBS)
+
+
+def build_seconds(building_name, level):
+    return BUILD_SECONDS.get(building_name, DEFAULT_BUILD_SECONDS) * UPGRADE_TIME_GROWTH ** max(0, level - 1)
+
+
+class BuildScheduler:
+    """Completes build jobs at their due time by calling complete(pid, building_no, building_name, level)."""
+
+    def __init__(self, db, complete, shard=None, time_scale=1.0, journal=None):
+        self.db = db
+        self.complete = complete
+        # a finished job is journaled as one event with its completion, see journal.py
+        self.journal = journal
+        # (index, count) in a sharded server, only the jobs of this worker's players are loaded
+        self.shard = shard
+        # build times are multiplied by this, below 1 for test servers and load runs
+        self.time_scale = time_scale
+        # (due, pid, building no, building name, level), due is wall clock time so it means the same after a restart
+        self.heap = []
+        # (pid, building no) of jobs taken off the heap whose row is not deleted yet, jobs() leaves them out
+        self.finishing = set()
+        # (pid, building no) -> failed attempts of a job waiting on the heap to be tried again
+        self.retries = {}
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="build-scheduler", daemon=True)
+        self.scheduled = 0
+        self.completed = 0
+        self.max_late = 0.0
+
+    def load(self):
+        with self.db.reader() as connection:
+            rows = connection.execute(
+                "SELECT DueAt, PlayerID, BuildingNo, BuildingName, BuildingLevel FROM BuildJobs WHERE "
+                + economy.shard_filter(self.shard)).fetchall()
+        with self.condition:
+            self.heap = [tuple(row) for row in rows]
+            heapq.heapify(self.heap)
+        return len(rows)
+
+    def start(self):
+        pending = self.load()
+        # jobs that came due while the server was down are finished before the first client is served
+        logs.event(log, "scheduler_started", pending=pending, overdue=self.run_due())
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def schedule(self, pid, building_no, building_name, level, now=None):
+        """Start a job, returns its duration in seconds or None while the hexagon has one running."""
+        now = now or time.time()
+        seconds = build_seconds(building_name, level) * self.time_scale
+        due = now + seconds
+        # the row is written before the condition is taken, a batch already holds the writer when it gets here
+        with self.db.writer() as connection:
+            added = connection.execute(
+                "INSERT INTO BuildJobs(PlayerID, BuildingNo, BuildingName, BuildingLevel, DueAt) VALUES(?,?,?,?,?) "
+                "ON CONFLICT(PlayerID, BuildingNo) DO NOTHING",
+                (pid, building_no, building_name, level, due)).rowcount
+        if not added:
+            return None
+        with self.condition:
+            heapq.heappush(self.heap, (due, pid, building_no, building_name, level))
+            self.scheduled += 1
+            # only a new earliest job changes how long the thread has to sleep
+            if self.heap[0][0] == due:
+                self.condition.notify()
+        return seconds
+
+    def jobs(self, pid):
+        """[(building no, building name, level, due), ...] of the player's running jobs."""
+        with self.db.reader() as connection:
+            rows = connection.execute(
+                "SELECT BuildingNo, BuildingName, BuildingLevel, DueAt FROM BuildJobs WHERE PlayerID = ?",
+                (pid,)).fetchall()
+        with self.condition:
+            # a finished job is pushed to the client before its row is gone
+            return [row for row in rows if (pid, row[0]) not in self.finishing]
+
+    def finish(self, job):
+        due, pid, building_no, building_name, level = job
+        # the building and the delete commit together, complete has to write the building to the database and not
+        # only to a write-behind cache, so a crash leaves the job to be completed again after the restart
+        with self.journal.action() if self.journal is not None else nullcontext(), self.db.writer() as connection:
+            # no new job of the hexagon can be stored while this row is there
+            connection.execute("DELETE FROM BuildJobs WHERE PlayerID = ? AND BuildingNo = ?", (pid, building_no))
+            self.complete(pid, building_no, building_name, level)
+            if self.journal is not None:
+                self.journal.record("build_finished", pid=pid, building_no=building_no)
+        self.completed += 1
+
+    def run_due(self, now=None):
+        """Finish every job that is due, returns how many."""
+        now = now or time.time()
+        due = []
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                job = heapq.heappop(self.heap)
+                self.finishing.add((job[1], job[2]))
+                due.append(job)
+        for job in due:
+            key = (job[1], job[2])
+            if key not in self.retries:
+                self.max_late = max(self.max_late, now - job[0])
+            try:
+                self.finish(job)
+            except Exception as e:
+                # the row stays in BuildJobs and the job goes back on the heap to be tried again later
+                attempts = self.retries.get(key, 0) + 1
+                delay = min(MAX_RETRY_SECONDS, RETRY_SECONDS * 2 ** (attempts - 1))
+                logs.event(log, "build_failed", logging.ERROR, pid=job[1], building_no=job[2], attempts=attempts,
+                           retry_in=delay, error=e)
+                with self.condition:
+                    self.retries[key] = attempts
+                    heapq.heappush(self.heap, (now + delay,) + job[1:])
+            else:
+                self.retries.pop(key, None)
+            finally:
+                with self.condition:
+                    self.finishing.discard(key)
+        return len(due)
+
+    def stats(self):
+        return {"pending": len(self.heap), "scheduled": self.scheduled, "completed": self.completed,
+                "max_late_ms": self.max_late * 1000}
+
+    def run(self):
+        while not self.stop_event.is_set():
+            finished = self.run_due()
+            if finished:
+                logs.event(log, "builds_completed", logging.DEBUG, jobs=finished)
+            with self.condition:
+                if self.stop_event.is_set():
+                    break
+                # sleep until the earliest job, schedule wakes the thread early for an earlier one
+                self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
@@ -4,153 +4,1091 @@ import sqlite3
 import os
 import time
 import datetime
+import asyncio
+import argparse
+import signal
+import sys
+import logging
+import multiprocessing
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import logs
+import protocol
+import database
+from database import ConnectionManager
+import economy
+import metrics
+import migrations
+from economy import EconomyTicker
+from subscriptions import SubscriptionHub
+from cache import PlayerStateCache
+from sessions import SessionTable, DEFAULT_TTL, token_shard
+from scheduler import BuildScheduler
+from leaderboard import Leaderboard
+import leaderboard
+from worldmap import WorldMap
+from versions import BuildingVersions
+import journal
+from journal import Journal, SnapshotTimer
 
+DB_PATH = "Leviathan.db"
+MAX_CONNECTIONS = 1000
+IDLE_TIMEOUT = 300.0
+READ_TIMEOUT = 30.0
+# pending connections the OS keeps for accept, further ones are refused by the kernel
+BACKLOG = 128
+# bytes of pushes buffered for a client that does not read before it is disconnected
+MAX_PUSH_BACKLOG = 1024 * 1024
+# pushes waiting for a client of the threaded server before it is disconnected, its MAX_PUSH_BACKLOG
+MAX_PUSH_QUEUE = 1000
+# seconds between the checks for changed resources of subscribed clients, each check reads every subscriber
+PUSH_SECONDS = economy.PRODUCTION_PERIOD
+MIN_PUSH_SECONDS = 0.5
+# the answer instead of a reply when the server is full
+BUSY = "busy"
+log = logs.get_logger("server")
 
-def performance_calc(func):
-    def wrapper():
-        t0 = time.time()
-        func()
-        t1 = time.time()
-        print(f"Time taken {(t1 - t0)} seconds")
 
-    return wrapper
+def connect_db(path=None):
+    path = path or DB_PATH
+    exists = os.path.isfile(path)
+    # connections are shared between client threads by the ConnectionManager, which serialises their use
+    connection = sqlite3.connect(path, check_same_thread=False)
+    # a missing database is created here and gets its schema from the migrations when the server starts
+    logs.event(log, "database_connected" if exists else "database_created", logging.DEBUG, path=path)
+    return connection
 
 
-def connect_db():
+class ServerState:
+    """Everything the client handlers share, one instance per server."""
+
+    def __init__(self, db, economy_mode="lazy", tick_seconds=economy.PRODUCTION_PERIOD, use_cache=False,
+                 cache_idle_seconds=300.0, flush_seconds=1.0, metrics_port=None, shard=None,
+                 session_ttl=DEFAULT_TTL, max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, build_time_scale=1.0, journal_dir=None,
+                 snapshot_seconds=journal.SNAPSHOT_SECONDS, compress_threshold=protocol.COMPRESS_THRESHOLD,
+                 push_seconds=PUSH_SECONDS, leaderboard_seconds=leaderboard.REFRESH_SECONDS):
+        if tick_seconds <= 0:
+            raise ValueError(f"tick_seconds must be positive, not {tick_seconds}")
+        if push_seconds < MIN_PUSH_SECONDS:
+            raise ValueError(f"push_seconds must be at least {MIN_PUSH_SECONDS}, not {push_seconds}")
+        self.db = db
+        # clients may ask for compression at login, None turns it down for everyone
+        self.compress_threshold = compress_threshold
+        self.compression = protocol.CompressionStats()
+        # None leaves the journal off, otherwise every action is appended there and the database snapshotted
+        self.journal = Journal(journal_dir, db) if journal_dir else None
+        self.snapshot_timer = SnapshotTimer(self.snapshot, snapshot_seconds) if self.journal is not None else None
+        # connections over the limit are answered "busy" and closed, so a spike cannot exhaust threads or sockets
+        self.max_connections = max_connections
+        self.open_connections = 0
+        # seconds a client may stay silent between requests, and may take to finish a request it started
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        # (index, count) in a sharded server, this process only serves players with PlayerID % count == index
+        self.shard = shard
+        self.sessions = SessionTable(session_ttl, shard[0] if shard is not None else 0)
+        self.started = time.time()
+        self.metrics = metrics.Registry()
+        self.command_seconds = self.metrics.histogram("leviathan_command_seconds", "Time to answer a client command")
+        self.db_seconds = self.metrics.histogram("leviathan_db_seconds", "Time a database connection was held")
+        self.bytes_received = self.metrics.counter("leviathan_received_bytes_total", "Bytes read from clients")
+        self.bytes_sent = self.metrics.counter("leviathan_sent_bytes_total", "Bytes written to clients")
+        self.connections = self.metrics.gauge("leviathan_connections", "Open client connections")
+        self.rejected = self.metrics.counter("leviathan_busy_total", "Connections turned away over the limit")
+        self.timeouts = self.metrics.counter("leviathan_timeouts_total", "Connections closed after a timeout")
+        self.metrics.add_collector(self.collect_stats)
+        db.observe = lambda access, seconds: self.db_seconds.observe(seconds, access=access)
+        # None leaves the HTTP endpoint off, the registry is still filled
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        # "poll" produces when a client sends update, "tick" on a server timer and "lazy" computes resources
+        # from production rates when they are read. Only poll leaves work for the update command.
+        self.economy_mode = economy_mode
+        # number of open connections per logged in player
+        self.connected = {}
+        self.connected_lock = threading.Lock()
+        self.cache = PlayerStateCache(db, economy_mode == "lazy", cache_idle_seconds, flush_seconds,
+                                      self.connected_pids) if use_cache else None
+        self.ticker = None
+        self.refresh_timer = None
+        if economy_mode == "tick":
+            flush = self.cache.flush if self.cache is not None else None
+            self.ticker = EconomyTicker(db, tick_seconds, before_tick=flush, after_tick=self.after_tick, shard=shard,
+                                        journal=self.journal)
+        else:
+            # nothing ticks, resources still accrue and other shards still write their players
+            self.refresh_timer = leaderboard.RefreshTimer(self.refresh_scores, leaderboard_seconds)
+        self.hub = SubscriptionHub(self.read_resources, push_seconds)
+        self.scheduler = BuildScheduler(db, self.complete_build, shard, build_time_scale, journal=self.journal)
+        self.leaderboard = Leaderboard(economy_mode == "lazy")
+        self.world = WorldMap()
+        self.building_versions = BuildingVersions()
+
+    def player_connected(self, pid):
+        with self.connected_lock:
+            self.connected[pid] = self.connected.get(pid, 0) + 1
+
+    def player_disconnected(self, pid):
+        with self.connected_lock:
+            self.connected[pid] -= 1
+            if not self.connected[pid]:
+                del self.connected[pid]
+
+    def admit(self):
+        """Count a new connection in, False when the server is full."""
+        with self.connected_lock:
+            if self.open_connections >= self.max_connections:
+                self.rejected.inc()
+                return False
+            self.open_connections += 1
+        self.connections.inc()
+        return True
+
+    def release(self):
+        with self.connected_lock:
+            self.open_connections -= 1
+        self.connections.dec()
+
+    def owns(self, pid):
+        return self.shard is None or pid % self.shard[1] == self.shard[0]
+
+    def connected_pids(self):
+        with self.connected_lock:
+            return set(self.connected)
+
+    def collect_stats(self):
+        samples = [
+            ("leviathan_uptime_seconds", "Seconds since the server started", "gauge", time.time() - self.started),
+            ("leviathan_players_online", "Players with at least one open connection", "gauge",
+             len(self.connected_pids())),
+            ("leviathan_pushes_total", "Messages pushed to subscribed clients", "counter", self.hub.pushes),
+            ("leviathan_sessions", "Session tokens that can be resumed", "gauge", len(self.sessions.sessions)),
+            ("leviathan_sessions_resumed_total", "Reconnects resumed from a session token", "counter",
+             self.sessions.resumed),
+            ("leviathan_log_dropped_total", "Log records dropped because the log queue was full", "counter",
+             logs.handler.dropped if logs.handler is not None else 0),
+        ]
+        samples += [
+            ("leviathan_compressed_messages_total", "Messages compressed for clients", "counter",
+             self.compression.messages),
+            ("leviathan_compression_input_bytes_total", "Bytes of the messages before compression", "counter",
+             self.compression.bytes_in),
+            ("leviathan_compression_output_bytes_total", "Bytes of the messages after compression", "counter",
+             self.compression.bytes_out),
+            ("leviathan_compression_ratio", "Bytes before compression per byte after it", "gauge",
+             self.compression.ratio),
+            ("leviathan_compression_cpu_seconds_total", "CPU time spent compressing", "counter",
+             self.compression.cpu_seconds),
+            ("leviathan_map_cities", "Cities placed on the world map", "gauge", len(self.world)),
+            ("leviathan_leaderboard_players", "Players on the leaderboard", "gauge", len(self.leaderboard)),
+            ("leviathan_leaderboard_moves_total", "Score changes that moved a player on the leaderboard", "counter",
+             self.leaderboard.updates),
+        ]
+        stats = self.building_versions.stats()
+        samples += [
+            ("leviathan_building_syncs_full_total", "Building syncs answered with every building", "counter",
+             stats["full"]),
+            ("leviathan_building_syncs_delta_total", "Building syncs answered with the changed hexagons only",
+             "counter", stats["delta"]),
+            ("leviathan_building_syncs_unchanged_total", "Building syncs answered unchanged", "counter",
+             stats["unchanged"]),
+        ]
+        if self.journal is not None:
+            stats = self.journal.stats()
+            samples += [
+                ("leviathan_journal_events_total", "Actions written to the journal", "counter", stats["written"]),
+                ("leviathan_journal_batches_total", "Journal writes, each ending with one fsync", "counter",
+                 stats["batches"]),
+                ("leviathan_journal_snapshots_total", "Database snapshots taken", "counter", stats["snapshots"]),
+            ]
+        stats = self.scheduler.stats()
+        samples += [
+            ("leviathan_build_jobs_pending", "Build and upgrade jobs waiting for their due time", "gauge",
+             stats["pending"]),
+            ("leviathan_build_jobs_completed_total", "Build and upgrade jobs completed", "counter", stats["completed"]),
+            ("leviathan_build_jobs_max_late_seconds", "Longest delay of a job past its due time", "gauge",
+             stats["max_late_ms"] / 1000),
+        ]
+        if self.ticker is not None:
+            stats = self.ticker.stats()
+            samples += [
+                ("leviathan_economy_ticks_total", "Economy ticks run", "counter", stats["ticks"]),
+                ("leviathan_economy_tick_last_seconds", "Duration of the last economy tick", "gauge",
+                 stats["last_ms"] / 1000),
+                ("leviathan_economy_tick_max_seconds", "Longest economy tick", "gauge", stats["max_ms"] / 1000),
+            ]
+        if self.cache is not None:
+            stats = self.cache.stats()
+            samples += [
+                ("leviathan_cache_entries", "Players held in the cache", "gauge", stats["entries"]),
+                ("leviathan_cache_hits_total", "Cache lookups answered from memory", "counter", stats["hits"]),
+                ("leviathan_cache_misses_total", "Cache lookups loaded from the database", "counter", stats["misses"]),
+                ("leviathan_cache_evictions_total", "Idle players dropped from the cache", "counter",
+                 stats["evictions"]),
+                ("leviathan_cache_flushes_total", "Write-behind flushes", "counter", stats["flushes"]),
+                ("leviathan_cache_flush_max_seconds", "Longest write-behind flush", "gauge", stats["max_flush_ms"] / 1000),
+            ]
+        return samples
+
+    def read_resources(self, pids):
+        found = self.cache.peek_resources(pids) if self.cache is not None else {}
+        missing = [pid for pid in pids if pid not in found]
+        if missing:
+            with self.db.reader() as connection:
+                found.update(economy.read_resources(connection, missing, self.economy_mode == "lazy"))
+        return found
+
+    def player_resources(self, pid):
+        if self.cache is not None:
+            return self.cache.resources(pid)
+        with self.db.reader() as connection:
+            if self.economy_mode == "lazy":
+                return economy.read_accrued(connection, pid)
+            return connection.execute("SELECT Food, Metal, Energy FROM Players WHERE PlayerID = ?", (pid,)).fetchone()
+
+    def player_buildings(self, pid):
+        if self.cache is not None:
+            return self.cache.buildings(pid)
+        with self.db.reader() as connection:
+            return connection.execute("SELECT * FROM Buildings WHERE PlayerID = ?", (pid,)).fetchall()
+
+    def action(self):
+        """Context to apply a change in, so a journal snapshot never falls between the change and its event."""
+        return self.journal.action() if self.journal is not None else nullcontext()
+
+    def record(self, kind, **fields):
+        if self.journal is not None:
+            self.journal.record(kind, **fields)
+
+    def add_building(self, pid, building_no, building_name, building_level):
+        with self.action():
+            if self.cache is not None:
+                self.cache.add_building(pid, building_no, building_name, building_level)
+            else:
+                with self.db.writer() as connection:
+                    connection.execute(database.UPSERT_BUILDING, (pid, building_no, building_name, building_level,))
+                    if self.economy_mode == "lazy":
+                        # the only write lazy accrual needs, resources up to now and the new production rates
+                        economy.settle(connection, pid)
+            self.record("add_building", pid=pid, building_no=building_no, building_name=building_name,
+                        level=building_level, settle=self.economy_mode == "lazy")
+        self.building_versions.changed(pid, building_no)
+        self.update_score(pid, levels=sum(row[3] for row in self.player_buildings(pid)))
+        self.hub.publish_building(pid, building_no, building_name, building_level)
+
+    def complete_build(self, pid, building_no, building_name, building_level):
+        """add_building of a finished upgrade, written through the cache in the scheduler's transaction."""
+        self.add_building(pid, building_no, building_name, building_level)
+        if self.cache is not None:
+            self.cache.flush(pids={pid})
+
+    def update_player(self, pid):
+        if self.economy_mode != "poll":
+            # production is applied by the economy tick or accrued when read
+            return
+        with self.action():
+            if self.cache is not None:
+                self.cache.produce(pid)
+            else:
+                with self.db.writer() as connection:
+                    calc_changes(connection, pid)
+            self.record("update", pid=pid)
+        self.update_score(pid, resources=sum(self.player_resources(pid)))
+
+    def update_score(self, pid, **parts):
+        """Move a player on the leaderboard, parts are the resources, levels or defense that changed."""
+        if self.leaderboard.update(pid, **parts) or not self.leaderboard.loaded:
+            return
+        # created after the server started, ranked with everything read from the database
+        with self.db.reader() as connection:
+            self.leaderboard.add_player(connection, pid)
+        self.leaderboard.update(pid, **parts)
+
+    def set_defense(self, pid, defense):
+        with self.action():
+            with self.db.writer() as connection:
+                connection.execute("UPDATE Players SET Defense = ? WHERE PlayerID = ?", (defense, pid))
+            self.record("army", pid=pid, defense=defense)
+        self.update_score(pid, defense=defense)
+
+    def schedule_upgrade(self, pid, building_no, building_name, level):
+        """Start an upgrade job, returns its duration in seconds or None when the hexagon has one running."""
+        now = time.time()
+        with self.action():
+            seconds = self.scheduler.schedule(pid, building_no, building_name, level, now=now)
+            if seconds is not None:
+                self.record("upgrade_scheduled", pid=pid, building_no=building_no, building_name=building_name,
+                            level=level, due=now + seconds)
+        return seconds
+
+    def after_tick(self):
+        if self.cache is not None:
+            self.cache.invalidate_resources()
+        self.refresh_scores()
+
+    def refresh_scores(self):
+        """Read every player's score again, for the players whose resources grew without the server writing them."""
+        if self.cache is not None:
+            # the database has to know what the cache holds before the board reads it
+            self.cache.flush()
+        with self.db.reader() as connection:
+            moved = self.leaderboard.refresh(connection)
+        logs.event(log, "leaderboard_refreshed", logging.DEBUG, moved=moved)
+
+    def snapshot(self):
+        # the cache holds changes the database does not have yet, they go into the snapshot too
+        return self.journal.snapshot(self.cache.flush if self.cache is not None else None)
+
+    def start(self):
+        with self.db.writer() as connection:
+            migrations.migrate(connection)
+            if self.economy_mode == "lazy":
+                economy.start_accrual(connection, shard=self.shard)
+            else:
+                economy.stop_accrual(connection, shard=self.shard)
+        if self.journal is not None:
+            self.journal.start()
+            if not journal.snapshots(self.journal.directory):
+                # restores start from a snapshot, so there is one from the beginning
+                self.snapshot()
+            self.snapshot_timer.start()
+        with self.db.reader() as connection:
+            # later changes move single players on the board, refresh_scores reads them all again
+            logs.event(log, "leaderboard_loaded", players=self.leaderboard.load(connection))
+            logs.event(log, "world_map_loaded", cities=self.world.load(connection))
+        if self.cache is not None:
+            self.cache.start()
+        # after the cache, overdue jobs are completed through add_building right away
+        self.scheduler.start()
+        if self.ticker is not None:
+            self.ticker.start()
+        if self.refresh_timer is not None:
+            self.refresh_timer.start()
+        self.hub.start()
+        if self.metrics_port is not None:
+            self.metrics_server = metrics.serve(self.metrics, port=self.metrics_port)
+
+    def close(self):
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        self.hub.stop()
+        self.scheduler.stop()
+        if self.ticker is not None:
+            self.ticker.stop()
+        if self.refresh_timer is not None:
+            self.refresh_timer.stop()
+        if self.cache is not None:
+            # write-behind, whatever is still dirty goes to the database before it closes
+            self.cache.stop()
+            logs.event(log, "cache_stats", **self.cache.stats())
+        if self.journal is not None:
+            self.snapshot_timer.stop()
+            self.journal.stop()
+            logs.event(log, "journal_stats", **self.journal.stats())
+        self.db.close()
+
+
+class PushWriter:
+    """Sends the pushes of a threaded server's client from a thread of its own.
+
+    The hub and the scheduler only queue the message, so a client that stops reading blocks nobody but this thread,
+    and once max_pending pushes are waiting the client is dropped.
+    """
+
+    def __init__(self, send, drop, max_pending=MAX_PUSH_QUEUE):
+        self.send = send
+        self.drop = drop
+        self.pending = queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self.run, name="push-writer", daemon=True)
+        self.lock = threading.Lock()
+
+    def push(self, text):
+        with self.lock:
+            # most clients never subscribe, the thread is only started by the first push
+            if self.thread.ident is None:
+                self.thread.start()
+        try:
+            self.pending.put_nowait(text)
+        except queue.Full:
+            self.drop()
+
+    def stop(self):
+        try:
+            self.pending.put_nowait(None)
+        except queue.Full:
+            # dropped already, the send blocked on the closed socket fails and ends the thread
+            pass
+
+    def run(self):
+        while True:
+            text = self.pending.get()
+            if text is None:
+                return
+            try:
+                self.send(text)
+            except Exception as e:
+                logs.event(log, "push_failed", logging.WARNING, error=e)
+                self.drop()
+                return
+
+
+def new_session(push):
+    # push(text) sends a server initiated message to this client, used by subscriptions
+    return {"username": "", "pid": 0, "push": push, "subscriber": None, "encoding": protocol.TEXT,
+            "compressor": None}
+
+
+def sign_in(state, session, pid, username):
+    if session["pid"]:
+        state.player_disconnected(session["pid"])
+    session["username"] = username
+    session["pid"] = pid
+    state.player_connected(pid)
+    if state.world.home(pid) is None:
+        # a player created after the server started
+        state.world.add(pid, username)
+
+
+def idle_timeout(state, session):
+    # a subscribed client waits for pushes and has no reason to send anything, only silent polling clients time out
+    return None if session["subscriber"] is not None else state.idle_timeout
+
+
+def end_session(state, session):
+    if session["pid"]:
+        state.player_disconnected(session["pid"])
+        session["pid"] = 0
+    if session["subscriber"] is not None:
+        state.hub.unsubscribe(session["subscriber"])
+        session["subscriber"] = None
+
+
+# commands with their own latency histogram, anything else is recorded as "other"
+TIMED_COMMANDS = {"login", "resume", "info", "info_buildings", "buildings_since", "add_building", "upgrade_building",
+                  "build_jobs", "army", "leaderboard", "rank", "map_home", "map_chunk", "map_near", "subscribe",
+                  "update"}
+
+
+def handle_request(state, session, request, binary=False):
+    """Run a single client command and return the response text, or None for commands without a reply.
+
+    With binary the commands of protocol.REPLY_SCHEMAS return their reply packed as bytes instead.
+    """
+    command = request.split(" ")[0]
+    t0 = time.perf_counter()
     try:
-        connection = sqlite3.connect("Leviathan.db")
-        if os.path.isfile("Leviathan.db"):
-            print("Connected to database")
-            return connection
+        return run_command(state, session, request, binary)
+    finally:
+        seconds = time.perf_counter() - t0
+        state.command_seconds.observe(seconds, command=command if command in TIMED_COMMANDS else "other")
+        logs.event(log, "command", command=command, pid=session["pid"], ms=round(seconds * 1000, 3))
+
+
+def building_args(break_up):
+    """(hexagon no, building name, level) of an add_building or upgrade_building request, ValueError when invalid."""
+    building_no, building_name, level = int(break_up[1]), str(break_up[2]), int(break_up[3])
+    # both are packed as 16 bit unsigned fields, a stored value out of range would break every binary reply
+    if not (0 <= building_no <= protocol.MAX_UINT16 and 0 <= level <= protocol.MAX_UINT16):
+        raise ValueError(f"hexagon {building_no} or level {level} out of range")
+    return building_no, building_name, level
+
+
+def text_rows(rows):
+    return "".join(", ".join(str(value) for value in row) + "^^" for row in rows)
+
+
+def negotiate(state, session, options):
+    """Take the options a client lists after login or resume, returns the accepted ones to repeat in the reply.
+
+    An old server ignores the words and a client only uses what the reply repeats, so both sides fall back to
+    plain text on their own.
+    """
+    accepted = []
+    session["encoding"] = protocol.BINARY if protocol.BINARY in options else protocol.TEXT
+    if session["encoding"] != protocol.TEXT:
+        accepted.append(session["encoding"])
+    session["compressor"] = None
+    compression = next((option for option in options if option in protocol.COMPRESSIONS), None)
+    if compression is not None and state.compress_threshold is not None:
+        session["compressor"] = protocol.Compressor(state.compress_threshold, compression == protocol.ZLIB_DICTIONARY,
+                                                    state.compression)
+        accepted.append(compression)
+    return accepted
+
+
+def run_command(state, session, request, binary=False):
+    db = state.db
+    break_up = request.split(" ")
+    response = None
+    if break_up[0] == "login":
+        with db.reader() as connection:
+            data = connection.execute("SELECT * FROM Players WHERE PName = ?", (break_up[1],)).fetchone()
+        if data is None:
+            logs.event(log, "login_unknown", user=break_up[1])
+            response = "rejected"
+        elif not state.owns(data[0]):
+            # the player's state lives in another worker process, see route
+            logs.event(log, "login_wrong_shard", logging.WARNING, user=break_up[1], pid=data[0])
+            response = "rejected"
+        elif break_up[2] == data[2]:
+            sign_in(state, session, data[0], data[1])
+            response = " ".join(["accepted", state.sessions.issue(data[0], data[1]),
+                                 *negotiate(state, session, break_up[3:])])
+            logs.event(log, "login", user=data[1], pid=data[0])
         else:
-            raise ValueError('Failed to connect DB')
-    except ValueError as e:
-        print(f"Error with database connection: {e}")
-        print("Shutting down")
-        raise SystemExit
+            logs.event(log, "login_failed", user=break_up[1], pid=data[0])
+            response = "rejected"
+    elif break_up[0] == "resume":
+        # a reconnect with the token of an earlier login, no database lookup or password check
+        resumed = state.sessions.resume(break_up[1]) if len(break_up) > 1 else None
+        if resumed is not None and state.owns(resumed.pid):
+            sign_in(state, session, resumed.pid, resumed.username)
+            response = " ".join(["accepted", *negotiate(state, session, break_up[2:])])
+        else:
+            response = "rejected"
+    elif break_up[0] == "info":
+        data = state.player_resources(session["pid"])
+        if binary:
+            response = protocol.pack_reply("info", tuple(int(value) for value in data))
+        else:
+            response = ""
+            for value in data:
+                response += str(value) + " "
+        if session["pid"]:
+            state.update_score(session["pid"], resources=sum(data))
+    elif break_up[0] == "info_buildings":
+        data = state.player_buildings(session["pid"])
+        response = protocol.pack_reply("info_buildings", rows=data) if binary else text_rows(data)
+    elif break_up[0] == "buildings_since":
+        # buildings_since <epoch> <version>, only the hexagons written since the client's version, see versions.py
+        pid = session["pid"]
+        try:
+            epoch, version = int(break_up[1]), int(break_up[2])
+        except (ValueError, IndexError):
+            epoch, version = 0, 0
+        # the version is taken before the rows, a write in between is sent again next time instead of lost
+        current, changed = state.building_versions.since(pid, epoch, version) if pid else (0, set())
+        rows = []
+        if not pid:
+            header = ("rejected", 0, 0)
+        elif changed is not None and not changed:
+            header = ("unchanged", 0, 0)
+        else:
+            header = ("full" if changed is None else "delta", state.building_versions.epoch, current)
+            rows = [row for row in state.player_buildings(pid) if changed is None or row[1] in changed]
+        if binary:
+            response = protocol.pack_reply("buildings_since", header, rows)
+        elif header[0] in ("rejected", "unchanged"):
+            response = header[0]
+        else:
+            response = f"{header[0]} {header[1]} {header[2]}^^" + text_rows(rows)
+    elif break_up[0] == "add_building":
+        pid = session["pid"]
+        try:
+            state.add_building(pid, *building_args(break_up))
+        except ValueError as e:
+            logs.event(log, "bad_building", logging.WARNING, pid=pid, request=request, error=e)
+    elif break_up[0] == "upgrade_building":
+        # the level is reached when the job is due, the reply tells the client how long that takes
+        pid = session["pid"]
+        seconds = None
+        try:
+            if pid:
+                seconds = state.schedule_upgrade(pid, *building_args(break_up))
+        except ValueError as e:
+            logs.event(log, "bad_building", logging.WARNING, pid=pid, request=request, error=e)
+        response = "rejected" if seconds is None else f"scheduled {seconds:.1f}"
+    elif break_up[0] == "build_jobs":
+        now = time.time()
+        rows = [(building_no, building_name, level, max(0.0, due - now))
+                for building_no, building_name, level, due in state.scheduler.jobs(session["pid"])]
+        if binary:
+            response = protocol.pack_reply("build_jobs", rows=rows)
+        else:
+            response = ""
+            for building_no, building_name, level, seconds in rows:
+                response += f"{building_no}, {building_name}, {level}, {seconds:.1f}^^"
+    elif break_up[0] == "army":
+        # total defense of the player's army, as the client's Army adds it up
+        pid = session["pid"]
+        try:
+            if pid:
+                state.set_defense(pid, max(0, int(break_up[1])))
+        except (ValueError, IndexError) as e:
+            logs.event(log, "bad_army", logging.WARNING, pid=pid, request=request, error=e)
+    elif break_up[0] == "leaderboard":
+        # leaderboard <first rank> <rows>, one page per request so the client only reads what it shows
+        try:
+            start = int(break_up[1]) if len(break_up) > 1 else 1
+            count = int(break_up[2]) if len(break_up) > 2 else leaderboard.PAGE_LIMIT
+        except ValueError:
+            start, count = 1, leaderboard.PAGE_LIMIT
+        rows = state.leaderboard.page(start, count)
+        response = protocol.pack_reply("leaderboard", rows=rows) if binary else text_rows(rows)
+    elif break_up[0] == "rank":
+        ranked = state.leaderboard.rank(session["pid"]) if session["pid"] else None
+        response = "rejected" if ranked is None else f"{ranked[0]} {ranked[1]} {len(state.leaderboard)}"
+    elif break_up[0] == "map_home":
+        home = state.world.home(session["pid"]) if session["pid"] else None
+        response = "rejected" if home is None else f"{home[0]} {home[1]}"
+    elif break_up[0] in ("map_chunk", "map_near"):
+        # clients ask for the chunks their viewport shows, never for the whole map
+        cities = []
+        try:
+            if break_up[0] == "map_chunk":
+                cities = state.world.chunk(int(break_up[1]), int(break_up[2]))
+            elif state.world.home(session["pid"]) is not None:
+                cities = state.world.near(*state.world.home(session["pid"]), int(break_up[1]))
+        except (ValueError, IndexError) as e:
+            logs.event(log, "bad_map_request", logging.WARNING, pid=session["pid"], request=request, error=e)
+        response = protocol.pack_reply(break_up[0], rows=cities) if binary else text_rows(cities)
+    elif break_up[0] == "subscribe":
+        if session["subscriber"] is None and session["pid"]:
+            session["subscriber"] = state.hub.subscribe(session["pid"], session["push"])
+            # start the client off with its current numbers
+            state.hub.publish_resources([session["subscriber"]])
+        response = "subscribed" if session["subscriber"] is not None else "rejected"
+    elif break_up[0] == "update":
+        try:
+            state.update_player(session["pid"])
+        except ValueError as e:
+            logs.event(log, "update_failed", logging.WARNING, pid=session["pid"], error=e)
+    return response
+
+
+# commands that write, a batch holding none of them does not need the writer connection
+WRITE_COMMANDS = {"add_building", "upgrade_building", "army", "update"}
+
+
+def writes(state, request):
+    command = request.split(" ")[0]
+    if command == "update":
+        # production is only written by update in poll mode
+        return state.economy_mode == "poll"
+    return command in WRITE_COMMANDS
+
+
+def handle_batch(state, session, requests):
+    """Run several commands in one database transaction, returns a "<status> <reply>" line per command.
+
+    Status is ok, empty for commands without a reply, or error. A failing command only rolls back its own writes,
+    in the database and in the player cache.
+    """
+    results = []
+    if not any(writes(state, request) for request in requests):
+        for request in requests:
+            try:
+                response = handle_request(state, session, request)
+            except Exception as e:
+                results.append(f"error {e}")
+                continue
+            results.append("empty" if response is None else f"ok {response}")
+        return results
+    with state.db.writer() as connection:
+        for number, request in enumerate(requests):
+            savepoint = f"command_{number}"
+            connection.execute(f"SAVEPOINT {savepoint}")
+            # the cache is written instead of the database, it is rolled back with the savepoint
+            cached = state.cache.save(session["pid"]) if state.cache is not None and session["pid"] else None
+            try:
+                response = handle_request(state, session, request)
+            except Exception as e:
+                connection.execute(f"ROLLBACK TO {savepoint}")
+                connection.execute(f"RELEASE {savepoint}")
+                if cached is not None:
+                    state.cache.restore(cached)
+                results.append(f"error {e}")
+                continue
+            connection.execute(f"RELEASE {savepoint}")
+            results.append("empty" if response is None else f"ok {response}")
+    return results
+
+
+def is_close(msg_type, payload):
+    return msg_type == protocol.MSG_TEXT and payload.decode("utf-8").lower() == "close"
+
+
+def handle_frame(state, session, msg_type, payload):
+    """Answer one incoming frame, returns the (msg_type, payload) reply or None."""
+    if msg_type == protocol.MSG_TEXT:
+        response = handle_request(state, session, payload.decode("utf-8"), session["encoding"] == protocol.BINARY)
+        if response is None:
+            return None
+        return protocol.MSG_BINARY if isinstance(response, bytes) else protocol.MSG_TEXT, response
+    if msg_type == protocol.MSG_BATCH:
+        results = handle_batch(state, session, protocol.decode_batch(payload))
+        return protocol.MSG_BATCH, protocol.encode_batch(results)
+    logs.event(log, "unknown_message_type", logging.WARNING, msg_type=msg_type)
+    return None
+
+
+def handle_client(client_socket, addr, state=None):
+    channel = protocol.Channel(client_socket)
 
+    def send(payload, msg_type):
+        frame = protocol.encode_frame(payload, msg_type, session["compressor"])
+        channel.send_frame(frame)
+        state.bytes_sent.inc(len(frame))
 
-def handle_client(client_socket, addr):
-    username = ""
-    pid = 0
+    def drop():
+        # the client does not read its pushes, shutting the socket down ends the read loop below as well
+        logs.event(log, "slow_client", logging.WARNING, addr=f"{addr[0]}:{addr[1]}")
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    pushes = PushWriter(lambda text: send(text, protocol.MSG_PUSH), drop)
+    session = new_session(pushes.push)
+    admitted = False
+    # a state made for this one client only is closed with it
+    owned = state is None
     try:
-        connection = connect_db()
-        querier = connection.cursor()
+        if owned:
+            state = ServerState(ConnectionManager(connect_db, readers=1))
+        admitted = state.admit()
+        if not admitted:
+            logs.event(log, "busy", logging.WARNING, addr=f"{addr[0]}:{addr[1]}")
+            send(BUSY, protocol.MSG_TEXT)
+            return
+        channel.read_timeout = state.read_timeout
         while True:
-            # receive and print client messages
-            request = client_socket.recv(1024).decode("utf-8")
-            if request.lower() == "close":
+            # receive client messages
+            channel.idle_timeout = idle_timeout(state, session)
+            frame = channel.recv()
+            if frame is None:
                 break
-            break_up = request.split(" ")
-            if break_up[0] == "login":
-                querier.execute("SELECT * FROM Players WHERE PName = ?", (break_up[1],))
-                data = querier.fetchone()
-                if data is None:
-                    print('There is no profile named %s' % break_up[1])
-                    response = "rejected"
-                else:
-                    print('Username %s found, pass is %s, given is %s' % (break_up[1], data[2], break_up[2]))
-                    if break_up[2] == data[2]:
-                        response = "accepted"
-                        username = data[1]
-                        pid = data[0]
-                    else:
-                        response = "rejected"
-                client_socket.send(response.encode("utf-8")[:1024])
-            elif break_up[0] == "info":
-                querier.execute("SELECT * FROM Players WHERE PName = ?", (username,))
-                data = querier.fetchone()
-                response = ""
-                for info in range(3, len(data)):
-                    response += str(data[info])
-                    if info != len(data):
-                        response += " "
-                print(response)
-                client_socket.send(response.encode("utf-8")[:1024])
-            elif break_up[0] == "info_buildings":
-                querier.execute("SELECT * FROM Buildings WHERE PlayerID = ?", (pid,))
-                data = querier.fetchall()
-                response = ""
-                for row in data:
-                    for value in range(0, len(row)):
-                        response += str(row[value])
-                        if value != len(row) - 1:
-                            response += ", "
-                    response += "^^"
-                print(response)
-                client_socket.send(response.encode("utf-8")[:1024])
-            elif break_up[0] == "add_building":
-                try:
-                    querier.execute(
-                        "INSERT INTO Buildings(PlayerID, BuildingNo, BuildingName, BuildingLevel) VALUES(?,?,?,?)",
-                        (pid, int(break_up[1]), str(break_up[2]), int(break_up[3]),))
-                    connection.commit()
-                except ValueError as e:
-                    print(
-                        f"Error with building: {e}, could not assign building value {pid, break_up[1], break_up[2], break_up[3]}")
-            elif break_up[0] == "update":
-                try:
-                    calc_changes(connection, pid)
-                except ValueError as e:
-                    print(
-                        f"Error with updating: {e}, could not update")
+            msg_type, payload = frame
+            state.bytes_received.inc(protocol.HEADER.size + len(payload))
+            if is_close(msg_type, payload):
+                break
+            reply = handle_frame(state, session, msg_type, payload)
+            if reply is not None:
+                send(reply[1], reply[0])
 
+    except socket.timeout:
+        state.timeouts.inc()
+        logs.event(log, "timeout", addr=f"{addr[0]}:{addr[1]}")
     except Exception as e:
-        print(f"Error when handling client: {e}")
+        logs.event(log, "client_failed", logging.WARNING, addr=f"{addr[0]}:{addr[1]}", error=e)
     finally:
+        if state is not None:
+            end_session(state, session)
+        pushes.stop()
+        if admitted:
+            state.release()
+        if owned and state is not None:
+            state.close()
         client_socket.close()
-        print(f"Connection to client ({addr[0]}:{addr[1]}) closed")
+        logs.event(log, "disconnect", addr=f"{addr[0]}:{addr[1]}")
 
 
-@performance_calc
-def run_server():
-    server_ip = "127.0.0.1"  # server hostname or IP address
-    port = 8000  # server port number
+async def handle_client_async(reader, writer, executor, state):
+    addr = writer.get_extra_info("peername")
+    logs.event(log, "connect", addr=f"{addr[0]}:{addr[1]}")
+    loop = asyncio.get_running_loop()
+    if not state.admit():
+        logs.event(log, "busy", logging.WARNING, addr=f"{addr[0]}:{addr[1]}")
+        writer.write(protocol.encode_frame(BUSY))
+        writer.close()
+        return
+
+    def write_push(frame):
+        if writer.transport.get_write_buffer_size() > MAX_PUSH_BACKLOG:
+            # the client stopped reading, drop it instead of buffering pushes without bound
+            logs.event(log, "slow_client", logging.WARNING, addr=f"{addr[0]}:{addr[1]}")
+            writer.transport.abort()
+            return
+        writer.write(frame)
+        state.bytes_sent.inc(len(frame))
+
+    # pushes come from the hub thread, the write itself has to happen on the event loop
+    def push(text):
+        loop.call_soon_threadsafe(write_push, protocol.encode_frame(text, protocol.MSG_PUSH, session["compressor"]))
+
+    session = new_session(push)
+    try:
+        while True:
+            frame = await protocol.read_frame(reader, idle_timeout(state, session), state.read_timeout)
+            if frame is None:
+                break
+            msg_type, payload = frame
+            state.bytes_received.inc(protocol.HEADER.size + len(payload))
+            if is_close(msg_type, payload):
+                break
+            # database work is handed to the bounded executor so the event loop never blocks on sqlite
+            reply = await loop.run_in_executor(executor, handle_frame, state, session, msg_type, payload)
+            if reply is not None:
+                frame = protocol.encode_frame(reply[1], reply[0], session["compressor"])
+                writer.write(frame)
+                state.bytes_sent.inc(len(frame))
+                # a client that does not read its replies is held up here, not buffered for
+                await asyncio.wait_for(writer.drain(), state.read_timeout)
+
+    except asyncio.TimeoutError:
+        state.timeouts.inc()
+        logs.event(log, "timeout", addr=f"{addr[0]}:{addr[1]}")
+    except Exception as e:
+        logs.event(log, "client_failed", logging.WARNING, addr=f"{addr[0]}:{addr[1]}", error=e)
+    finally:
+        end_session(state, session)
+        state.release()
+        writer.close()
+        logs.event(log, "disconnect", addr=f"{addr[0]}:{addr[1]}")
+
+
+async def serve_async(server_ip, port, db_workers, state, backlog=BACKLOG):
+    executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix="db")
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_client_async(reader, writer, executor, state), server_ip, port, backlog=backlog)
+    logs.event(log, "listening", address=f"{server_ip}:{port}", mode="asyncio", db_workers=db_workers)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(wait=False)
+
+
+def run_async_server(server_ip="127.0.0.1", port=8000, db_workers=4, db_readers=4, backlog=BACKLOG, **state_options):
+    # state_options are passed on to ServerState
+    state = ServerState(ConnectionManager(connect_db, readers=db_readers), **state_options)
+    state.start()
+    try:
+        asyncio.run(serve_async(server_ip, port, db_workers, state, backlog))
+    except (KeyboardInterrupt, SystemExit):
+        logs.event(log, "stopped")
+    except Exception as e:
+        logs.event(log, "server_failed", logging.ERROR, error=e)
+    finally:
+        state.close()
+
+
+def run_server(server_ip="127.0.0.1", port=8000, db_readers=4, backlog=BACKLOG, **state_options):
+    # server_ip is the server hostname or IP address, port the server port number
     # Creation of server and connection
+    state = None
+    server = None
     try:
+        # one pool and economy for the whole server, shared by every client thread
+        state = ServerState(ConnectionManager(connect_db, readers=db_readers), **state_options)
+        state.start()
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # bind the socket to the host and port
         server.bind((server_ip, port))
         # listen for incoming connections
-        print(f"Listening on {server_ip}:{port}")
-        server.listen()
+        logs.event(log, "listening", address=f"{server_ip}:{port}", mode="threaded")
+        server.listen(backlog)
         while True:
             # accept a client connection
             client_socket, addr = server.accept()
-            print(f"Accepted connection from {addr[0]}:{addr[1]}")
+            logs.event(log, "connect", addr=f"{addr[0]}:{addr[1]}")
             # start a new thread to handle the client
-            thread = threading.Thread(target=handle_client, args=(client_socket, addr))
+            thread = threading.Thread(target=handle_client, args=(client_socket, addr, state))
             thread.start()
 
+    except (KeyboardInterrupt, SystemExit):
+        logs.event(log, "stopped")
+    except Exception as e:
+        logs.event(log, "server_failed", logging.ERROR, error=e)
+    finally:
+        if server is not None:
+            server.close()
+        if state is not None:
+            state.close()
+
+
+# Sharded server: a dispatcher process accepts the connections, reads the first request and hands the socket to
+# the worker process owning the player. Every player is served by one worker, so the per process player cache
+# and subscriptions stay correct while the parsing and Python work spreads over the cores.
+
+# seconds a new connection gets to send its first request before the dispatcher drops it
+HANDOFF_TIMEOUT = 10.0
+
+
+def first_request(frame):
+    msg_type, payload = frame
+    if msg_type == protocol.MSG_BATCH:
+        requests = protocol.decode_batch(payload)
+        return requests[0] if requests else ""
+    return payload.decode("utf-8") if msg_type == protocol.MSG_TEXT else ""
+
+
+def route(request, db, shards):
+    """Index of the worker for a connection starting with request, players are split by PlayerID % shards."""
+    break_up = request.split(" ")
+    if break_up[0] == "resume" and len(break_up) > 1:
+        # sessions live in the worker that issued the token
+        return token_shard(break_up[1]) % shards
+    if break_up[0] == "login" and len(break_up) > 1:
+        with db.reader() as connection:
+            row = connection.execute("SELECT PlayerID FROM Players WHERE PName = ?", (break_up[1],)).fetchone()
+        if row is not None:
+            return row[0] % shards
+    # unknown players and other requests are answered, and rejected, by the first worker
+    return 0
+
+
+def dispatch_client(client_socket, addr, db, workers, pending):
+    try:
+        client_socket.settimeout(HANDOFF_TIMEOUT)
+        reader = protocol.FrameReader()
+        received = bytearray()
+        frame = None
+        while frame is None:
+            data = client_socket.recv(protocol.RECV_SIZE)
+            if not data:
+                return
+            received += data
+            reader.feed(data)
+            frame = reader.next_frame()
+        client_socket.settimeout(None)
+        pipe, lock = workers[route(first_request(frame), db, len(workers))]
+        # everything read so far goes along, the worker handles it before reading from the socket itself
+        with lock:
+            pipe.send((client_socket, bytes(received)))
     except Exception as e:
-        print(f"Error: {e}")
+        logs.event(log, "dispatch_failed", logging.WARNING, addr=f"{addr[0]}:{addr[1]}", error=e)
     finally:
-        server.close()
+        # the worker has its own copy of the socket by now
+        client_socket.close()
+        pending.release()
+
+
+async def adopt_client(sock, received, executor, state):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    reader.feed_data(received)
+    transport, stream_protocol = await loop.create_connection(lambda: asyncio.StreamReaderProtocol(reader), sock=sock)
+    writer = asyncio.StreamWriter(transport, stream_protocol, reader, loop)
+    await handle_client_async(reader, writer, executor, state)
+
+
+def receive_handoffs(pipe, loop, adopt, closed):
+    while True:
+        try:
+            sock, received = pipe.recv()
+        except (EOFError, OSError):
+            break
+        loop.call_soon_threadsafe(adopt, sock, received)
+    loop.call_soon_threadsafe(closed.set)
+
+
+async def serve_handoffs(pipe, db_workers, state, shard):
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix="db")
+    closed = asyncio.Event()
+    # the event loop only keeps weak references to tasks, the client tasks are kept alive here
+    clients = set()
+
+    def adopt(sock, received):
+        task = loop.create_task(adopt_client(sock, received, executor, state))
+        clients.add(task)
+        task.add_done_callback(clients.discard)
+
+    threading.Thread(target=receive_handoffs, args=(pipe, loop, adopt, closed), name="handoffs", daemon=True).start()
+    logs.event(log, "worker_ready", shard=shard[0], shards=shard[1], db_workers=db_workers)
+    try:
+        # runs until the dispatcher goes away
+        await closed.wait()
+    finally:
+        executor.shutdown(wait=False)
+
+
+def run_worker(pipe, shard, db_path, db_workers, db_readers, state_options, log_options):
+    global DB_PATH
+    DB_PATH = db_path
+    if log_options is not None:
+        logs.setup(**log_options)
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    # Ctrl+C reaches the whole process group, the dispatcher stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    state = ServerState(ConnectionManager(connect_db, readers=db_readers), shard=shard, **state_options)
+    state.start()
+    try:
+        asyncio.run(serve_handoffs(pipe, db_workers, state, shard))
+    except (KeyboardInterrupt, SystemExit):
+        logs.event(log, "worker_stopped", shard=shard[0])
+    finally:
+        state.close()
+        logs.shutdown()
+
+
+def run_sharded_server(server_ip="127.0.0.1", port=8000, workers=2, db_workers=4, db_readers=4, log_options=None,
+                       backlog=BACKLOG, **state_options):
+    server = None
+    processes = []
+    # the dispatcher only reads, to look up which worker a player belongs to
+    db = ConnectionManager(connect_db, readers=2)
+    if state_options.get("journal_dir"):
+        # the journal and its snapshots describe one process writing the whole database
+        logs.event(log, "journal_disabled", logging.WARNING, reason="not supported with several workers")
+        state_options = dict(state_options, journal_dir=None)
+    try:
+        # migrate once, before the workers open the file
+        with db.writer() as connection:
+            migrations.migrate(connection)
+        pipes = []
+        for index in range(workers):
+            options = dict(state_options)
+            if options.get("metrics_port") is not None:
+                # one endpoint per worker, on consecutive ports
+                options["metrics_port"] += index
+            worker_log = dict(log_options) if log_options is not None else None
+            if worker_log is not None and worker_log.get("path"):
+                # a log file per worker, so lines of different processes never interleave
+                worker_log["path"] += f".{index}"
+            parent_end, child_end = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(child_end, (index, workers), DB_PATH, db_workers, db_readers, options, worker_log),
+                name=f"worker-{index}")
+            process.start()
+            child_end.close()
+            processes.append(process)
+            pipes.append((parent_end, threading.Lock()))
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind((server_ip, port))
+        server.listen(backlog)
+        logs.event(log, "listening", address=f"{server_ip}:{port}", mode="sharded", workers=workers)
+        # clients still waiting to be handed off, each of them holds a dispatcher thread
+        pending = threading.BoundedSemaphore(backlog)
+        while True:
+            client_socket, addr = server.accept()
+            logs.event(log, "connect", addr=f"{addr[0]}:{addr[1]}")
+            if not pending.acquire(blocking=False):
+                logs.event(log, "busy", logging.WARNING, addr=f"{addr[0]}:{addr[1]}")
+                try:
+                    client_socket.sendall(protocol.encode_frame(BUSY))
+                except OSError:
+                    pass
+                client_socket.close()
+                continue
+            threading.Thread(target=dispatch_client, args=(client_socket, addr, db, pipes, pending),
+                             daemon=True).start()
+    except (KeyboardInterrupt, SystemExit):
+        logs.event(log, "stopped")
+    except Exception as e:
+        logs.event(log, "server_failed", logging.ERROR, error=e)
+    finally:
+        if server is not None:
+            server.close()
+        for process in processes:
+            # workers write their cached state out on SIGTERM, like a single process server
+            process.terminate()
+        for process in processes:
+            process.join()
+        db.close()
 
 
 def calc_changes(db, pid):
-    producers = [
-        "plantation",
-        "power_plant",
-        "abyssal_ore_refinery"
-    ]
-    food_change = 0
-    energy_change = 0
-    steel_change = 0
     querier = db.cursor()
-    querier.execute("SELECT * FROM Buildings WHERE PlayerID = ?", (pid,))
-    data = querier.fetchall()
-    for arrays in data:
-        for producer in producers:
-            if arrays[2] == producer:
-                if arrays[2] == "plantation":
-                    food_change += 5
-                if arrays[2] == "power_pant":
-                    energy_change += 100
-                if arrays[2] == "abyssal_ore_refinery":
-                    steel_change += 15
+    querier.execute("SELECT BuildingName, BuildingLevel FROM Buildings WHERE PlayerID = ?", (pid,))
+    food_change, steel_change, energy_change = economy.building_rates(querier.fetchall())
     querier.close()
-    print(food_change, steel_change, energy_change)
+    logs.event(log, "production", logging.DEBUG, pid=pid, food=food_change, steel=steel_change, energy=energy_change)
     commit_pid_changes(db, pid, food_change, steel_change, energy_change)
 
 
@@ -158,14 +1096,124 @@ def commit_pid_changes(db,pid, food_change, steel_change, energy_change):
     querier = db.cursor()
     querier.execute("SELECT * FROM Players WHERE PlayerID = ?", (pid,))
     data = querier.fetchone()
-    print(data[3])
     food = int(data[3]) + food_change
     steel = int(data[4]) + steel_change
     energy = int(data[5]) + energy_change
-    print(food, energy, steel)
     querier.execute("UPDATE Players SET Food = ?, Metal = ?, Energy = ? WHERE PlayerID = ?", (food, steel, energy, pid,))
-    db.commit()
-    print("commited")
+    # committed by the ConnectionManager writer block around the request
+
+
+def exit_on_signal(signum, frame):
+    # a terminated server shuts down like an interrupted one, so the cached state is written out,
+    # and a second signal must not cut that short
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
+
+def positive_seconds(text):
+    seconds = float(text)
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError(f"{text} is not a positive number of seconds")
+    return seconds
+
+
+def push_seconds(text):
+    seconds = float(text)
+    if seconds < MIN_PUSH_SECONDS:
+        raise argparse.ArgumentTypeError(f"{text} is below the {MIN_PUSH_SECONDS} second minimum")
+    return seconds
+
+
+def main():
+    global DB_PATH
+    parser = argparse.ArgumentParser(description="Leviathans legacy game server")
+    parser.add_argument("--mode", choices=["asyncio", "threaded"], default="asyncio",
+                        help="asyncio serves every client from one event loop, threaded starts a thread per client")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes for the asyncio mode, players are split between them by PlayerID")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--db", default=DB_PATH, help="path of the SQLite database")
+    parser.add_argument("--db-workers", type=int, default=4,
+                        help="size of the database executor used by the asyncio mode")
+    parser.add_argument("--db-readers", type=int, default=4, help="reader connections in the shared pool")
+    parser.add_argument("--economy", choices=["lazy", "tick", "poll"], default="lazy",
+                        help="lazy computes resources when read, tick produces on a server timer, "
+                             "poll produces when a client sends update")
+    parser.add_argument("--tick-seconds", type=positive_seconds, default=economy.PRODUCTION_PERIOD,
+                        help="interval of the economy tick")
+    parser.add_argument("--push-seconds", type=push_seconds, default=PUSH_SECONDS,
+                        help="interval of the resource pushes to subscribed clients")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="answer every request from SQLite instead of the in memory player cache")
+    parser.add_argument("--cache-idle-seconds", type=float, default=300.0,
+                        help="players untouched for this long are dropped from the cache")
+    parser.add_argument("--flush-seconds", type=float, default=1.0,
+                        help="interval of the cache write-behind to SQLite")
+    parser.add_argument("--session-ttl", type=float, default=DEFAULT_TTL,
+                        help="seconds an unused session token can still be resumed")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on http://127.0.0.1:<port>/metrics")
+    parser.add_argument("--build-time-scale", type=float, default=1.0,
+                        help="multiplier of the build and upgrade times, e.g. 0.01 for a test server")
+    parser.add_argument("--journal-dir", default=None,
+                        help="append every game action to a journal in this directory and snapshot the database")
+    parser.add_argument("--snapshot-seconds", type=float, default=journal.SNAPSHOT_SECONDS,
+                        help="interval of the database snapshots next to the journal")
+    parser.add_argument("--compress-threshold", type=int, default=protocol.COMPRESS_THRESHOLD,
+                        help="compress messages from this many bytes on for clients that ask for it")
+    parser.add_argument("--no-compression", action="store_true", help="never compress, whatever clients ask for")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="open connections per process, further clients are answered busy")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds a client may stay silent between requests")
+    parser.add_argument("--read-timeout", type=float, default=READ_TIMEOUT,
+                        help="seconds a client may take to send the rest of a request")
+    parser.add_argument("--backlog", type=int, default=BACKLOG,
+                        help="pending connections queued for accept")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--log-json", action="store_true", help="write one JSON object per log line")
+    parser.add_argument("--log-file", default=None, help="write the log to this file instead of stdout")
+    parser.add_argument("--log-sample", default="command=100",
+                        help="keep 1 in N of these events, e.g. command=100,connect=10")
+    args = parser.parse_args()
+    DB_PATH = args.db
+    log_options = {
+        "level": args.log_level,
+        "json_output": args.log_json,
+        "path": args.log_file,
+        "samples": logs.parse_samples(args.log_sample),
+    }
+    logs.setup(**log_options)
+    state_options = {
+        "economy_mode": args.economy,
+        "tick_seconds": args.tick_seconds,
+        "push_seconds": args.push_seconds,
+        "use_cache": not args.no_cache,
+        "cache_idle_seconds": args.cache_idle_seconds,
+        "flush_seconds": args.flush_seconds,
+        "metrics_port": args.metrics_port,
+        "session_ttl": args.session_ttl,
+        "max_connections": args.max_connections,
+        "idle_timeout": args.idle_timeout,
+        "read_timeout": args.read_timeout,
+        "build_time_scale": args.build_time_scale,
+        "journal_dir": args.journal_dir,
+        "snapshot_seconds": args.snapshot_seconds,
+        "compress_threshold": None if args.no_compression else args.compress_threshold,
+    }
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    try:
+        if args.mode == "threaded":
+            run_server(args.host, args.port, args.db_readers, args.backlog, **state_options)
+        elif args.workers > 1:
+            run_sharded_server(args.host, args.port, args.workers, args.db_workers, args.db_readers, log_options,
+                               args.backlog, **state_options)
+        else:
+            run_async_server(args.host, args.port, args.db_workers, args.db_readers, args.backlog, **state_options)
+    finally:
+        logs.shutdown()
 
 
-run_server()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Session tokens, so a reconnecting client skips the login query and password check.
+
+A successful login answers `accepted <token>`. A client that lost its connection sends `resume <token>` on the new
+one and gets its player back from the in memory table. Tokens expire after `ttl` seconds without use and are lost
+when the server restarts, the client then falls back to a normal login.
+
+Tokens start with the shard of the worker that issued them, `<shard>.<random>`, so a sharded server can route a
+resume to the worker holding the session.
+"""
+import secrets
+import threading
+import time
+
+DEFAULT_TTL = 3600.0
+# expired sessions are dropped every this many logins, resume checks the expiry itself
+PURGE_EVERY = 1000
+
+
+class Session:
+    def __init__(self, pid, username, expires):
+        self.pid = pid
+        self.username = username
+        self.expires = expires
+
+
+def token_shard(token):
+    """Shard index a token was issued by, 0 for tokens without a valid prefix."""
+    prefix, _, _ = token.partition(".")
+    return int(prefix) if prefix.isdigit() else 0
+
+
+class SessionTable:
+    def __init__(self, ttl=DEFAULT_TTL, shard=0):
+        self.ttl = ttl
+        self.shard = shard
+        self.sessions = {}
+        self.lock = threading.RLock()
+        self.issued = 0
+        self.resumed = 0
+        self.expired = 0
+
+    def issue(self, pid, username, now=None):
+        now = now or time.monotonic()
+        token = f"{self.shard}.{secrets.token_urlsafe(24)}"
+        with self.lock:
+            self.sessions[token] = Session(pid, username, now + self.ttl)
+            self.issued += 1
+            if self.issued % PURGE_EVERY == 0:
+                self.purge(now)
+        return token
+
+    def resume(self, token, now=None):
+        """The Session of a valid token with its expiry pushed back, or None."""
+        now = now or time.monotonic()
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is None:
+                return None
+            if session.expires < now:
+                del self.sessions[token]
+                self.expired += 1
+                return None
+            session.expires = now + self.ttl
+            self.resumed += 1
+            return session
+
+    def revoke(self, token):
+        with self.lock:
+            self.sessions.pop(token, None)
+
+    def purge(self, now=None):
+        now = now or time.monotonic()
+        with self.lock:
+            expired = [token for token, session in self.sessions.items() if session.expires < now]
+            for token in expired:
+                del self.sessions[token]
+            self.expired += len(expired)
+        return len(expired)
+
+    def stats(self):
+        return {"sessions": len(self.sessions), "issued": self.issued, "resumed": self.resumed,
+                "expired": self.expired}
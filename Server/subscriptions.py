@@ -0,0 +1,104 @@
+"""Server to client pushes of resource and building changes.
+
+A client sends `subscribe` once, after that the server pushes compact text messages on its own:
+
+    resources <food> <steel> <energy>
+    building <hexagon no> <building name> <level>
+
+Resources are checked on every hub tick and only pushed when they changed since the last push to that client,
+buildings are pushed as soon as they are written.
+"""
+import logging
+import threading
+import time
+
+import logs
+
+log = logs.get_logger("subscriptions")
+
+
+class Subscriber:
+    def __init__(self, pid, push):
+        self.pid = pid
+        # thread safe callable sending one push message to the client
+        self.push = push
+        self.last_resources = None
+
+
+class SubscriptionHub:
+    def __init__(self, read_resources, interval=5.0):
+        # read_resources(pids) returns {pid: (food, steel, energy)} for the given players
+        self.read_resources = read_resources
+        self.interval = interval
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="subscriptions", daemon=True)
+        self.pushes = 0
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def subscribe(self, pid, push):
+        subscriber = Subscriber(pid, push)
+        with self.lock:
+            self.subscribers.setdefault(pid, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(subscriber.pid)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers[subscriber.pid]
+
+    def snapshot(self, pid=None):
+        with self.lock:
+            if pid is not None:
+                return list(self.subscribers.get(pid, ()))
+            return [subscriber for subscribers in self.subscribers.values() for subscriber in subscribers]
+
+    def send(self, subscriber, message):
+        try:
+            subscriber.push(message)
+            self.pushes += 1
+        except Exception as e:
+            # the connection handler notices the broken socket and unsubscribes on its way out
+            logs.event(log, "push_failed", logging.WARNING, pid=subscriber.pid, error=e)
+
+    def publish_building(self, pid, hexagon_no, building_name, level):
+        for subscriber in self.snapshot(pid):
+            self.send(subscriber, f"building {hexagon_no} {building_name} {level}")
+
+    def publish_resources(self, subscribers=None):
+        """Push the resources of every subscriber whose numbers changed since its last push."""
+        subscribers = self.snapshot() if subscribers is None else subscribers
+        if not subscribers:
+            return 0
+        resources = self.read_resources({subscriber.pid for subscriber in subscribers})
+        pushed = 0
+        for subscriber in subscribers:
+            current = resources.get(subscriber.pid)
+            if current is not None and current != subscriber.last_resources:
+                subscriber.last_resources = current
+                self.send(subscriber, "resources %d %d %d" % current)
+                pushed += 1
+        return pushed
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            t0 = time.perf_counter()
+            try:
+                pushed = self.publish_resources()
+            except Exception as e:
+                logs.event(log, "publish_failed", logging.ERROR, error=e)
+                continue
+            if pushed:
+                logs.event(log, "resources_pushed", logging.DEBUG, clients=pushed,
+                           ms=round((time.perf_counter() - t0) * 1000, 2))
@@ -0,0 +1,56 @@
+"""Version numbers of every player's buildings, so clients only download the hexagons that changed.
+
+Each write of a building moves the player's version up by one and remembers it for that hexagon. A client keeps
+the version of the buildings it has and asks for the changes since then:
+
+    buildings_since <epoch> <version>    -> unchanged
+                                          -> delta <epoch> <version>^^<pid>, <no>, <name>, <level>^^...
+                                          -> full <epoch> <version>^^<pid>, <no>, <name>, <level>^^...
+
+The versions are kept in memory, the epoch is drawn when the server starts, so a client holding a version of an
+earlier run or of another worker gets the full list once instead of a wrong delta. Version 0 means nothing synced.
+"""
+import secrets
+import threading
+
+
+class BuildingVersions:
+    def __init__(self, epoch=None):
+        self.epoch = epoch if epoch is not None else secrets.randbelow(2 ** 31 - 1) + 1
+        # pid -> [version, {building no: version it last changed at}]
+        self.players = {}
+        self.lock = threading.Lock()
+        self.full_syncs = 0
+        self.delta_syncs = 0
+        self.unchanged_syncs = 0
+
+    def version(self, pid):
+        """Current version of a player's buildings, a player seen for the first time starts at 1."""
+        with self.lock:
+            return self.players.setdefault(pid, [1, {}])[0]
+
+    def changed(self, pid, building_no):
+        """Count a building write, call it after the write so a client never gets the new version with old rows."""
+        with self.lock:
+            player = self.players.setdefault(pid, [1, {}])
+            player[0] += 1
+            player[1][building_no] = player[0]
+            return player[0]
+
+    def since(self, pid, epoch, version):
+        """(current version, building numbers changed after version), or (current version, None) for a full sync."""
+        with self.lock:
+            current, hexagons = self.players.setdefault(pid, [1, {}])
+            if epoch != self.epoch or not 0 < version <= current:
+                self.full_syncs += 1
+                return current, None
+            changed = {building_no for building_no, changed_at in hexagons.items() if changed_at > version}
+            if changed:
+                self.delta_syncs += 1
+            else:
+                self.unchanged_syncs += 1
+            return current, changed
+
+    def stats(self):
+        return {"players": len(self.players), "full": self.full_syncs, "delta": self.delta_syncs,
+                "unchanged": self.unchanged_syncs}
@@ -0,0 +1,109 @@
+"""Hex world map with every player's city on it.
+
+Cities sit on an axial coordinate (q, r) grid. Their place follows from the PlayerID, player 1 in the middle and
+everyone after on a spiral around it, so every worker process agrees on the map without storing or coordinating
+positions. The map is kept in buckets of CHUNK_SIZE x CHUNK_SIZE axial coordinates, a viewport or range query
+only looks at the buckets it overlaps and a client only asks for the chunks it can see:
+
+    map_home                         -> <q> <r> of the player's own city
+    map_chunk <chunk q> <chunk r>    -> <pid>, <name>, <q>, <r>^^ for each city in the chunk
+    map_near <radius>                -> the same for the cities at most radius hexes from the own city
+
+The module has no server dependencies, the client uses it to work out which chunks a viewport covers.
+"""
+import math
+import threading
+
+# axial coordinates per side of a chunk
+CHUNK_SIZE = 16
+# hexes between neighbouring cities, so every city has room around it
+CITY_SPACING = 3
+# cities in a map_near reply at most, and the largest radius looked at
+NEAR_LIMIT = 200
+MAX_NEAR_RADIUS = 8 * CHUNK_SIZE
+# the six neighbours in axial coordinates, in the order a spiral ring walks them
+DIRECTIONS = [(1, 0), (1, -1), (0, -1), (-1, 0), (-1, 1), (0, 1)]
+
+
+def spiral_position(index):
+    """Axial (q, r) of the index-th hex of a spiral around (0, 0), in O(1)."""
+    if index <= 0:
+        return 0, 0
+    # ring n holds 6n hexes and ends at index 3n(n+1)
+    ring = (math.isqrt(12 * index - 3) - 3) // 6
+    while 3 * ring * (ring + 1) < index:
+        ring += 1
+    offset = index - 3 * ring * (ring - 1) - 1
+    side, step = divmod(offset, ring)
+    q, r = DIRECTIONS[4][0] * ring, DIRECTIONS[4][1] * ring
+    for direction in DIRECTIONS[:side]:
+        q, r = q + direction[0] * ring, r + direction[1] * ring
+    return q + DIRECTIONS[side][0] * step, r + DIRECTIONS[side][1] * step
+
+
+def city_position(pid):
+    q, r = spiral_position(pid - 1)
+    return q * CITY_SPACING, r * CITY_SPACING
+
+
+def chunk_of(q, r):
+    return q // CHUNK_SIZE, r // CHUNK_SIZE
+
+
+def chunks_in_view(q0, r0, q1, r1):
+    """Chunks overlapping the axial rectangle from (q0, r0) to (q1, r1)."""
+    first_q, first_r = chunk_of(min(q0, q1), min(r0, r1))
+    last_q, last_r = chunk_of(max(q0, q1), max(r0, r1))
+    return [(cq, cr) for cq in range(first_q, last_q + 1) for cr in range(first_r, last_r + 1)]
+
+
+def hex_distance(q0, r0, q1, r1):
+    dq, dr = q0 - q1, r0 - r1
+    return (abs(dq) + abs(dr) + abs(dq + dr)) // 2
+
+
+class WorldMap:
+    def __init__(self):
+        # pid -> (q, r, name)
+        self.cities = {}
+        # (chunk q, chunk r) -> {pid: (q, r, name)}
+        self.chunks = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.cities)
+
+    def load(self, connection):
+        """Place every player, returns the number of cities."""
+        for pid, name in connection.execute("SELECT PlayerID, PName FROM Players"):
+            self.add(pid, name)
+        return len(self.cities)
+
+    def add(self, pid, name):
+        q, r = city_position(pid)
+        with self.lock:
+            self.cities[pid] = (q, r, name)
+            self.chunks.setdefault(chunk_of(q, r), {})[pid] = (q, r, name)
+        return q, r
+
+    def home(self, pid):
+        city = self.cities.get(pid)
+        return None if city is None else city[:2]
+
+    def chunk(self, cq, cr):
+        """[(pid, name, q, r), ...] of the cities in one chunk."""
+        with self.lock:
+            return [(pid, name, q, r) for pid, (q, r, name) in self.chunks.get((cq, cr), {}).items()]
+
+    def near(self, q, r, radius, limit=NEAR_LIMIT):
+        """Cities at most radius hexes from (q, r), nearest first."""
+        radius = min(radius, MAX_NEAR_RADIUS)
+        found = []
+        with self.lock:
+            for key in chunks_in_view(q - radius, r - radius, q + radius, r + radius):
+                for pid, (city_q, city_r, name) in self.chunks.get(key, {}).items():
+                    distance = hex_distance(q, r, city_q, city_r)
+                    if distance <= radius:
+                        found.append((distance, pid, name, city_q, city_r))
+        found.sort()
+        return [city[1:] for city in found[:limit]]
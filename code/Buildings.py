@@ -53,24 +53,23 @@ class Buildings(AbstractBuilding):
             # pygame.time.set_timer(pygame.USEREVENT, self.build_time * 1000)
             self.buyable = False
 
-    def check_upgrade(self):
-        if self.upgrade_end_time and time.time() >= self.upgrade_end_time:
-            self.upgrade_end_time = None
-            print("Upgrade complete!")
-
     def get_remaining_upgrade_time(self):
         if self.upgrade_end_time:
             return max(0, int(self.upgrade_end_time - time.time()))
         return 0
 
-    def upgrade(self):
+    def upgrade(self, seconds=None):
+        # the server runs the upgrade timer, the stage only goes up when it reports the upgrade as finished
         if self.upgrade_possible and mplayer.steel >= self.build_cost:
             if self.upgrade_end_time == 0 or self.upgrade_end_time == None:
                 mplayer.steel -= self.build_cost
-                self.building_stage += 1
                 self.increase_of_price()
                 self.build_time *= self.increase_rate_of_build_time
-                self.upgrade_end_time = time.time() + self.build_time
+                self.upgrade_end_time = time.time() + (self.build_time if seconds is None else seconds)
+
+    def finish_upgrade(self, building_stage):
+        self.building_stage = building_stage
+        self.upgrade_end_time = None
 
     def demolish(self):
         if self.building_stage > 0:
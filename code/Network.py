@@ -0,0 +1,88 @@
+import queue
+import threading
+
+from Player import ServerUnavailable
+
+# seconds the network thread waits for a request before it looks for server pushes
+POLL_SECONDS = 0.05
+
+
+class NetworkWorker:
+    """Runs the player's server requests on a background thread, so a slow server never holds up a frame.
+
+    The render loop hands requests in with submit and calls drain once per frame, which runs the callbacks of the
+    requests that finished. Between requests the thread reads what the server pushed to a subscribed player.
+    """
+
+    def __init__(self, player, poll_seconds=POLL_SECONDS):
+        self.player = player
+        self.poll_seconds = poll_seconds
+        # (call, on_result, on_error, key) for the network thread, None stops it
+        self.outbound = queue.Queue()
+        # (callback, value) for the render thread
+        self.inbound = queue.Queue()
+        # keys of the requests queued or running, a request with the same key is not sent twice
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="network", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout=1.0):
+        self.outbound.put(None)
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def submit(self, call, on_result=None, on_error=None, key=None):
+        """Queue call(), returns False when a request with the same key is still waiting for its reply."""
+        if key is not None:
+            with self.lock:
+                if key in self.in_flight:
+                    return False
+                self.in_flight.add(key)
+        self.outbound.put((call, on_result, on_error, key))
+        return True
+
+    def drain(self):
+        """Run the callbacks of finished requests on the calling thread, returns how many ran.
+
+        A request that found the server gone raises its ServerUnavailable here, so the render thread ends the game.
+        """
+        handled = 0
+        while True:
+            try:
+                callback, value = self.inbound.get_nowait()
+            except queue.Empty:
+                return handled
+            if isinstance(value, ServerUnavailable):
+                raise value
+            callback(value)
+            handled += 1
+
+    def run(self):
+        while True:
+            try:
+                request = self.outbound.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                if self.player.subscribed:
+                    self.player.poll_updates()
+                continue
+            if request is None:
+                return
+            call, on_result, on_error, key = request
+            try:
+                result = call()
+            except Exception as e:
+                self.inbound.put((on_error or report_error, e))
+            else:
+                if on_result is not None:
+                    self.inbound.put((on_result, result))
+            finally:
+                if key is not None:
+                    with self.lock:
+                        self.in_flight.discard(key)
+
+
+def report_error(error):
+    print(f"Request to the server failed: {error}")
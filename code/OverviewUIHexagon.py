@@ -3,9 +3,13 @@ import pygame
 import math
 from Buildings import Plantation, PowerPlant, Cabins, Barracks, AbyssalOreRefinery, DefensiveDome
 from Buildings import BuildingFactory
-from Player import mplayer
+from Player import mplayer, ServerUnavailable
+# Player puts the Server directory on the path, the chunk layout of the world map is shared with the server
+import worldmap
 from Soldiers import Army
+from Network import NetworkWorker
 import datetime
+import time
 
 
 next_hexagon_id = 0
@@ -75,7 +79,7 @@ def hexagon_update_action(func):
         if selected:
             building_type = type(selected).__name__.lower().replace(' ', '_')
             building_stage = selected.building_stage + 1
-            mplayer.commit_building(hexagon_id, building_type, building_stage)
+            mplayer.in_background(lambda: mplayer.commit_building(hexagon_id, building_type, building_stage))
             print(f"Sent update to server for Hexagon ID {hexagon_id}: {building_type}, Level: {building_stage}")
 
         return result
@@ -94,7 +98,7 @@ def hexagon_downgrade_action(func):
             if selected.building_stage > 0 :
                 building_type = type(selected).__name__.lower().replace(' ', '_')
                 building_stage = selected.building_stage - 1
-                mplayer.commit_building(hexagon_id, building_type, building_stage)
+                mplayer.in_background(lambda: mplayer.commit_building(hexagon_id, building_type, building_stage))
                 print(f"Sent update to server for Hexagon ID {hexagon_id}: {building_type}, Level: {building_stage}")
 
         return result
@@ -250,8 +254,7 @@ class Popup:
             if self.selected_hexagon and self.selected_hexagon.building:
                 # Check if upgrade or demolish buttons were clicked
                 if self.upgrade_button_rect.collidepoint(event.pos) and self.selected_hexagon.building.upgrade_possible:
-                    self.log_building_change(self.selected_hexagon.id, self.selected_hexagon.building)
-                    self.selected_hexagon.building.upgrade()
+                    self.request_upgrade(self.selected_hexagon.id, self.selected_hexagon.building)
                     return True
 
                 if self.demolish_button_rect.collidepoint(event.pos):
@@ -273,6 +276,21 @@ class Popup:
                     return True
         return False
 
+    def request_upgrade(self, hexagon_index, building):
+        """Start the upgrade on the server, the new stage arrives with the server's building update."""
+        if building.upgrade_end_time or mplayer.steel < building.build_cost:
+            return
+        building_type = type(building).__name__.lower().replace(' ', '_')
+        level = building.building_stage + 1
+
+        def started(seconds):
+            if seconds is not None:
+                building.upgrade(seconds)
+
+        # a second click while the server has not answered yet is ignored by the key
+        mplayer.in_background(lambda: mplayer.upgrade_building(hexagon_index, building_type, level), started,
+                              key=("upgrade", hexagon_index))
+
     @hexagon_update_action
     def log_building_change(self, hexagon_index, selected):
         """Log building changes to the server. This method is a placeholder for actual server communication logic."""
@@ -295,9 +313,7 @@ class Popup:
         self.visible = True
 
     def update(self):
-        """Update the popup content and draw it if visible."""
-        if self.visible and self.selected_hexagon and self.selected_hexagon.building:
-            self.selected_hexagon.building.check_upgrade()
+        """Draw the popup if visible, upgrades finish through the server's building updates."""
         self.draw()
 
 class ArmyPopup:
@@ -364,6 +380,7 @@ class ArmyPopup:
                         if uid == unit_id:
                             count = int(input_box.text) if input_box.text.isdigit() else 0
                             self.mplayer.army.add_soldier(unit_id, count)
+                            self.mplayer.army.send_army_info_to_server()
                             self.update_unit_count_label(unit_id)
                             input_box.text = ""
                             input_box.txt_surface = input_box.font.render(input_box.text, True, input_box.color)
@@ -414,6 +431,177 @@ class ArmyPopup:
             self.draw()
 
 
+class LeaderboardPopup:
+    """One page of the server's leaderboard, the next page is only fetched when the player asks for it."""
+    def __init__(self, screen, rect, mplayer, page_size=10, bg_color=(200, 200, 200)):
+        self.screen = screen
+        self.rect = rect
+        self.mplayer = mplayer
+        self.page_size = page_size
+        self.bg_color = bg_color
+        self.font = pygame.font.Font(None, 24)
+        self.visible = False
+        self.start = 1
+        self.rows = []
+        self.own_rank = None
+        self.close_button_rect = pygame.Rect(self.rect.right - 30, self.rect.top, 30, 30)
+        self.previous_button_rect = pygame.Rect(self.rect.x + 10, self.rect.bottom - 40, 100, 30)
+        self.next_button_rect = pygame.Rect(self.rect.right - 110, self.rect.bottom - 40, 100, 30)
+
+    def open(self):
+        self.start = 1
+        self.load_page(1)
+        self.visible = True
+
+    def load_page(self, start):
+        # the page shows once the reply is there, until then the popup keeps the one it has
+        def loaded(page):
+            self.start, self.rows, self.own_rank = start, page[0], page[1]
+
+        def failed(error):
+            print(f"Could not load the leaderboard: {error}")
+
+        self.mplayer.in_background(
+            lambda: (self.mplayer.get_leaderboard(start, self.page_size), self.mplayer.get_rank()), loaded, failed,
+            key="leaderboard")
+
+    def draw(self):
+        if not self.visible:
+            return
+
+        pygame.draw.rect(self.screen, self.bg_color, self.rect)
+        if self.own_rank:
+            rank, score, players = self.own_rank
+            own_text = self.font.render(f"Your rank: {rank} of {players} ({score})", True, (0, 0, 0))
+            self.screen.blit(own_text, (self.rect.x + 10, self.rect.y + 10))
+        for i, (rank, name, score) in enumerate(self.rows):
+            row_text = self.font.render(f"{rank}. {name}  {score}", True, (0, 0, 0))
+            self.screen.blit(row_text, (self.rect.x + 10, self.rect.y + 40 + i * 28))
+
+        for label, button_rect in (("Previous", self.previous_button_rect), ("Next", self.next_button_rect)):
+            pygame.draw.rect(self.screen, (0, 120, 150), button_rect)
+            self.screen.blit(self.font.render(label, True, (255, 255, 255)), (button_rect.x + 5, button_rect.y + 5))
+
+        close_text = self.font.render('X', True, (255, 255, 255))
+        pygame.draw.rect(self.screen, (255, 0, 0), self.close_button_rect)
+        self.screen.blit(close_text, (self.close_button_rect.x + 5, self.close_button_rect.y + 5))
+
+    def handle_event(self, event):
+        if not self.visible:
+            return False
+
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            if self.close_button_rect.collidepoint(event.pos):
+                self.visible = False
+                return True
+            if self.previous_button_rect.collidepoint(event.pos) and self.start > 1:
+                self.load_page(max(1, self.start - self.page_size))
+                return True
+            if self.next_button_rect.collidepoint(event.pos) and len(self.rows) == self.page_size:
+                self.load_page(self.start + self.page_size)
+                return True
+        return False
+
+class WorldMapPopup:
+    """Part of the world map around our city, only the chunks in view are fetched and each one only once."""
+    def __init__(self, screen, rect, mplayer, hex_size=10, bg_color=(20, 40, 70)):
+        self.screen = screen
+        self.rect = rect
+        self.mplayer = mplayer
+        self.hex_size = hex_size
+        self.bg_color = bg_color
+        self.font = pygame.font.Font(None, 18)
+        self.visible = False
+        self.home = None
+        # axial coordinates shown in the middle of the popup
+        self.center = (0, 0)
+        # (chunk q, chunk r) -> [(pid, name, q, r), ...]
+        self.chunks = {}
+        # chunks asked for whose reply is not there yet
+        self.requested = set()
+        self.close_button_rect = pygame.Rect(self.rect.right - 30, self.rect.top, 30, 30)
+
+    def open(self):
+        def placed(home):
+            self.home = home
+            self.center = home or (0, 0)
+            self.load_visible_chunks()
+
+        def failed(error):
+            print(f"Could not load the world map: {error}")
+
+        self.center = self.home or (0, 0)
+        self.visible = True
+        self.mplayer.in_background(self.mplayer.get_home, placed, failed, key="map_home")
+
+    def to_screen(self, q, r):
+        # flat topped hexes
+        x = self.hex_size * 1.5 * (q - self.center[0])
+        y = self.hex_size * math.sqrt(3) * ((r - self.center[1]) + (q - self.center[0]) / 2)
+        return self.rect.centerx + x, self.rect.centery + y
+
+    def view(self):
+        """Axial rectangle covering the popup."""
+        q_span = int(self.rect.width / 2 / (self.hex_size * 1.5)) + 1
+        r_span = int(self.rect.height / 2 / (self.hex_size * math.sqrt(3))) + q_span // 2 + 1
+        q, r = self.center
+        return q - q_span, r - r_span, q + q_span, r + r_span
+
+    def load_visible_chunks(self):
+        missing = [chunk for chunk in worldmap.chunks_in_view(*self.view())
+                   if chunk not in self.chunks and chunk not in self.requested]
+        if not missing:
+            return
+        self.requested.update(missing)
+
+        def loaded(chunks):
+            self.chunks.update(chunks)
+            self.requested.difference_update(missing)
+
+        def failed(error):
+            print(f"Could not load map chunks: {error}")
+            # asked for again the next time they are in view
+            self.requested.difference_update(missing)
+
+        self.mplayer.in_background(lambda: self.mplayer.get_map_chunks(missing), loaded, failed)
+
+    def pan(self, dq, dr):
+        self.center = (self.center[0] + dq, self.center[1] + dr)
+        self.load_visible_chunks()
+
+    def draw(self):
+        if not self.visible:
+            return
+
+        pygame.draw.rect(self.screen, self.bg_color, self.rect)
+        for chunk in worldmap.chunks_in_view(*self.view()):
+            for pid, name, q, r in self.chunks.get(chunk, ()):
+                x, y = self.to_screen(q, r)
+                if not self.rect.collidepoint(x, y):
+                    continue
+                color = (255, 215, 0) if (q, r) == self.home else (200, 200, 200)
+                pygame.draw.circle(self.screen, color, (int(x), int(y)), self.hex_size // 2 + 2)
+                name_text = self.font.render(name, True, (255, 255, 255))
+                self.screen.blit(name_text, (x + self.hex_size, y - 6))
+
+        close_text = self.font.render('X', True, (255, 255, 255))
+        pygame.draw.rect(self.screen, (255, 0, 0), self.close_button_rect)
+        self.screen.blit(close_text, (self.close_button_rect.x + 10, self.close_button_rect.y + 8))
+
+    def handle_event(self, event):
+        if not self.visible:
+            return False
+
+        if event.type == pygame.MOUSEBUTTONDOWN and self.close_button_rect.collidepoint(event.pos):
+            self.visible = False
+            return True
+        if event.type == pygame.KEYDOWN:
+            moves = {pygame.K_LEFT: (-4, 2), pygame.K_RIGHT: (4, -2), pygame.K_UP: (0, -4), pygame.K_DOWN: (0, 4)}
+            if event.key in moves:
+                self.pan(*moves[event.key])
+                return True
+        return False
+
 
 class OverviewUI:
     def __init__(self, screen, background_filename, mplayer):
@@ -428,6 +616,8 @@ class OverviewUI:
         self.popup = Popup(screen, pygame.Rect(150, 100, 500, 400))
         self.hexagons = self.initialize_hexagons(screen.get_width(), screen.get_height())
         self.army_popup = ArmyPopup(screen, pygame.Rect(200, 150, 500, 400), mplayer)
+        self.leaderboard_popup = LeaderboardPopup(screen, pygame.Rect(200, 100, 400, 400), mplayer)
+        self.world_map_popup = WorldMapPopup(screen, pygame.Rect(100, 80, 600, 460), mplayer)
 
     def initialize_buttons(self):
         labels = ['Account', 'World Map','Army', 'Leaderboard', 'Settings', 'Help', 'Exit']
@@ -516,6 +706,16 @@ class OverviewUI:
                 if any(isinstance(hexagon.building, Barracks) for hexagon in self.hexagons):
                     self.army_popup.visible = True
                     print(f'army popup visible')
+            if button_label == 'Leaderboard':
+                self.leaderboard_popup.open()
+            if button_label == 'World Map':
+                self.world_map_popup.open()
+            if self.world_map_popup.visible:
+                if self.world_map_popup.handle_event(event):
+                    continue
+            if self.leaderboard_popup.visible:
+                if self.leaderboard_popup.handle_event(event):
+                    continue
             if self.army_popup.visible:
                 if self.army_popup.handle_event(event):
                     continue
@@ -525,7 +725,8 @@ class OverviewUI:
                     continue  # Skip other interactions if the popup was interacted with
 
             # Process hexagon clicks only if the popup is not interacting
-            if not self.army_popup.visible and not self.popup.visible:
+            if not self.army_popup.visible and not self.popup.visible and not self.leaderboard_popup.visible \
+                    and not self.world_map_popup.visible:
                 for hexagon in self.hexagons:
                     if hexagon.is_clicked(event):
                         self.popup.selected_hexagon = hexagon
@@ -544,42 +745,65 @@ class OverviewUI:
             hexagon.draw(self.screen)
         self.popup.draw()
         self.army_popup.draw()
+        self.leaderboard_popup.draw()
+        self.world_map_popup.draw()
 
 
     def get_building_in_hexes(self, mplayer):
-        # Fetch data from the server, assuming data is formatted as 'id, building_type, stage'
-        DataFromServer = mplayer.get_buildings()  # Example: ['1, plantation, 1', '']
-        factory = BuildingFactory()  # Assume BuildingFactory can correctly interpret strings like 'plantation' to class instances.
-
-        for data in DataFromServer:
-            if data:  # Skip empty strings
-                details = data.split(',')
-                if len(details) == 4:  # Ensure that there are exactly 3 elements (id, building type, stage)
-                    hex_id = int(details[1].strip())  # Convert ID and strip whitespace
-                    building_type = details[2].strip()  # Strip whitespace from building type
-                    building_stage = int(details[3].strip())  # Convert stage to integer
-
-                    # Find the hexagon with the matching ID and set its building
-                    for hexagon in self.hexagons:
-                        if hexagon.id == hex_id:
-                            hexagon.building = factory.create_building(building_type)
-                            hexagon.building.building_stage = building_stage
-                            break
-                    else:
-                        print(f"Invalid hexagon ID: {hex_id}")
-                else:
-                    print(f"Invalid building data format: {details}")
+        # only the hexagons changed since the last call come from the server, nothing when none changed
+        mplayer.in_background(lambda: fetch_buildings(mplayer), self.apply_buildings, key="buildings")
+
+    def apply_buildings(self, fetched):
+        buildings, jobs = fetched
+        factory = BuildingFactory()
+        for hex_id, building_type, building_stage in buildings:
+            self.set_hexagon_building(hex_id, building_type, building_stage, factory)
+        # upgrades still running on the server, for the time left in the popup
+        for hex_id, building_type, building_stage, seconds in jobs:
+            for hexagon in self.hexagons:
+                if hexagon.id == hex_id and hexagon.building is not None:
+                    hexagon.building.upgrade_end_time = time.time() + seconds
+
+    def set_hexagon_building(self, hex_id, building_type, building_stage, factory=None):
+        # Find the hexagon with the matching ID and set its building
+        factory = factory or BuildingFactory()
+        for hexagon in self.hexagons:
+            if hexagon.id == hex_id:
+                building = factory.create_building(building_type)
+                # keep the existing object, and its running upgrade timer, when only the stage changed
+                if type(hexagon.building) is not type(building):
+                    hexagon.building = building
+                hexagon.building.finish_upgrade(building_stage)
+                break
+        else:
+            print(f"Invalid hexagon ID: {hex_id}")
+
+    def apply_building_updates(self, mplayer):
+        """Show building changes the server pushed since the last frame."""
+        while mplayer.building_updates:
+            hex_id, building_type, building_stage = mplayer.building_updates.pop(0)
+            self.set_hexagon_building(hex_id, building_type, building_stage)
+
+
+def fetch_buildings(mplayer):
+    """(changed buildings, running upgrades) from the server, the upgrades are only read on a full sync."""
+    full, buildings = mplayer.sync_buildings()
+    return buildings, mplayer.get_build_jobs() if full else []
 
 
 def overview_ui(mplayer):
     screen = pygame.display.set_mode((800, 600))
     pygame.display.set_caption("Game Overview UI")
     ui = OverviewUI(screen, 'Hexagon.png', mplayer)
+    # every request goes through the network thread, the frame only picks up the replies that arrived
+    network = NetworkWorker(mplayer)
+    mplayer.network = network
+    network.start()
     ui.get_building_in_hexes(mplayer)
     clock = pygame.time.Clock()
     running = True
-    data = mplayer.get_player_info()
-    print(data)
+    mplayer.in_background(mplayer.get_player_info, print)
+    mplayer.in_background(mplayer.subscribe)
 
     time_passed = 0
     while running:
@@ -591,14 +815,23 @@ def overview_ui(mplayer):
         ui.draw(mplayer)
         pygame.display.flip()
         clock.tick(30)
-        if now.second%5 == 0 and now.second > time_passed:
+        try:
+            network.drain()
+        except ServerUnavailable as e:
+            print(e)
+            break
+        # pushes are read by the network thread while it has nothing else to do
+        ui.apply_building_updates(mplayer)
+        if not mplayer.subscribed and now.second%5 == 0 and now.second > time_passed:
             time_passed = now.second
-            mplayer.update_player()
-            pygame.time.delay(100)
-            mplayer.get_player_info()
-
-
-
+            # a refresh still waiting for its reply is not sent again
+            mplayer.in_background(mplayer.refresh, key="refresh")
+            # without pushes finished upgrades and the popup's edits show up from the server's changes,
+            # an unchanged city costs one short reply
+            ui.get_building_in_hexes(mplayer)
+
+    network.stop()
+    mplayer.network = None
     pygame.quit()
 
 # Uncomment to run
@@ -1,8 +1,24 @@
+import os
+import sys
 import pygame
 import pygame.freetype
 import socket
 from Soldiers import Army
 
+# the wire protocol module is shared with the server
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Server'))
+import protocol
+
+# asked for at login, the server repeats the ones it agreed to
+LOGIN_OPTIONS = [protocol.BINARY, protocol.ZLIB_DICTIONARY]
+# connection attempts one second apart before connect_to_server gives up
+CONNECT_TRIES = 5
+
+
+class ServerUnavailable(ConnectionError):
+    """The server did not accept a connection, the game cannot go on without it."""
+
+
 class Player:
     # Our player info
     def __init__(self, client=None, username=None, password=None):
@@ -13,7 +29,21 @@ class Player:
         self.client = client
         self.__username = username
         self.__password = password
+        # session token from the login, resumed after a reconnect
+        self.token = None
+        # the server agreed at login to send packed replies, see protocol.REPLY_SCHEMAS
+        self.binary = False
         self.army= Army(self)
+        self.subscribed = False
+        # (hexagon no, building name, level) pushed by the server and not yet shown by the UI
+        self.building_updates = []
+        # requests queued between begin_batch and send_batch
+        self.pending_batch = None
+        # version of the buildings we have, the server sends only what changed after it
+        self.buildings_epoch = 0
+        self.buildings_version = 0
+        # Network.NetworkWorker running the requests of the UI, None runs them right away
+        self.network = None
 
     def can_afford(self, food_cost, steel_cost):
         return self.food >= food_cost and self.steel >= steel_cost
@@ -25,43 +55,49 @@ class Player:
     def get_player_info(self):
         p_stats = []
         try:
-            request = "info"
-            self.client.send(request.encode("utf-8")[:1024])
-            received = self.client.recv(1024).decode("utf-8")
-            p_stats = received.split(" ")
-            self.food = int(p_stats[0])
-            self.steel = int(p_stats[1])
-            self.energy = int(p_stats[2])
+            p_stats = self.request_info()
         except Exception as e:
             print(e)
-            self.client = connect_to_server()
-            username = self.__username
-            password = self.__password
-            request = "login" + " " + username + " " + password
-            self.client.send(request.encode("utf-8")[:1024])
-            response = self.client.recv(1024).decode("utf-8")
-            request = "info"
-            self.client.send(request.encode("utf-8")[:1024])
-            received = self.client.recv(1024).decode("utf-8")
-            p_stats = received.split(" ")
-            self.food = int(p_stats[0])
-            self.steel = int(p_stats[1])
-            self.energy = int(p_stats[2])
-        finally:
-            return p_stats
+            # ServerUnavailable goes on to the caller, the game ends when the server is gone
+            self.reconnect()
+            try:
+                p_stats = self.request_info()
+            except Exception as e:
+                print(e)
+        return p_stats
         # sets player stats and returns an array of all stats
 
+    def request_info(self):
+        header, _ = self.request_rows("info", parse_player_info)
+        p_stats = [str(value) for value in header]
+        self.food = int(p_stats[0])
+        self.steel = int(p_stats[1])
+        self.energy = int(p_stats[2])
+        return p_stats
+
     def get_buildings(self):
         request = "info_buildings"
-        self.client.send(request.encode("utf-8")[:1024])
-        received = self.client.recv(1024).decode("utf-8")
-        print(received + " buildings")
-        p_stats = received.split("^^")
+        _, rows = self.request_rows(request, parse_building_rows)
+        # packed rows are tuples, shown the same way as the rows of a text reply
+        p_stats = [row if isinstance(row, str) else ", ".join(str(value) for value in row) for row in rows]
         print(p_stats)
         return p_stats
         # returns array of buildings and their data in the form
         # (1, 1, 'plantation', 1), (1, 2, 'cabins', 1)
 
+    def sync_buildings(self):
+        """Buildings changed since the last sync as (full, [(hexagon no, building name, level), ...]).
+
+        full is True when the server sent every building, the first time or after it restarted.
+        """
+        request = "buildings_since" + " " + str(self.buildings_epoch) + " " + str(self.buildings_version)
+        (mode, epoch, version), rows = self.request_rows(request, parse_building_sync)
+        if mode not in ("full", "delta"):
+            return False, []
+        self.buildings_epoch = epoch
+        self.buildings_version = version
+        return mode == "full", [(building_no, name, level) for pid, building_no, name, level in rows]
+
     def show_food(self):
         return self.get_player_info()[0]
 
@@ -73,47 +109,288 @@ class Player:
         pass
         return self.get_player_info()[2]
 
-    def set_parameters(self, client, username, password):
+    def set_parameters(self, client, username, password, token=None, binary=False):
         self.client = client
         self.__username = username
         self.__password = password
+        self.token = token
+        self.binary = binary
+
+    def in_background(self, call, on_result=None, on_error=None, key=None):
+        """Run call on the network thread, on_result(result) or on_error(error) follow on the render thread.
+
+        Without a network thread, e.g. in the tests, everything runs right away.
+        """
+        if self.network is not None:
+            return self.network.submit(call, on_result, on_error, key)
+        try:
+            result = call()
+        except Exception as e:
+            (on_error or print)(e)
+            return True
+        if on_result is not None:
+            on_result(result)
+        return True
+
+    def request_rows(self, request, parse_text):
+        """Send request and return its (header, rows), unpacked from a binary reply or parse_text of a text one."""
+        self.client.send_text(request)
+        if not self.binary:
+            return parse_text(self.client.recv_text(self.apply_push))
+        msg_type, payload = self.client.recv_reply(self.apply_push)
+        if msg_type == protocol.MSG_BINARY:
+            return protocol.unpack_reply(request.split(" ")[0], payload)
+        return parse_text(payload.decode("utf-8"))
+
+    def reconnect(self):
+        resubscribe = self.subscribed
+        if self.client is not None:
+            self.client.close()
+        self.client = connect_to_server()
+        self.subscribed = False
+        self.sign_in()
+        # the pushes ended with the old connection
+        if resubscribe:
+            self.subscribe()
+
+    def sign_in(self):
+        # resuming the session is a table lookup on the server, the full login is the fallback once it expired
+        if self.token is not None:
+            self.client.send_text(" ".join(["resume", self.token, *LOGIN_OPTIONS]))
+            response = self.client.recv_text().split(" ")
+            if response[0] == "accepted":
+                self.binary = protocol.BINARY in response[1:]
+                return
+        request = " ".join(["login", self.__username, self.__password, *LOGIN_OPTIONS])
+        self.client.send_text(request)
+        response = self.client.recv_text().split(" ")
+        self.token = response[1] if response[0] == "accepted" and len(response) > 1 else None
+        self.binary = response[0] == "accepted" and protocol.BINARY in response[2:]
 
     def commit_building(self, hexagon_no, building_id, building_level):
         request = "add_building" + " " + str(hexagon_no) + " " + str(building_id) + " " + str(building_level)
-        self.client.send(request.encode("utf-8")[:1024])
+        if self.pending_batch is not None:
+            self.pending_batch.append(request)
+        else:
+            self.client.send_text(request)
         print(f'{request} is looks like this')
         # Add building to db, requires following data (pos in hex array, building_name, level of building)
 
+    def upgrade_building(self, hexagon_no, building_id, building_level):
+        """Start an upgrade on the server, returns the seconds until it is done or None if it was refused."""
+        request = "upgrade_building" + " " + str(hexagon_no) + " " + str(building_id) + " " + str(building_level)
+        self.client.send_text(request)
+        received = self.client.recv_text(self.apply_push).split(" ")
+        if received[0] != "scheduled":
+            print(f"Upgrade refused by server: {request}")
+            return None
+        return float(received[1])
+
+    def get_build_jobs(self):
+        # running upgrades as [(hexagon no, building name, level, seconds left), ...]
+        return self.request_rows("build_jobs", parse_build_jobs)[1]
+
+    def report_army(self, defense):
+        # the total defense of the army counts towards the leaderboard
+        request = "army" + " " + str(defense)
+        if self.pending_batch is not None:
+            self.pending_batch.append(request)
+        else:
+            self.client.send_text(request)
+
+    def get_leaderboard(self, start=1, count=10):
+        """One page of the leaderboard as [(rank, name, score), ...], starting at rank start."""
+        return self.request_rows("leaderboard" + " " + str(start) + " " + str(count), parse_leaderboard)[1]
+
+    def get_rank(self):
+        # (rank, score, players on the board) or None when the server has no rank for us
+        self.client.send_text("rank")
+        received = self.client.recv_text(self.apply_push).split(" ")
+        if received[0] == "rejected":
+            return None
+        return int(received[0]), int(received[1]), int(received[2])
+
+    def get_home(self):
+        # axial (q, r) of our city on the world map, None when the server has not placed it
+        self.client.send_text("map_home")
+        received = self.client.recv_text(self.apply_push).split(" ")
+        if received[0] == "rejected":
+            return None
+        return int(received[0]), int(received[1])
+
+    def get_map_chunks(self, chunks):
+        """Cities of the given world map chunks as {(chunk q, chunk r): [(pid, name, q, r), ...]}, one round trip."""
+        self.begin_batch()
+        self.pending_batch.extend(f"map_chunk {cq} {cr}" for cq, cr in chunks)
+        found = {}
+        for chunk, (status, reply) in zip(chunks, self.send_batch()):
+            if status == "ok":
+                found[chunk] = parse_cities(reply)
+        return found
+
+    def get_nearby_cities(self, radius):
+        return self.request_rows("map_near " + str(radius), lambda received: ((), parse_cities(received)))[1]
+
     def update_player(self):
         request = "update"
-        self.client.send(request.encode("utf-8")[:1024])
+        self.client.send_text(request)
+
+    def begin_batch(self):
+        # requests made until send_batch travel to the server as one message and run in one transaction
+        self.pending_batch = []
+
+    def send_batch(self):
+        """Send the queued requests, returns a (status, reply) pair per request, status is ok, empty or error."""
+        requests = self.pending_batch or []
+        self.pending_batch = None
+        if not requests:
+            return []
+        self.client.send(protocol.encode_batch(requests), protocol.MSG_BATCH)
+        frame = self.client.recv()
+        while frame is not None and frame[0] == protocol.MSG_PUSH:
+            self.apply_push(frame[1].decode("utf-8"))
+            frame = self.client.recv()
+        if frame is None:
+            raise ConnectionAbortedError("Connection closed by server")
+        results = []
+        for item in protocol.decode_batch(frame[1]):
+            status, _, reply = item.partition(" ")
+            results.append((status, reply))
+        return results
+
+    def commit_buildings(self, buildings):
+        # several hexagon edits for the price of one round trip, buildings is a list of (hexagon no, name, level)
+        self.begin_batch()
+        for hexagon_no, building_id, building_level in buildings:
+            self.commit_building(hexagon_no, building_id, building_level)
+        return self.send_batch()
+
+    def refresh(self):
+        """update and info in one round trip, returns the player stats like get_player_info."""
+        self.begin_batch()
+        self.pending_batch.extend(["update", "info"])
+        try:
+            status, reply = self.send_batch()[1]
+        except Exception as e:
+            print(e)
+            return self.get_player_info()
+        if status != "ok":
+            print(f"Could not refresh player: {reply}")
+            return []
+        p_stats = reply.split(" ")
+        self.food = int(p_stats[0])
+        self.steel = int(p_stats[1])
+        self.energy = int(p_stats[2])
+        return p_stats
+
+    def subscribe(self):
+        # ask the server to push resource and building changes instead of polling for them
+        try:
+            self.client.send_text("subscribe")
+            self.subscribed = self.client.recv_text(self.apply_push) == "subscribed"
+        except Exception as e:
+            print(e)
+            self.subscribed = False
+        return self.subscribed
+
+    def apply_push(self, message):
+        parts = message.split(" ")
+        if parts[0] == "resources" and len(parts) == 4:
+            self.food = int(parts[1])
+            self.steel = int(parts[2])
+            self.energy = int(parts[3])
+        elif parts[0] == "building" and len(parts) == 4:
+            self.building_updates.append((int(parts[1]), parts[2], int(parts[3])))
+        else:
+            print(f"Unknown push from server: {message}")
+
+    def poll_updates(self):
+        # applies whatever the server pushed without waiting, safe to call every frame
+        try:
+            frame = self.client.recv_nowait()
+            while frame is not None:
+                msg_type, payload = frame
+                if msg_type == protocol.MSG_PUSH:
+                    self.apply_push(payload.decode("utf-8"))
+                frame = self.client.recv_nowait()
+        except Exception as e:
+            print(f"Lost server updates: {e}")
+            # back to polling, get_player_info reconnects
+            self.subscribed = False
+
+def parse_cities(received):
+    # "pid, name, q, r^^" rows of the world map commands
+    cities = []
+    for city in filter(None, received.split("^^")):
+        details = [detail.strip() for detail in city.split(",")]
+        cities.append((int(details[0]), details[1], int(details[2]), int(details[3])))
+    return cities
+
+
+# text replies parsed into the (header, rows) the binary replies unpack to
+
+def parse_player_info(received):
+    return received.split(" "), []
+
+
+def parse_building_rows(received):
+    return (), received.split("^^")
+
+
+def parse_building_sync(received):
+    rows = received.split("^^")
+    header = rows[0].split(" ")
+    if len(header) < 3:
+        # unchanged or rejected
+        return (header[0], 0, 0), []
+    buildings = []
+    for row in filter(None, rows[1:]):
+        details = [detail.strip() for detail in row.split(",")]
+        buildings.append((int(details[0]), int(details[1]), details[2], int(details[3])))
+    return (header[0], int(header[1]), int(header[2])), buildings
+
+
+def parse_build_jobs(received):
+    jobs = []
+    for job in filter(None, received.split("^^")):
+        details = [detail.strip() for detail in job.split(",")]
+        jobs.append((int(details[0]), details[1], int(details[2]), float(details[3])))
+    return (), jobs
+
+
+def parse_leaderboard(received):
+    rows = []
+    for row in filter(None, received.split("^^")):
+        details = [detail.strip() for detail in row.split(",")]
+        rows.append((int(details[0]), details[1], int(details[2])))
+    return (), rows
+
 
 mplayer = Player()
 
 
-def connect_to_server():
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def connect_to_server(tries=CONNECT_TRIES):
     server_ip = "127.0.0.1"
     server_port = 8000
-    Connected = True
-    tries = 0
-    while Connected:
+    for attempt in range(1, tries + 1):
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             client.connect((server_ip, server_port))
-            print(f"Connected to {server_ip} using {server_port}")
-            Connected = False
         except ConnectionRefusedError:
             print("Connection failed")
-            tries += 1
-            if tries == 5:
-                pygame.quit()
-            pygame.time.wait(1000)
-    return client
+            client.close()
+            if attempt < tries:
+                pygame.time.wait(1000)
+            continue
+        print(f"Connected to {server_ip} using {server_port}")
+        return protocol.Channel(client)
+    # this can run on the network thread, pygame is shut down by the render thread that gets the error
+    raise ServerUnavailable(f"No server at {server_ip}:{server_port} after {tries} tries")
 
 
 def check_connection(client):
     try:
-        data = client.recv(1024)
+        data = client.recv()
         if not data: raise ConnectionAbortedError
     except ConnectionAbortedError:
         print("Connection aborted, reconnecting")
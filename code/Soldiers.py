@@ -40,7 +40,10 @@ class Army:
 
     def send_army_info_to_server(self):
         army_info = {unit_id: data['count'] for unit_id, data in self.soldiers.items()}
-        # Implement the actual server communication here
+        # the server only keeps the total defense, it is what the army adds to the leaderboard score
+        defense = sum(self.get_units_total_defense(unit_id) for unit_id in self.soldiers)
+        if getattr(self.player, 'client', None) is not None:
+            self.player.in_background(lambda: self.player.report_army(defense))
         print(f"Sending army info to server: {army_info}")
 
     def receive_army_info_from_server(self, army_info):
@@ -2,7 +2,8 @@ import pygame
 import pygame.freetype
 from enum import Enum
 from pygame.sprite import RenderUpdates
-from Player import mplayer, connect_to_server, check_connection
+from Player import mplayer, connect_to_server, check_connection, LOGIN_OPTIONS, ServerUnavailable
+import protocol
 import OverviewUIHexagon
 import UIElements
 import os
@@ -44,7 +45,11 @@ login = LoginInfo()
 
 
 def main():
-    client = connect_to_server()
+    try:
+        client = connect_to_server()
+    except ServerUnavailable as e:
+        print(e)
+        return
     # establish connection with server
     game_state = GameState(0)
     pygame.init()
@@ -63,12 +68,15 @@ def main():
             password = login.get_login_pass()
             request = "login" + " " + username + " " + password
             print(request)
-            client.send(request.encode("utf-8")[:1024])
-            received = client.recv(1024).decode("utf-8")
-            if received.lower() == "accepted":
-                mplayer.set_parameters(client, username, password)
+            # asks for packed and compressed replies, a server that does not know them answers in plain text
+            client.send_text(" ".join([request, *LOGIN_OPTIONS]))
+            received = client.recv_text().split(" ")
+            if received[0].lower() == "accepted":
+                # the session token lets the player reconnect without sending the password again
+                mplayer.set_parameters(client, username, password, received[1] if len(received) > 1 else None,
+                                       protocol.BINARY in received[2:])
                 OverviewUIHexagon.overview_ui(mplayer)
-            elif received.lower() == "rejected":
+            elif received[0].lower() == "rejected":
                 box = UIElements.TextBox(
                     center_position=(screen.get_width() / 2, 200),
                     font_size=50,
@@ -79,6 +87,24 @@ def main():
                 pygame.display.update()
                 pygame.time.wait(2000)
                 game_state = title_screen(screen, game_state)
+            elif received[0].lower() == "busy":
+                # the server is full and closed the connection, the next attempt needs a new one
+                box = UIElements.TextBox(
+                    center_position=(screen.get_width() / 2, 200),
+                    font_size=50,
+                    bg_rgb=None,
+                    text_rgb=RED,
+                    text="Server busy",)
+                box.draw(screen)
+                pygame.display.update()
+                pygame.time.wait(2000)
+                try:
+                    client = connect_to_server()
+                except ServerUnavailable as e:
+                    print(e)
+                    pygame.quit()
+                    return
+                game_state = title_screen(screen, game_state)
 
         if game_state == GameState.QUIT:
             client.close()
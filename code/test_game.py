@@ -1,3 +1,15 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import queue
+import random
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 from unittest.mock import patch, MagicMock
 
@@ -5,6 +17,21 @@ import pygame
 
 import OverviewUI
 import Player
+import protocol
+import database
+import economy
+import subscriptions
+import cache
+import migrations
+import metrics
+import loadgen
+import sessions
+import logs
+import scheduler
+import leaderboard
+import worldmap
+import journal
+import Network
 from Buildings import (Buildings, Plantation, PowerPlant, Cabins, Barracks,
                        AbyssalOreRefinery, DefensiveDome, BuildingFactory)
 from OverviewUIHexagon import Hexagon, Button, Popup, OverviewUI, TopBar
@@ -259,13 +286,33 @@ class TestBuildingFactory(unittest.TestCase):
         with self.assertRaises(ValueError):
             self.factory.create_building('unknown_type')
 
+    def test_fixture_buildings_are_known(self):
+        # seeded players must be playable by the client
+        for building_type in migrations.FIXTURE_BUILDINGS:
+            self.assertIsInstance(self.factory.create_building(building_type), Buildings)
+
 
 # start unittest for server.py
 class TestServer(unittest.TestCase):
 
-    @patch('server.socket')
-    @patch('server.threading')
-    def test_run_server(self, mock_socket):
+    def temp_database(self, players=None):
+        """ConnectionManager on a database file removed after the test, migrated with players when given."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "Leviathan.db")
+        db = database.ConnectionManager(lambda: sqlite3.connect(path, check_same_thread=False), readers=1)
+        self.addCleanup(db.close)
+        if players is not None:
+            with db.writer() as connection:
+                migrations.migrate(connection)
+                migrations.generate_fixture(connection, players, buildings_per_player=0)
+        return db
+
+    @patch('Server.server.migrations')
+    @patch('Server.server.connect_db')
+    @patch('Server.server.threading')
+    @patch('Server.server.socket')
+    def test_run_server(self, mock_socket, mock_threading, mock_connect_db, mock_migrations):
         # Prepare mock objects
         mock_server_socket = MagicMock()
         mock_socket.socket.return_value = mock_server_socket
@@ -279,21 +326,137 @@ class TestServer(unittest.TestCase):
         mock_server_socket.listen.assert_called_once()
         mock_server_socket.accept.assert_called()
 
-    @patch('server.connect_db')
+    @patch('Server.server.connect_db')
     def test_handle_client(self, mock_connect_db):
         # Prepare mock objects
         mock_client_socket = MagicMock()
-        mock_querier = MagicMock()
-        mock_connect_db.return_value.cursor.return_value = mock_querier
-        mock_querier.fetchone.return_value = (1, 'username', 'password', 0, 0, 0)  # Sample data
+        mock_client_socket.recv.side_effect = [protocol.encode_frame("login username password"), b""]
+        mock_connection = mock_connect_db.return_value
+        mock_connection.execute.return_value.fetchone.return_value = (1, 'username', 'password', 0, 0, 0)  # Sample data
 
         # Call the function
         server.handle_client(mock_client_socket, ('127.0.0.1', 1234))
 
         # Assertions
         mock_client_socket.recv.assert_called()
-        mock_querier.execute.assert_called()
-        mock_client_socket.send.assert_called()
+        mock_connection.execute.assert_any_call("SELECT * FROM Players WHERE PName = ?", ('username',))
+        mock_client_socket.sendall.assert_called_once()
+        reply = protocol.FrameReader()
+        reply.feed(mock_client_socket.sendall.call_args[0][0])
+        self.assertTrue(reply.next_frame()[1].startswith(b"accepted 0."))
+        # the state made for this client is closed with it
+        mock_connection.close.assert_called()
+
+    def test_handle_batch(self):
+        db = self.temp_database()
+        with db.writer() as connection:
+            connection.executescript("""
+                CREATE TABLE Players (PlayerID INTEGER PRIMARY KEY, PName TEXT, PPass TEXT,
+                                      Food INTEGER, Metal INTEGER, Energy INTEGER);
+                CREATE TABLE Buildings (PlayerID INTEGER, BuildingNo INTEGER, BuildingName TEXT, BuildingLevel INTEGER);
+                INSERT INTO Players VALUES (1, 'username', 'password', 0, 0, 0);
+            """)
+            database.ensure_unique_buildings(connection)
+        state = server.ServerState(db, economy_mode="poll")
+        session = server.new_session(MagicMock())
+
+        results = server.handle_batch(state, session, [
+            "login username password", "add_building 1 plantation 1", "login username", "update", "info"])
+
+        self.assertTrue(results[0].startswith("ok accepted "))
+        self.assertEqual(results[1], "empty")
+        self.assertTrue(results[2].startswith("error"))
+        self.assertEqual(results[4], "ok 5 0 0 ")
+        self.assertEqual(state.command_seconds.count(command="login"), 2)
+        self.assertEqual(state.command_seconds.count(command="info"), 1)
+        self.assertGreater(state.db_seconds.count(access="write"), 0)
+
+    def test_failed_batch_command_rolls_back_the_cache(self):
+        db = self.temp_database(1)
+        state = server.ServerState(db, use_cache=True)
+        session = server.new_session(MagicMock())
+        server.handle_request(state, session, "login player1 password")
+        with patch.object(state, "update_score", side_effect=RuntimeError("leaderboard down")):
+            results = server.handle_batch(state, session, ["add_building 0 plantation 1"])
+        self.assertTrue(results[0].startswith("error"))
+        self.assertEqual(state.player_buildings(1), [])
+        state.cache.flush()
+        with db.reader() as connection:
+            self.assertEqual(connection.execute("SELECT COUNT(*) FROM Buildings").fetchone()[0], 0)
+        # production is not written in lazy mode, such a batch runs without the writer
+        with patch.object(db, "writer", side_effect=AssertionError("writer taken")):
+            self.assertEqual(server.handle_batch(state, session, ["update", "info_buildings"]), ["empty", "ok "])
+
+    def test_buildings_since_sends_changed_hexagons(self):
+        db = self.temp_database(1)
+        state = server.ServerState(db, economy_mode="poll")
+        session = server.new_session(MagicMock())
+        server.handle_request(state, session, "login player1 password")
+        state.add_building(1, 0, "plantation", 1)
+        state.add_building(1, 1, "cabins", 1)
+        epoch = state.building_versions.epoch
+
+        full = server.handle_request(state, session, "buildings_since 0 0").split("^^")
+        self.assertEqual(full[0], f"full {epoch} 3")
+        self.assertEqual(full[1:], ["1, 0, plantation, 1", "1, 1, cabins, 1", ""])
+        self.assertEqual(server.handle_request(state, session, f"buildings_since {epoch} 3"), "unchanged")
+        state.add_building(1, 1, "cabins", 2)
+        self.assertEqual(server.handle_request(state, session, f"buildings_since {epoch} 3"),
+                         f"delta {epoch} 4^^1, 1, cabins, 2^^")
+        # a version of another server run gets everything again
+        self.assertTrue(server.handle_request(state, session, f"buildings_since {epoch + 1} 3").startswith("full "))
+
+    def test_binary_encoding_is_negotiated_at_login(self):
+        db = self.temp_database(1)
+        state = server.ServerState(db, economy_mode="poll")
+        state.add_building(1, 2, "cabins", 1)
+        text_session = server.new_session(MagicMock())
+        server.handle_request(state, text_session, "login player1 password")
+        self.assertEqual(server.handle_frame(state, text_session, protocol.MSG_TEXT, b"info_buildings"),
+                         (protocol.MSG_TEXT, "1, 2, cabins, 1^^"))
+        session = server.new_session(MagicMock())
+        self.assertTrue(server.handle_request(state, session, "login player1 password binary").endswith(" binary"))
+        msg_type, payload = server.handle_frame(state, session, protocol.MSG_TEXT, b"info_buildings")
+        self.assertEqual(msg_type, protocol.MSG_BINARY)
+        self.assertEqual(protocol.unpack_reply("info_buildings", payload), ((), [(1, 2, "cabins", 1)]))
+        # batches stay text for every client
+        self.assertEqual(server.handle_batch(state, session, ["info_buildings"]), ["ok 1, 2, cabins, 1^^"])
+        self.assertIsNone(session["compressor"])
+        self.assertEqual(server.handle_request(state, session, "resume nothing binary zlib"), "rejected")
+        reply = server.handle_request(state, session, "login player1 password zlib unknown").split(" ")
+        self.assertEqual((reply[0], reply[2:]), ("accepted", ["zlib"]))
+        self.assertEqual(session["encoding"], protocol.TEXT)
+        self.assertIsNotNone(session["compressor"])
+        state.compress_threshold = None
+        self.assertEqual(len(server.handle_request(state, session, "login player1 password zlib").split(" ")), 2)
+
+    def test_out_of_range_buildings_are_rejected(self):
+        db = self.temp_database(1)
+        state = server.ServerState(db, economy_mode="poll")
+        session = server.new_session(MagicMock())
+        server.handle_request(state, session, "login player1 password binary")
+        server.handle_request(state, session, "add_building -1 plantation 1")
+        server.handle_request(state, session, "add_building 70000 plantation 1")
+        server.handle_request(state, session, "add_building 2 plantation 70000")
+        self.assertEqual(server.handle_request(state, session, "upgrade_building 70000 cabins 2"), "rejected")
+        self.assertEqual(state.player_buildings(1), [])
+        # the packed replies still work
+        msg_type, payload = server.handle_frame(state, session, protocol.MSG_TEXT, b"info_buildings")
+        self.assertEqual(protocol.unpack_reply("info_buildings", payload), ((), []))
+
+    def test_route_by_player_shard(self):
+        db = self.temp_database(4)
+        self.assertEqual(server.route("login player3 password", db, 2), 1)
+        self.assertEqual(server.route("login player4 password", db, 2), 0)
+        self.assertEqual(server.route("login nobody password", db, 2), 0)
+        batch = (protocol.MSG_BATCH, protocol.encode_batch(["login player3 password", "info"]))
+        self.assertEqual(server.first_request(batch), "login player3 password")
+        # a worker turns away players of another shard
+        state = server.ServerState(db, shard=(0, 2))
+        session = server.new_session(MagicMock())
+        self.assertEqual(server.handle_request(state, session, "login player3 password"), "rejected")
+        self.assertTrue(server.handle_request(state, session, "login player4 password").startswith("accepted 0."))
+        self.assertEqual(server.route("resume 1.abc", db, 2), 1)
 
     @patch('server.connect_db')
     def test_calc_changes(self, mock_connect_db):
@@ -326,6 +489,902 @@ class TestServer(unittest.TestCase):
         mock_querier.commit.assert_called()
 
 
+    def test_busy_when_full(self):
+        state = server.ServerState(MagicMock(), max_connections=1)
+        self.assertTrue(state.admit())
+        mock_client_socket = MagicMock()
+        server.handle_client(mock_client_socket, ('127.0.0.1', 1234), state)
+        reply = protocol.FrameReader()
+        reply.feed(mock_client_socket.sendall.call_args[0][0])
+        self.assertEqual(reply.next_frame(), (protocol.MSG_TEXT, b"busy"))
+        mock_client_socket.recv.assert_not_called()
+        mock_client_socket.close.assert_called_once()
+        state.release()
+        self.assertTrue(state.admit())
+
+    def test_subscribed_clients_do_not_time_out(self):
+        state = server.ServerState(MagicMock(), idle_timeout=5.0)
+        session = server.new_session(MagicMock())
+        self.assertEqual(server.idle_timeout(state, session), 5.0)
+        session["subscriber"] = state.hub.subscribe(1, session["push"])
+        self.assertIsNone(server.idle_timeout(state, session))
+
+    def test_tick_seconds_must_be_positive(self):
+        self.assertRaises(ValueError, server.ServerState, MagicMock(), economy_mode="tick", tick_seconds=0)
+        self.assertEqual(server.positive_seconds("2.5"), 2.5)
+        self.assertRaises(argparse.ArgumentTypeError, server.positive_seconds, "0")
+
+    def test_push_interval_is_separate_from_the_tick(self):
+        state = server.ServerState(MagicMock(), economy_mode="tick", tick_seconds=0.1, push_seconds=2.0)
+        self.assertEqual((state.ticker.interval, state.hub.interval), (0.1, 2.0))
+        self.assertEqual(server.ServerState(MagicMock(), tick_seconds=0.1).hub.interval, server.PUSH_SECONDS)
+        self.assertRaises(ValueError, server.ServerState, MagicMock(), push_seconds=0)
+        self.assertRaises(argparse.ArgumentTypeError, server.push_seconds, "0.01")
+
+    def test_client_that_stops_reading_is_dropped(self):
+        state = server.ServerState(self.temp_database(1))
+        server_socket, client_socket = socket.socketpair()
+        self.addCleanup(client_socket.close)
+        thread = threading.Thread(target=server.handle_client, args=(server_socket, ("127.0.0.1", 1234), state))
+        thread.start()
+        client = protocol.Channel(client_socket)
+        client.send_text("login player1 password")
+        self.assertTrue(client.recv_text().startswith("accepted"))
+        client.send_text("subscribe")
+        self.assertEqual(client.recv_text(lambda push: None), "subscribed")
+        # nothing is read from here on, the hub thread must not wait for this client
+        started = time.monotonic()
+        for _ in range(server.MAX_PUSH_QUEUE + 500):
+            state.hub.publish_building(1, 0, "x" * 10000, 1)
+        self.assertLess(time.monotonic() - started, 5)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+
+# start unittest for protocol.py
+class TestProtocol(unittest.TestCase):
+
+    def test_merged_frames_are_split(self):
+        # Two commands arriving in one TCP segment must come out as two frames
+        reader = protocol.FrameReader()
+        reader.feed(protocol.encode_frame("update") + protocol.encode_frame("info"))
+        self.assertEqual(list(reader.frames()), [(protocol.MSG_TEXT, b"update"), (protocol.MSG_TEXT, b"info")])
+
+    def test_partial_frame_waits_for_rest(self):
+        reader = protocol.FrameReader()
+        frame = protocol.encode_frame("info_buildings")
+        reader.feed(frame[:3])
+        self.assertIsNone(reader.next_frame())
+        reader.feed(frame[3:])
+        self.assertEqual(reader.next_frame(), (protocol.MSG_TEXT, b"info_buildings"))
+
+    def test_large_payload_is_not_truncated(self):
+        payload = "1, 1, plantation, 1^^" * 10000
+        mock_socket = MagicMock()
+        frame = protocol.encode_frame(payload)
+        mock_socket.recv.side_effect = [frame[i:i + 1024] for i in range(0, len(frame), 1024)]
+        channel = protocol.Channel(mock_socket)
+        self.assertEqual(channel.recv_text(), payload)
+
+    def test_reply_schemas_round_trip(self):
+        rows = [(123456, 0, "plantation", 2), (123456, 15, "défense", 1)]
+        payload = protocol.pack_reply("info_buildings", rows=rows)
+        self.assertEqual(protocol.unpack_reply("info_buildings", payload), ((), rows))
+        self.assertLess(len(payload), len(server.text_rows(rows).encode("utf-8")))
+        jobs = protocol.pack_reply("build_jobs", rows=[(3, "cabins", 2, 12.5)])
+        self.assertEqual(protocol.unpack_reply("build_jobs", jobs), ((), [(3, "cabins", 2, 12.5)]))
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.unpack_reply("leaderboard", payload)
+
+    def test_compressed_frames_are_read_back(self):
+        payload = "123456, 4, plantation, 2^^" * 200
+        for dictionary in (False, True):
+            compressor = protocol.Compressor(dictionary=dictionary)
+            frame = protocol.encode_frame(payload, protocol.MSG_TEXT, compressor)
+            self.assertLess(len(frame), len(payload) // 10)
+            reader = protocol.FrameReader()
+            reader.feed(frame)
+            self.assertEqual(reader.next_frame(), (protocol.MSG_TEXT, payload.encode("utf-8")))
+            self.assertGreater(compressor.stats.ratio, 10)
+        # short messages are not worth it
+        self.assertEqual(protocol.encode_frame("info", protocol.MSG_TEXT, protocol.Compressor()),
+                         protocol.encode_frame("info"))
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.decompress_frame(protocol.MSG_TEXT | protocol.COMPRESSED, b"not zlib")
+
+    def test_oversized_frame_is_rejected(self):
+        reader = protocol.FrameReader()
+        reader.feed(protocol.HEADER.pack(protocol.MAX_PAYLOAD + 1, protocol.MSG_TEXT))
+        with self.assertRaises(protocol.ProtocolError):
+            reader.next_frame()
+
+    def test_timeout_depends_on_started_frame(self):
+        mock_socket = MagicMock()
+        frame = protocol.encode_frame("info")
+        mock_socket.recv.side_effect = [frame[:3], frame[3:]]
+        channel = protocol.Channel(mock_socket, idle_timeout=300, read_timeout=30)
+        self.assertEqual(channel.recv_text(), "info")
+        # waiting for a new frame uses the idle timeout, the rest of a started one the read timeout
+        self.assertEqual([c[0][0] for c in mock_socket.settimeout.call_args_list], [300, 30])
+
+    def test_read_frame_times_out(self):
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(protocol.encode_frame("info")[:3])
+            await protocol.read_frame(reader, idle_timeout=0.05, read_timeout=0.05)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(run())
+
+
+# start unittest for database.py
+class TestConnectionManager(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, "Leviathan.db")
+        self.db = database.ConnectionManager(lambda: sqlite3.connect(path, check_same_thread=False), readers=2)
+        with self.db.writer() as connection:
+            connection.execute("CREATE TABLE Players (PlayerID INTEGER PRIMARY KEY, Food INTEGER)")
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def test_wal_enabled(self):
+        with self.db.reader() as connection:
+            self.assertEqual(connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+    def test_nested_writer_commits_once(self):
+        with self.db.writer() as connection:
+            connection.execute("INSERT INTO Players VALUES (1, 5)")
+            with self.db.writer() as inner:
+                inner.execute("INSERT INTO Players VALUES (2, 5)")
+            # reads inside the write see the uncommitted rows
+            with self.db.reader() as reader:
+                self.assertEqual(reader.execute("SELECT COUNT(*) FROM Players").fetchone()[0], 2)
+            self.assertTrue(connection.in_transaction)
+        with self.db.reader() as reader:
+            self.assertEqual(reader.execute("SELECT COUNT(*) FROM Players").fetchone()[0], 2)
+
+    def test_failed_write_rolls_back(self):
+        with self.assertRaises(ValueError):
+            with self.db.writer() as connection:
+                connection.execute("INSERT INTO Players VALUES (1, 5)")
+                raise ValueError("bad building")
+        with self.db.reader() as reader:
+            self.assertEqual(reader.execute("SELECT COUNT(*) FROM Players").fetchone()[0], 0)
+
+    def test_ensure_unique_buildings_compacts_history(self):
+        with self.db.writer() as connection:
+            connection.execute("CREATE TABLE Buildings (PlayerID INTEGER, BuildingNo INTEGER, "
+                               "BuildingName TEXT, BuildingLevel INTEGER)")
+            connection.executemany("INSERT INTO Buildings VALUES (?,?,?,?)", [
+                (1, 0, "plantation", 1), (1, 0, "plantation", 2), (1, 1, "cabins", 1), (1, 0, "plantation", 3)])
+            self.assertEqual(database.ensure_unique_buildings(connection), 2)
+            connection.execute(database.UPSERT_BUILDING, (1, 1, "cabins", 2))
+            rows = connection.execute("SELECT * FROM Buildings ORDER BY BuildingNo").fetchall()
+        self.assertEqual(rows, [(1, 0, "plantation", 3), (1, 1, "cabins", 2)])
+
+    def test_health(self):
+        health = self.db.health()
+        self.assertTrue(health["writer"])
+        self.assertEqual(health["healthy_idle_readers"], 2)
+
+
+# start unittest for economy.py
+class TestEconomy(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.executescript("""
+            CREATE TABLE Players (PlayerID INTEGER PRIMARY KEY, PName TEXT, PPass TEXT,
+                                  Food INTEGER, Metal INTEGER, Energy INTEGER);
+            CREATE TABLE Buildings (PlayerID INTEGER, BuildingNo INTEGER, BuildingName TEXT, BuildingLevel INTEGER);
+            INSERT INTO Players VALUES (1, 'a', 'x', 0, 0, 0), (2, 'b', 'x', 10, 10, 10), (3, 'c', 'x', 0, 0, 0);
+            INSERT INTO Buildings VALUES (1, 0, 'plantation', 1), (1, 1, 'plantation', 1), (1, 2, 'cabins', 1),
+                                         (2, 0, 'abyssal_ore_refinery', 1), (2, 1, 'power_plant', 1);
+        """)
+
+    def resources(self, pid):
+        return self.connection.execute("SELECT Food, Metal, Energy FROM Players WHERE PlayerID = ?", (pid,)).fetchone()
+
+    def test_apply_production_for_all_players(self):
+        updated = economy.apply_production(self.connection)
+        self.assertEqual(updated, 2)
+        self.assertEqual(self.resources(1), (10, 0, 0))
+        self.assertEqual(self.resources(2), (10, 25, 110))
+        self.assertEqual(self.resources(3), (0, 0, 0))
+
+    def test_apply_production_for_one_shard(self):
+        # shard 1 of 2 owns the odd PlayerIDs
+        self.assertEqual(economy.apply_production(self.connection, shard=(1, 2)), 1)
+        self.assertEqual(self.resources(1), (10, 0, 0))
+        self.assertEqual(self.resources(2), (10, 10, 10))
+
+    def test_apply_production_scaled(self):
+        economy.apply_production(self.connection, scale=2)
+        self.assertEqual(self.resources(1), (20, 0, 0))
+
+    def test_ticker_reports_timing(self):
+        db = MagicMock()
+        db.writer.return_value.__enter__.return_value = self.connection
+        ticker = economy.EconomyTicker(db, interval=economy.PRODUCTION_PERIOD)
+        ticker.tick()
+        self.assertEqual(ticker.stats()["ticks"], 1)
+        self.assertEqual(self.resources(1), (10, 0, 0))
+
+    def test_lazy_accrual_reads_without_writing(self):
+        economy.start_accrual(self.connection, now=1000.0)
+        self.connection.commit()
+        # 3 whole periods and a bit have passed
+        now = 1000.0 + 3.5 * economy.PRODUCTION_PERIOD
+        self.assertEqual(economy.read_accrued(self.connection, 1, now), (30, 0, 0))
+        self.assertEqual(economy.read_accrued(self.connection, 2, now), (10, 55, 310))
+        self.assertFalse(self.connection.in_transaction)
+        self.assertEqual(self.resources(1), (0, 0, 0))
+
+    def test_settle_keeps_partial_period(self):
+        economy.start_accrual(self.connection, now=1000.0)
+        now = 1000.0 + 2.5 * economy.PRODUCTION_PERIOD
+        self.connection.execute("INSERT INTO Buildings VALUES (1, 3, 'plantation', 1)")
+        self.assertEqual(economy.settle(self.connection, 1, now), (20, 0, 0))
+        # the new plantation only counts from now on and the half period is not lost
+        later = 1000.0 + 3 * economy.PRODUCTION_PERIOD
+        self.assertEqual(economy.read_accrued(self.connection, 1, later), (35, 0, 0))
+
+    def test_stop_accrual_writes_what_accrued(self):
+        economy.start_accrual(self.connection, now=1000.0)
+        economy.stop_accrual(self.connection, now=1000.0 + 3.5 * economy.PRODUCTION_PERIOD)
+        self.assertEqual(self.resources(1), (30, 0, 0))
+        self.assertEqual(self.resources(2), (10, 55, 310))
+        # the clock is gone, nothing is credited a second time
+        self.assertEqual(economy.read_accrued(self.connection, 1, 5000.0), (30, 0, 0))
+
+    def test_production_depends_on_level(self):
+        # a site not bought yet produces nothing, the client's class names count like the server's
+        self.connection.execute("INSERT INTO Buildings VALUES (3, 0, 'plantation', 2), (3, 1, 'powerplant', 3), "
+                                "(3, 2, 'abyssalorerefinery', 0), (3, 3, 'plantation', 99)")
+        rows = self.connection.execute("SELECT BuildingName, BuildingLevel FROM Buildings WHERE PlayerID = 3")
+        expected = economy.building_rates(rows.fetchall())
+        self.assertEqual(expected, (8 + round(5 * 1.5 ** (economy.MAX_LEVEL - 1)), 0, 225))
+        economy.apply_production(self.connection)
+        self.assertEqual(self.resources(3), expected)
+        self.assertEqual(self.resources(1), (10, 0, 0))
+
+
+# start unittest for subscriptions.py
+class TestSubscriptionHub(unittest.TestCase):
+
+    def setUp(self):
+        self.resources = {1: (10, 20, 30)}
+        self.hub = subscriptions.SubscriptionHub(lambda pids: {pid: self.resources[pid] for pid in pids})
+        self.push = MagicMock()
+        self.subscriber = self.hub.subscribe(1, self.push)
+
+    def test_resources_pushed_only_on_change(self):
+        self.hub.publish_resources()
+        self.hub.publish_resources()
+        self.push.assert_called_once_with("resources 10 20 30")
+        self.resources[1] = (15, 20, 30)
+        self.hub.publish_resources()
+        self.push.assert_called_with("resources 15 20 30")
+
+    def test_building_pushed_to_owner_only(self):
+        other = MagicMock()
+        self.hub.subscribe(2, other)
+        self.hub.publish_building(1, 4, "plantation", 2)
+        self.push.assert_called_once_with("building 4 plantation 2")
+        other.assert_not_called()
+
+    def test_unsubscribe(self):
+        self.hub.unsubscribe(self.subscriber)
+        self.hub.publish_building(1, 4, "plantation", 2)
+        self.push.assert_not_called()
+
+
+# start unittest for cache.py
+class TestPlayerStateCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, "Leviathan.db")
+        self.db = database.ConnectionManager(lambda: sqlite3.connect(path, check_same_thread=False), readers=1)
+        with self.db.writer() as connection:
+            connection.executescript("""
+                CREATE TABLE Players (PlayerID INTEGER PRIMARY KEY, PName TEXT, PPass TEXT,
+                                      Food INTEGER, Metal INTEGER, Energy INTEGER);
+                CREATE TABLE Buildings (PlayerID INTEGER, BuildingNo INTEGER, BuildingName TEXT, BuildingLevel INTEGER);
+                INSERT INTO Players VALUES (1, 'username', 'password', 0, 0, 0);
+            """)
+            database.ensure_unique_buildings(connection)
+            economy.start_accrual(connection, now=1000.0)
+        self.cache = cache.PlayerStateCache(self.db, lazy=False)
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def stored(self):
+        with self.db.reader() as connection:
+            food = connection.execute("SELECT Food FROM Players WHERE PlayerID = 1").fetchone()[0]
+            buildings = connection.execute("SELECT COUNT(*) FROM Buildings").fetchone()[0]
+        return food, buildings
+
+    def test_writes_are_deferred_until_flush(self):
+        self.cache.add_building(1, 0, "plantation", 1)
+        self.cache.produce(1)
+        self.assertEqual(self.cache.resources(1), (5, 0, 0))
+        self.assertEqual(self.stored(), (0, 0))
+        self.assertEqual(self.cache.flush(), 1)
+        self.assertEqual(self.stored(), (5, 1))
+        self.assertEqual(self.cache.flush(), 0)
+
+    def test_stop_flushes(self):
+        self.cache.add_building(1, 0, "plantation", 1)
+        self.cache.stop()
+        self.assertEqual(self.stored(), (0, 1))
+
+    def test_upgrade_replaces_building(self):
+        self.cache.add_building(1, 0, "plantation", 1)
+        self.cache.flush()
+        self.cache.add_building(1, 0, "plantation", 2)
+        self.cache.flush()
+        self.assertEqual(self.cache.buildings(1), [(1, 0, "plantation", 2)])
+        self.assertEqual(self.stored(), (0, 1))
+
+    def test_hit_rate_and_eviction(self):
+        self.cache.resources(1)
+        self.cache.resources(1)
+        self.assertEqual(self.cache.stats()["hit_rate"], 0.5)
+        self.cache.idle_seconds = 0
+        self.assertEqual(self.cache.evict_idle(active_pids={1}), 0)
+        self.assertEqual(self.cache.evict_idle(), 1)
+
+    def test_dirty_entries_are_not_evicted(self):
+        self.cache.add_building(1, 0, "plantation", 1)
+        self.cache.idle_seconds = 0
+        self.assertEqual(self.cache.evict_idle(), 0)
+
+    def test_database_is_read_without_the_lock(self):
+        reader = self.db.reader
+        unlocked = []
+
+        def probe():
+            unlocked.append(self.cache.lock.acquire(blocking=False))
+            if unlocked[-1]:
+                self.cache.lock.release()
+
+        def checked_reader():
+            thread = threading.Thread(target=probe)
+            thread.start()
+            thread.join()
+            return reader()
+
+        with patch.object(self.db, "reader", side_effect=checked_reader):
+            self.cache.resources(1)
+            self.cache.invalidate_resources()
+            self.cache.add_building(1, 0, "plantation", 1)
+        self.assertEqual(unlocked, [True, True])
+        self.assertEqual(self.cache.buildings(1), [(1, 0, "plantation", 1)])
+
+    def test_missing_player(self):
+        self.assertIsNone(self.cache.resources(2))
+        self.assertEqual(self.cache.buildings(2), [])
+        self.cache.resources(1)
+        with self.db.writer() as connection:
+            connection.execute("DELETE FROM Players WHERE PlayerID = 1")
+        # the reload after an economy tick finds no row any more
+        self.cache.invalidate_resources()
+        self.assertIsNone(self.cache.resources(1))
+        self.assertRaises(KeyError, self.cache.produce, 1)
+
+
+# start unittest for migrations.py
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.connection = sqlite3.connect(os.path.join(self.directory.name, "Leviathan.db"))
+
+    def tearDown(self):
+        self.connection.close()
+        self.directory.cleanup()
+
+    def test_bootstrap_empty_database(self):
+        self.assertEqual(migrations.migrate(self.connection), migrations.SCHEMA_VERSION)
+        self.assertEqual(migrations.schema_version(self.connection), migrations.SCHEMA_VERSION)
+        self.assertTrue(migrations.leading_column_indexed(self.connection, "Players", "PName"))
+        self.assertTrue(migrations.leading_column_indexed(self.connection, "Buildings", "PlayerID"))
+        # a second run has nothing left to do
+        self.assertEqual(migrations.migrate(self.connection), 0)
+
+    def test_upgrade_existing_database(self):
+        self.connection.executescript("""
+            CREATE TABLE Players (PlayerID INTEGER PRIMARY KEY, PName TEXT, PPass TEXT,
+                                  Food INTEGER, Metal INTEGER, Energy INTEGER);
+            CREATE TABLE Buildings (PlayerID INTEGER, BuildingNo INTEGER, BuildingName TEXT, BuildingLevel INTEGER);
+            INSERT INTO Players VALUES (1, 'username', 'password', 0, 0, 0);
+            INSERT INTO Buildings VALUES (1, 0, 'plantation', 1), (1, 0, 'plantation', 2);
+        """)
+        migrations.migrate(self.connection)
+        self.assertEqual(self.connection.execute("SELECT * FROM Buildings").fetchall(), [(1, 0, "plantation", 2)])
+        self.assertTrue(migrations.leading_column_indexed(self.connection, "Players", "PName"))
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(Players)")}
+        self.assertIn("LastUpdated", columns)
+
+    def test_fixture_queries_use_indexes(self):
+        migrations.migrate(self.connection)
+        migrations.generate_fixture(self.connection, 200, buildings_per_player=3)
+        self.assertEqual(self.connection.execute("SELECT COUNT(*) FROM Buildings").fetchone()[0], 600)
+        plans = migrations.explain(self.connection)
+        for name in ("login", "resources", "buildings"):
+            self.assertFalse(any(detail.startswith("SCAN") for detail in plans[name]), plans[name])
+
+
+# start unittest for metrics.py
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram("command_seconds", "Command time", buckets=(0.01, 0.1))
+        for value in (0.005, 0.05, 0.05, 1.0):
+            histogram.observe(value, command="info")
+        text = registry.render()
+        self.assertIn('command_seconds_bucket{command="info",le="0.01"} 1', text)
+        self.assertIn('command_seconds_bucket{command="info",le="0.1"} 3', text)
+        self.assertIn('command_seconds_bucket{command="info",le="+Inf"} 4', text)
+        self.assertIn('command_seconds_count{command="info"} 4', text)
+
+    def test_counters_gauges_and_collectors(self):
+        registry = metrics.Registry()
+        registry.counter("bytes_total", "Bytes").inc(10)
+        connections = registry.gauge("connections", "Connections")
+        connections.inc()
+        connections.inc()
+        connections.dec()
+        registry.add_collector(lambda: [("ticks_total", "Ticks", "counter", 3)])
+        text = registry.render()
+        self.assertIn("# TYPE bytes_total counter\nbytes_total 10", text)
+        self.assertIn("connections 1", text)
+        self.assertIn("# TYPE ticks_total counter\nticks_total 3", text)
+
+    def test_http_endpoint(self):
+        import urllib.request
+        registry = metrics.Registry()
+        registry.counter("requests_total", "Requests").inc()
+        http_server = metrics.serve(registry, port=0)
+        try:
+            url = f"http://127.0.0.1:{http_server.server_address[1]}/metrics"
+            with urllib.request.urlopen(url, timeout=5) as response:
+                self.assertIn("requests_total 1", response.read().decode("utf-8"))
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+
+
+# start unittest for loadgen.py
+class TestLoadgen(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadgen.percentile(values, 0.5), 50)
+        self.assertEqual(loadgen.percentile(values, 0.99), 99)
+        self.assertEqual(loadgen.percentile([], 0.5), 0.0)
+
+    def test_run_load_against_server(self):
+        from concurrent.futures import ThreadPoolExecutor
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "Leviathan.db")
+        first = loadgen.make_database(path, 3)
+        state = server.ServerState(database.ConnectionManager(lambda: sqlite3.connect(path, check_same_thread=False),
+                                                              readers=2))
+        state.start()
+        self.addCleanup(state.close)
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+
+        async def run():
+            listener = await asyncio.start_server(
+                lambda reader, writer: server.handle_client_async(reader, writer, executor, state), "127.0.0.1", 0)
+            port = listener.sockets[0].getsockname()[1]
+            rates = {"info": 20, "update": 10, "add_building": 10}
+            try:
+                return await loadgen.run_load("127.0.0.1", port, 3, 0.3, rates, first, ramp_seconds=0)
+            finally:
+                listener.close()
+
+        stats = asyncio.run(run())
+        self.assertEqual(stats.errors, {})
+        self.assertEqual(len(stats.latencies["login"]), 3)
+        self.assertIn("requests/s", stats.report())
+
+
+# start unittest for sessions.py
+class TestSessionTable(unittest.TestCase):
+
+    def test_issue_and_resume(self):
+        table = sessions.SessionTable(ttl=10, shard=2)
+        token = table.issue(7, "username", now=100)
+        self.assertEqual(sessions.token_shard(token), 2)
+        session = table.resume(token, now=105)
+        self.assertEqual((session.pid, session.username), (7, "username"))
+        # resuming pushes the expiry back
+        self.assertIsNotNone(table.resume(token, now=114))
+        self.assertIsNone(table.resume("2.unknown", now=114))
+
+    def test_expired_token_is_rejected(self):
+        table = sessions.SessionTable(ttl=10)
+        token = table.issue(7, "username", now=100)
+        self.assertIsNone(table.resume(token, now=111))
+        self.assertEqual(table.stats()["sessions"], 0)
+
+    def test_resume_command(self):
+        state = server.ServerState(MagicMock())
+        token = state.sessions.issue(3, "username")
+        session = server.new_session(MagicMock())
+        self.assertEqual(server.handle_request(state, session, "resume " + token), "accepted")
+        self.assertEqual((session["pid"], session["username"]), (3, "username"))
+        self.assertEqual(state.connected_pids(), {3})
+        self.assertEqual(server.handle_request(state, server.new_session(MagicMock()), "resume 0.bad"), "rejected")
+
+
+# start unittest for logs.py
+class TestLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "server.log")
+        self.log = logs.get_logger("test")
+
+    def tearDown(self):
+        logs.shutdown()
+        logging.getLogger(logs.ROOT).handlers[:] = []
+        self.directory.cleanup()
+
+    def lines(self):
+        logs.shutdown()
+        with open(self.path) as file:
+            return file.read().splitlines()
+
+    def test_json_events(self):
+        logs.setup(json_output=True, path=self.path)
+        logs.event(self.log, "login", user="username", pid=1)
+        entry = json.loads(self.lines()[0])
+        self.assertEqual((entry["message"], entry["user"], entry["pid"]), ("login", "username", 1))
+
+    def test_sampling_keeps_one_in_n(self):
+        logs.setup(path=self.path, samples=logs.parse_samples("command=10"))
+        for _ in range(30):
+            logs.event(self.log, "command", command="info")
+        # warnings are never sampled away
+        logs.event(self.log, "command", logging.WARNING, command="info")
+        lines = self.lines()
+        self.assertEqual(len(lines), 4)
+        self.assertIn("sampled=1/10", lines[0])
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = logs.DroppingQueueHandler(queue.Queue(1))
+        handler.emit(logging.makeLogRecord({"msg": "first"}))
+        handler.emit(logging.makeLogRecord({"msg": "second"}))
+        self.assertEqual(handler.dropped, 1)
+
+
+# start unittest for scheduler.py
+class TestBuildScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        path = os.path.join(self.directory.name, "Leviathan.db")
+        self.db = database.ConnectionManager(lambda: sqlite3.connect(path, check_same_thread=False), readers=1)
+        self.addCleanup(self.db.close)
+        with self.db.writer() as connection:
+            migrations.migrate(connection)
+        self.completed = []
+
+    def complete(self, pid, building_no, building_name, level):
+        self.completed.append((pid, building_no, building_name, level))
+
+    def test_jobs_complete_when_due(self):
+        jobs = scheduler.BuildScheduler(self.db, self.complete)
+        self.assertEqual(jobs.schedule(1, 4, "cabins", 2, now=1000.0), 30.0)
+        self.assertEqual(jobs.schedule(1, 5, "cabins", 1, now=1000.0), 20.0)
+        self.assertIsNone(jobs.schedule(1, 4, "cabins", 3, now=1000.0))
+        self.assertEqual(jobs.run_due(now=1025.0), 1)
+        self.assertEqual(self.completed, [(1, 5, "cabins", 1)])
+        self.assertEqual([job[0] for job in jobs.jobs(1)], [4])
+
+    def test_jobs_survive_restart(self):
+        scheduler.BuildScheduler(self.db, self.complete).schedule(1, 4, "cabins", 1, now=1000.0)
+        # a new scheduler finds the stored job, overdue by now, and completes it on start
+        jobs = scheduler.BuildScheduler(self.db, self.complete)
+        jobs.start()
+        self.addCleanup(jobs.stop)
+        self.assertEqual(self.completed, [(1, 4, "cabins", 1)])
+        self.assertEqual(jobs.jobs(1), [])
+
+    def test_failed_job_is_retried_with_backoff(self):
+        failures = [sqlite3.OperationalError("database is locked")] * 2
+
+        def complete(*job):
+            if failures:
+                raise failures.pop()
+            self.complete(*job)
+
+        jobs = scheduler.BuildScheduler(self.db, complete)
+        jobs.schedule(1, 4, "cabins", 1, now=1000.0)
+        self.assertEqual(jobs.run_due(now=1020.0), 1)
+        self.assertEqual(jobs.heap[0][0], 1020.0 + scheduler.RETRY_SECONDS)
+        self.assertEqual(jobs.run_due(now=1021.0), 1)
+        self.assertEqual(jobs.heap[0][0], 1021.0 + 2 * scheduler.RETRY_SECONDS)
+        self.assertEqual(len(jobs.jobs(1)), 1)
+        self.assertEqual(jobs.run_due(now=1023.0), 1)
+        self.assertEqual(self.completed, [(1, 4, "cabins", 1)])
+        self.assertEqual((jobs.heap, jobs.retries, jobs.jobs(1)), ([], {}, []))
+
+    def test_upgrade_command_pushes_on_completion(self):
+        with self.db.writer() as connection:
+            connection.execute("INSERT INTO Players(PlayerID, PName, PPass, Food, Metal, Energy) "
+                               "VALUES (1, 'username', 'password', 0, 0, 0)")
+        state = server.ServerState(self.db, build_time_scale=0.001)
+        state.start()
+        self.addCleanup(state.close)
+        pushes = queue.Queue()
+        session = server.new_session(pushes.put)
+        server.handle_request(state, session, "login username password")
+        self.assertEqual(server.handle_request(state, session, "subscribe"), "subscribed")
+        pushes.get(timeout=1)
+        self.assertEqual(server.handle_request(state, session, "upgrade_building 3 barracks 1"), "scheduled 0.1")
+        self.assertEqual(pushes.get(timeout=2), "building 3 barracks 1")
+        self.assertEqual(state.player_buildings(1), [(1, 3, "barracks", 1)])
+        self.assertEqual(server.handle_request(state, session, "build_jobs"), "")
+
+    def test_finished_job_is_written_through_the_cache(self):
+        with self.db.writer() as connection:
+            connection.execute("INSERT INTO Players(PlayerID, PName, PPass, Food, Metal, Energy) "
+                               "VALUES (1, 'username', 'password', 0, 0, 0)")
+        state = server.ServerState(self.db, use_cache=True)
+        session = server.new_session(MagicMock())
+        server.handle_request(state, session, "login username password")
+        server.handle_request(state, session, "upgrade_building 3 barracks 1")
+        with patch.object(state.cache, "flush", side_effect=sqlite3.OperationalError("disk I/O error")):
+            state.scheduler.run_due(now=time.time() + 120)
+        # the building did not reach the database, so the job is still there
+        self.assertEqual(len(state.scheduler.jobs(1)), 1)
+        state.scheduler.run_due(now=time.time() + 240)
+        with self.db.reader() as connection:
+            self.assertEqual(connection.execute("SELECT * FROM Buildings").fetchall(), [(1, 3, "barracks", 1)])
+            self.assertEqual(connection.execute("SELECT COUNT(*) FROM BuildJobs").fetchone()[0], 0)
+
+
+# start unittest for leaderboard.py
+class TestLeaderboard(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        path = os.path.join(self.directory.name, "Leviathan.db")
+        self.db = database.ConnectionManager(lambda: sqlite3.connect(path, check_same_thread=False), readers=1)
+        self.addCleanup(self.db.close)
+        with self.db.writer() as connection:
+            migrations.migrate(connection)
+            connection.executemany("INSERT INTO Players(PlayerID, PName, PPass, Food, Metal, Energy) VALUES(?,?,?,?,?,?)",
+                                   [(1, "username", "password", 0, 0, 0), (2, "second", "password", 50, 0, 0)])
+            connection.execute("INSERT INTO Buildings VALUES (1, 0, 'plantation', 2)")
+
+    def test_ranked_index_matches_sorted_list(self):
+        rng = random.Random(1)
+        index = leaderboard.RankedIndex(rng=rng)
+        index.build([(-10, 1), (-5, 2)])
+        keys = [(-10, 1), (-5, 2)]
+        for pid in range(3, 300):
+            key = (-rng.randrange(100), pid)
+            index.insert(key)
+            keys.append(key)
+        for key in rng.sample(keys, 100):
+            index.remove(key)
+            keys.remove(key)
+        keys.sort()
+        self.assertEqual(len(index), len(keys))
+        self.assertEqual(index.slice(0, len(keys)), keys)
+        self.assertEqual(index.slice(40, 5), keys[40:45])
+        for position in (0, 17, len(keys) - 1):
+            self.assertEqual(index.rank(keys[position]), position)
+        with self.assertRaises(KeyError):
+            index.remove((1, 0))
+
+    def test_load_and_update(self):
+        board = leaderboard.Leaderboard(lazy=False)
+        with self.db.reader() as connection:
+            self.assertEqual(board.load(connection), 2)
+        self.assertEqual(board.page(1, 10), [(1, "username", 200), (2, "second", 50)])
+        board.update(2, defense=300)
+        self.assertEqual(board.rank(2), (1, 350))
+        self.assertEqual(board.page(2, 1), [(2, "username", 200)])
+        self.assertFalse(board.update(3, resources=10))
+
+    def test_refresh_reads_scores_written_elsewhere(self):
+        board = leaderboard.Leaderboard(lazy=False)
+        with self.db.reader() as connection:
+            board.load(connection)
+        # production of a player nobody reads, and a player another worker created
+        with self.db.writer() as connection:
+            connection.execute("UPDATE Players SET Food = 500 WHERE PlayerID = 2")
+            connection.execute("INSERT INTO Players(PlayerID, PName, PPass, Food, Metal, Energy) "
+                               "VALUES(3, 'third', 'password', 300, 0, 0)")
+        with self.db.reader() as connection:
+            self.assertEqual(board.refresh(connection), 2)
+            self.assertEqual(board.refresh(connection), 0)
+        self.assertEqual(board.page(1, 10), [(1, "second", 500), (2, "third", 300), (3, "username", 200)])
+
+    def test_scores_follow_the_economy_tick(self):
+        state = server.ServerState(self.db, economy_mode="tick", use_cache=True)
+        state.start()
+        self.addCleanup(state.close)
+        self.assertIsNone(state.refresh_timer)
+        with self.db.writer() as connection:
+            connection.execute("UPDATE Players SET Metal = 400 WHERE PlayerID = 2")
+        state.ticker.after_tick()
+        self.assertEqual(state.leaderboard.rank(2), (1, 450))
+
+    def test_commands(self):
+        state = server.ServerState(self.db, economy_mode="poll")
+        state.start()
+        self.addCleanup(state.close)
+        session = server.new_session(lambda text: None)
+        server.handle_request(state, session, "login second password")
+        self.assertEqual(server.handle_request(state, session, "rank"), "2 50 2")
+        server.handle_request(state, session, "add_building 1 cabins 2")
+        self.assertEqual(server.handle_request(state, session, "leaderboard 1 2"), "1, second, 250^^2, username, 200^^")
+        server.handle_request(state, session, "army 40")
+        self.assertEqual(server.handle_request(state, session, "rank"), "1 290 2")
+        with self.db.reader() as connection:
+            self.assertEqual(connection.execute("SELECT Defense FROM Players WHERE PlayerID = 2").fetchone(), (40,))
+
+
+# start unittest for worldmap.py
+class TestWorldMap(unittest.TestCase):
+
+    def test_spiral_positions_are_unique_rings(self):
+        positions = [worldmap.spiral_position(index) for index in range(1 + 3 * 10 * 11)]
+        self.assertEqual(len(set(positions)), len(positions))
+        self.assertEqual(positions[0], (0, 0))
+        for ring in range(1, 11):
+            for index in range(3 * ring * (ring - 1) + 1, 3 * ring * (ring + 1) + 1):
+                self.assertEqual(worldmap.hex_distance(0, 0, *positions[index]), ring)
+
+    def test_chunk_and_range_queries(self):
+        world = worldmap.WorldMap()
+        for pid in range(1, 2001):
+            world.add(pid, f"player{pid}")
+        home = world.home(1)
+        near = world.near(*home, 2 * worldmap.CITY_SPACING)
+        self.assertEqual(near[0], (1, "player1", 0, 0))
+        # two rings of cities around the first one
+        self.assertEqual(len(near), 19)
+        everything = [city for key in worldmap.chunks_in_view(-200, -200, 200, 200) for city in world.chunk(*key)]
+        self.assertEqual(len(everything), 2000)
+        for pid, name, q, r in world.chunk(0, 0):
+            self.assertEqual(worldmap.chunk_of(q, r), (0, 0))
+
+    def test_map_commands(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "Leviathan.db")
+        db = database.ConnectionManager(lambda: sqlite3.connect(path, check_same_thread=False), readers=1)
+        self.addCleanup(db.close)
+        with db.writer() as connection:
+            migrations.migrate(connection)
+            migrations.generate_fixture(connection, 3, buildings_per_player=0)
+        state = server.ServerState(db)
+        state.start()
+        self.addCleanup(state.close)
+        session = server.new_session(MagicMock())
+        server.handle_request(state, session, "login player2 password")
+        self.assertEqual(server.handle_request(state, session, "map_home"), "-3 3")
+        self.assertEqual(server.handle_request(state, session, "map_near 3"),
+                         "2, player2, -3, 3^^1, player1, 0, 0^^3, player3, 0, 3^^")
+        self.assertIn("1, player1, 0, 0^^", server.handle_request(state, session, "map_chunk 0 0"))
+        self.assertEqual(server.handle_request(state, session, "map_chunk 50 50"), "")
+
+
+# start unittest for journal.py
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "Leviathan.db")
+        self.journal_dir = os.path.join(self.directory.name, "journal")
+        self.db = database.ConnectionManager(lambda: sqlite3.connect(self.path, check_same_thread=False), readers=1)
+        self.addCleanup(self.db.close)
+        with self.db.writer() as connection:
+            migrations.migrate(connection)
+            connection.execute("INSERT INTO Players(PlayerID, PName, PPass, Food, Metal, Energy) "
+                               "VALUES (1, 'username', 'password', 0, 0, 0)")
+
+    def state(self):
+        state = server.ServerState(self.db, economy_mode="poll", journal_dir=self.journal_dir)
+        state.start()
+        session = server.new_session(MagicMock())
+        server.handle_request(state, session, "login username password")
+        return state, session
+
+    def rows(self, path):
+        connection = sqlite3.connect(path)
+        try:
+            return (connection.execute("SELECT Food, Defense FROM Players").fetchall(),
+                    connection.execute("SELECT * FROM Buildings").fetchall())
+        finally:
+            connection.close()
+
+    def test_events_are_written_in_order(self):
+        state, session = self.state()
+        server.handle_batch(state, session, ["add_building 0 plantation 1", "update", "army 30"])
+        state.journal.flush()
+        events = list(journal.read_events(self.journal_dir))
+        self.assertEqual([event["type"] for event in events], ["add_building", "update", "army"])
+        self.assertEqual([event["seq"] for event in events], [1, 2, 3])
+        state.close()
+
+    def test_restore_from_snapshot_and_journal(self):
+        state, session = self.state()
+        server.handle_request(state, session, "add_building 0 plantation 1")
+        self.assertIsNotNone(state.snapshot())
+        # nothing new since the last snapshot
+        self.assertIsNone(state.snapshot())
+        server.handle_request(state, session, "update")
+        server.handle_request(state, session, "army 30")
+        state.close()
+        restored = os.path.join(self.directory.name, "restored.db")
+        self.assertEqual(journal.restore(self.journal_dir, restored), 2)
+        self.assertEqual(self.rows(restored), self.rows(self.path))
+        self.assertEqual(self.rows(restored), ([(5, 30)], [(1, 0, "plantation", 1)]))
+
+    def test_point_in_time_restore(self):
+        state, session = self.state()
+        server.handle_request(state, session, "add_building 0 plantation 1")
+        server.handle_request(state, session, "update")
+        state.journal.flush()
+        until = list(journal.read_events(self.journal_dir))[-1]["ts"]
+        server.handle_request(state, session, "update")
+        state.close()
+        restored = os.path.join(self.directory.name, "restored.db")
+        self.assertEqual(journal.restore(self.journal_dir, restored, until), 2)
+        self.assertEqual(self.rows(restored)[0], [(5, None)])
+
+    def test_restore_drops_finished_build_jobs(self):
+        state, session = self.state()
+        state.snapshot()
+        server.handle_request(state, session, "upgrade_building 3 barracks 1")
+        self.assertEqual(state.scheduler.run_due(now=time.time() + 120), 1)
+        state.journal.flush()
+        events = list(journal.read_events(self.journal_dir))
+        self.assertEqual([event["type"] for event in events], ["upgrade_scheduled", "add_building", "build_finished"])
+        state.close()
+        restored = os.path.join(self.directory.name, "restored.db")
+        journal.restore(self.journal_dir, restored)
+        connection = sqlite3.connect(restored)
+        try:
+            self.assertEqual(connection.execute("SELECT * FROM BuildJobs").fetchall(), [])
+        finally:
+            connection.close()
+        self.assertEqual(self.rows(restored)[1], [(1, 3, "barracks", 1)])
+
+    def test_compaction_keeps_what_restores_need(self):
+        state, session = self.state()
+        for level in range(1, 4):
+            server.handle_request(state, session, f"add_building 0 plantation {level}")
+            state.snapshot()
+        state.close()
+        self.assertEqual(len(journal.snapshots(self.journal_dir)), journal.KEEP_SNAPSHOTS)
+        oldest = journal.snapshots(self.journal_dir)[0][0]
+        self.assertTrue(all(event["seq"] > oldest for event in journal.read_events(self.journal_dir)))
+        self.assertEqual(journal.segments(self.journal_dir)[0][0], oldest + 1)
+
+
 # start unittest for Player.py
 class TestPlayer(unittest.TestCase):
 
@@ -334,7 +1393,7 @@ class TestPlayer(unittest.TestCase):
         # Prepare mock objects
         mock_client = MagicMock()
         mock_socket.return_value = mock_client
-        mock_client.recv.return_value = "10000 10000 0"
+        mock_client.recv_text.return_value = "10000 10000 0"
         player = Player.Player(client=mock_client)
 
         # Call the function
@@ -342,15 +1401,15 @@ class TestPlayer(unittest.TestCase):
 
         # Assertions
         self.assertEqual(result, ["10000", "10000", "0"])
-        mock_client.send.assert_called_once()
-        mock_client.recv.assert_called_once()
+        mock_client.send_text.assert_called_once()
+        mock_client.recv_text.assert_called_once()
 
     @patch('Player.socket.socket')
     def test_get_buildings(self, mock_socket):
         # Prepare mock objects
         mock_client = MagicMock()
         mock_socket.return_value = mock_client
-        mock_client.recv.return_value = "(1, 1, 'plantation', 1)^^(1, 2, 'cabins', 1)"
+        mock_client.recv_text.return_value = "(1, 1, 'plantation', 1)^^(1, 2, 'cabins', 1)"
         player = Player.Player(client=mock_client)
 
         # Call the function
@@ -358,8 +1417,8 @@ class TestPlayer(unittest.TestCase):
 
         # Assertions
         self.assertEqual(result, ["(1, 1, 'plantation', 1)", "(1, 2, 'cabins', 1)"])
-        mock_client.send.assert_called_once()
-        mock_client.recv.assert_called_once()
+        mock_client.send_text.assert_called_once()
+        mock_client.recv_text.assert_called_once()
 
     @patch('Player.socket.socket')
     def test_commit_building(self, mock_socket):
@@ -372,8 +1431,176 @@ class TestPlayer(unittest.TestCase):
         player.commit_building(1, 1, 1)
 
         # Assertions
-        mock_client.send.assert_called_once_with(b'add_building 1 1 1')
-        mock_client.recv.assert_not_called()
+        mock_client.send_text.assert_called_once_with('add_building 1 1 1')
+        mock_client.recv_text.assert_not_called()
+
+    @patch('Player.connect_to_server')
+    def test_reconnect_resumes_session(self, mock_connect_to_server):
+        mock_client = mock_connect_to_server.return_value
+        mock_client.recv_text.return_value = "accepted binary zlib-dict"
+        old_client = MagicMock()
+        player = Player.Player()
+        player.set_parameters(old_client, "username", "password", "0.token")
+        player.reconnect()
+        old_client.close.assert_called_once()
+        mock_client.send_text.assert_called_once_with("resume 0.token binary zlib-dict")
+        self.assertTrue(player.binary)
+
+    @patch('Player.pygame')
+    @patch('Player.socket.socket')
+    def test_connect_gives_up(self, mock_socket, mock_pygame):
+        mock_socket.return_value.connect.side_effect = ConnectionRefusedError
+        self.assertRaises(Player.ServerUnavailable, Player.connect_to_server)
+        self.assertEqual(mock_socket.return_value.connect.call_count, Player.CONNECT_TRIES)
+        mock_pygame.quit.assert_not_called()
+
+    @patch('Player.connect_to_server')
+    def test_reconnect_logs_in_after_expiry(self, mock_connect_to_server):
+        mock_client = mock_connect_to_server.return_value
+        mock_client.recv_text.side_effect = ["rejected", "accepted 0.fresh"]
+        player = Player.Player()
+        player.set_parameters(MagicMock(), "username", "password", "0.token")
+        player.reconnect()
+        mock_client.send_text.assert_called_with("login username password binary zlib-dict")
+        self.assertEqual(player.token, "0.fresh")
+        # a server without packed replies answers without binary, the client stays with text
+        self.assertFalse(player.binary)
+
+    @patch('Player.connect_to_server')
+    def test_reconnect_subscribes_again(self, mock_connect_to_server):
+        mock_client = mock_connect_to_server.return_value
+        mock_client.recv_text.side_effect = ["accepted", "subscribed"]
+        player = Player.Player()
+        player.set_parameters(MagicMock(), "username", "password", "0.token")
+        player.subscribed = True
+        player.reconnect()
+        mock_client.send_text.assert_called_with("subscribe")
+        self.assertTrue(player.subscribed)
+
+    def test_apply_push(self):
+        player = Player.Player(client=MagicMock())
+        player.apply_push("resources 5 6 7")
+        player.apply_push("building 3 plantation 2")
+        self.assertEqual((player.food, player.steel, player.energy), (5, 6, 7))
+        self.assertEqual(player.building_updates, [(3, "plantation", 2)])
+
+    def test_upgrade_building(self):
+        mock_client = MagicMock()
+        mock_client.recv_text.side_effect = ["scheduled 45.0", "rejected"]
+        player = Player.Player(client=mock_client)
+        self.assertEqual(player.upgrade_building(2, "powerplant", 1), 45.0)
+        mock_client.send_text.assert_called_once_with("upgrade_building 2 powerplant 1")
+        self.assertIsNone(player.upgrade_building(2, "powerplant", 1))
+
+    def test_get_map_chunks(self):
+        mock_client = MagicMock()
+        mock_client.recv.return_value = (protocol.MSG_BATCH, protocol.encode_batch(["ok 1, player1, 0, 0^^", "ok "]))
+        player = Player.Player(client=mock_client)
+        self.assertEqual(player.get_map_chunks([(0, 0), (1, 0)]), {(0, 0): [(1, "player1", 0, 0)], (1, 0): []})
+        mock_client.send.assert_called_once_with(protocol.encode_batch(["map_chunk 0 0", "map_chunk 1 0"]),
+                                                 protocol.MSG_BATCH)
+
+    def test_leaderboard_page_and_rank(self):
+        mock_client = MagicMock()
+        mock_client.recv_text.side_effect = ["1, second, 250^^2, username, 200^^", "2 200 2"]
+        player = Player.Player(client=mock_client)
+        self.assertEqual(player.get_leaderboard(1, 2), [(1, "second", 250), (2, "username", 200)])
+        mock_client.send_text.assert_called_once_with("leaderboard 1 2")
+        self.assertEqual(player.get_rank(), (2, 200, 2))
+
+    def test_sync_buildings(self):
+        mock_client = MagicMock()
+        mock_client.recv_text.side_effect = ["full 7 3^^1, 0, plantation, 1^^1, 4, cabins, 2^^", "unchanged"]
+        player = Player.Player(client=mock_client)
+        self.assertEqual(player.sync_buildings(), (True, [(0, "plantation", 1), (4, "cabins", 2)]))
+        mock_client.send_text.assert_called_with("buildings_since 0 0")
+        self.assertEqual(player.sync_buildings(), (False, []))
+        mock_client.send_text.assert_called_with("buildings_since 7 3")
+
+    def test_binary_replies(self):
+        mock_client = MagicMock()
+        mock_client.recv_reply.side_effect = [
+            (protocol.MSG_BINARY, protocol.pack_reply("buildings_since", ("delta", 7, 4), [(1, 4, "cabins", 3)])),
+            (protocol.MSG_BINARY, protocol.pack_reply("leaderboard", rows=[(1, "second", 250)])),
+        ]
+        player = Player.Player(client=mock_client)
+        player.set_parameters(mock_client, "username", "password", "0.token", binary=True)
+        self.assertEqual(player.sync_buildings(), (False, [(4, "cabins", 3)]))
+        self.assertEqual((player.buildings_epoch, player.buildings_version), (7, 4))
+        self.assertEqual(player.get_leaderboard(1, 1), [(1, "second", 250)])
+        mock_client.recv_text.assert_not_called()
+
+    def test_binary_info_and_buildings(self):
+        mock_client = MagicMock()
+        mock_client.recv_reply.side_effect = [
+            (protocol.MSG_BINARY, protocol.pack_reply("info", (250, 40, 7))),
+            (protocol.MSG_BINARY, protocol.pack_reply("info_buildings", rows=[(1, 1, "plantation", 1),
+                                                                              (1, 2, "cabins", 1)])),
+        ]
+        player = Player.Player()
+        player.set_parameters(mock_client, "username", "password", "0.token", binary=True)
+        self.assertEqual(player.get_player_info(), ["250", "40", "7"])
+        self.assertEqual((player.food, player.steel, player.energy), (250, 40, 7))
+        self.assertEqual(player.get_buildings(), ["1, 1, plantation, 1", "1, 2, cabins, 1"])
+        mock_client.send_text.assert_called_with("info_buildings")
+        mock_client.recv_text.assert_not_called()
+
+
+# start unittest for Network.py
+class TestNetworkWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.player = MagicMock(subscribed=False)
+        self.worker = Network.NetworkWorker(self.player, poll_seconds=0.01)
+        self.worker.start()
+        self.addCleanup(self.worker.stop)
+
+    def wait_for_replies(self, count):
+        handled = 0
+        for _ in range(500):
+            handled += self.worker.drain()
+            if handled >= count:
+                return handled
+            threading.Event().wait(0.01)
+        return handled
+
+    def test_slow_request_does_not_block_the_caller(self):
+        release = threading.Event()
+        results = []
+        self.assertTrue(self.worker.submit(lambda: release.wait(5) and "reply", results.append, key="slow"))
+        # a second request with the same key waits for the first, the frame goes on without a reply
+        self.assertFalse(self.worker.submit(lambda: "again", results.append, key="slow"))
+        self.assertEqual(self.worker.drain(), 0)
+        release.set()
+        self.assertEqual(self.wait_for_replies(1), 1)
+        self.assertEqual(results, ["reply"])
+        self.assertTrue(self.worker.submit(lambda: "again", results.append, key="slow"))
+
+    def test_errors_go_to_on_error(self):
+        errors = []
+
+        def fail():
+            raise ConnectionAbortedError("Connection closed by peer")
+
+        self.worker.submit(fail, on_error=errors.append)
+        self.assertEqual(self.wait_for_replies(1), 1)
+        self.assertIsInstance(errors[0], ConnectionAbortedError)
+
+    def test_lost_server_is_raised_on_the_render_thread(self):
+        self.worker.submit(lambda: Player.connect_to_server(tries=0), on_error=self.fail)
+        for _ in range(500):
+            if not self.worker.inbound.empty():
+                break
+            threading.Event().wait(0.01)
+        self.assertRaises(Player.ServerUnavailable, self.worker.drain)
+
+    def test_idle_worker_reads_pushes(self):
+        self.player.subscribed = True
+        for _ in range(500):
+            if self.player.poll_updates.called:
+                break
+            threading.Event().wait(0.01)
+        self.player.poll_updates.assert_called()
 
 
 # start test for UIElements.py
@@ -348,7 +348,7 @@ class TestPlayer(unittest.TestCase):
         # Prepare mock objects
         mock_client = MagicMock()
         mock_socket.return_value = mock_client
-        mock_client.recv.return_value = "10000 10000 0"
+        mock_client.recv_text.return_value = "10000 10000 0"
         player = Player.Player(client=mock_client)
 
         # Call the function
@@ -356,15 +356,15 @@ class TestPlayer(unittest.TestCase):
 
         # Assertions
         self.assertEqual(result, ["10000", "10000", "0"])
-        mock_client.send.assert_called_once()
-        mock_client.recv.assert_called_once()
+        mock_client.send_text.assert_called_once()
+        mock_client.recv_text.assert_called_once()
 
     @patch('Player.socket.socket')
     def test_get_buildings(self, mock_socket):
         # Prepare mock objects
         mock_client = MagicMock()
         mock_socket.return_value = mock_client
-        mock_client.recv.return_value = "(1, 1, 'plantation', 1)^^(1, 2, 'cabins', 1)"
+        mock_client.recv_text.return_value = "(1, 1, 'plantation', 1)^^(1, 2, 'cabins', 1)"
         player = Player.Player(client=mock_client)
 
         # Call the function
@@ -372,8 +372,8 @@ class TestPlayer(unittest.TestCase):
 
         # Assertions
         self.assertEqual(result, ["(1, 1, 'plantation', 1)", "(1, 2, 'cabins', 1)"])
-        mock_client.send.assert_called_once()
-        mock_client.recv.assert_called_once()
+        mock_client.send_text.assert_called_once()
+        mock_client.recv_text.assert_called_once()
 
     @patch('Player.socket.socket')
     def test_commit_building(self, mock_socket):
@@ -386,8 +386,8 @@ class TestPlayer(unittest.TestCase):
         player.commit_building(1, 1, 1)
 
         # Assertions
-        mock_client.send.assert_called_once_with(b'add_building 1 1 1')
-        mock_client.recv.assert_not_called()
+        mock_client.send_text.assert_called_once_with('add_building 1 1 1')
+        mock_client.recv_text.assert_not_called()
 
 
 # Start test for TestUIElements class